@@ -0,0 +1,288 @@
+"""
+Micro-benchmarks for the chat crypto and storage paths.
+
+Usage:
+    python benchmark.py              # run every benchmark
+    python benchmark.py ciphers      # run only the named benchmark(s)
+"""
+import os
+import subprocess
+import sys
+import time
+
+# Rough distribution of chat message sizes (bytes -> share of messages).
+MESSAGE_SIZES = {16: 0.30, 64: 0.35, 256: 0.20, 1024: 0.10, 4096: 0.05}
+
+
+def timeit(func, repeat=5, number=20):
+    """Returns the best average time per call, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def bench_ciphers():
+    """Salsa20 vs AES-CTR through EncryptionManager over the message-size distribution."""
+    from encryption import EncryptionManager, CIPHERS
+
+    print(f"{'size':>6} " + " ".join(f"{name:>14}" for name in CIPHERS))
+    weighted = dict.fromkeys(CIPHERS, 0.0)
+    for size, share in MESSAGE_SIZES.items():
+        message = "x" * size
+        row = []
+        for name in CIPHERS:
+            manager = EncryptionManager(os.urandom(32), cipher=name)
+            t = timeit(lambda: manager.decrypt_message(manager.encrypt_message(message)))
+            weighted[name] += share * t
+            row.append(f"{t * 1e6:>11.1f} us")
+        print(f"{size:>6} " + " ".join(row))
+    print("weighted " + " ".join(f"{weighted[name] * 1e6:>11.1f} us" for name in CIPHERS))
+
+
+def bench_backends():
+    """Every registered implementation of each crypto primitive."""
+    import crypto_backends
+
+    key, nonce = os.urandom(32), os.urandom(8)
+    for size in (64, 4096, 65536):
+        data = os.urandom(size)
+        for name in crypto_backends.available('salsa20'):
+            impl = crypto_backends.implementation('salsa20', name)
+            t = timeit(lambda: impl(key, nonce, data), number=5)
+            print(f"salsa20 {name:>14} {size:>6} B {t * 1e6:>11.1f} us")
+
+    from custom_rsa import generate_rsa_keys
+    for bits in (512, 2048):
+        private_key, _ = generate_rsa_keys(bit_length=bits)
+        c = int.from_bytes(os.urandom(bits // 8 - 1), 'big')
+        for name in crypto_backends.available('powmod'):
+            impl = crypto_backends.implementation('powmod', name)
+            t = timeit(lambda: impl(c, private_key.d, private_key.n), number=5)
+            print(f"powmod  {name:>14} {bits:>6} b {t * 1e6:>11.1f} us")
+
+
+def bench_parallel_salsa20():
+    """Pure-Python Salsa20 on attachment-sized buffers with 1..N worker processes."""
+    import parallel_salsa20
+
+    key, nonce = os.urandom(32), os.urandom(8)
+    cores = os.cpu_count() or 1
+    counts = sorted({1, 2, 4, 8, cores} & set(range(1, cores + 1)))
+    for size in (1 << 20, 4 << 20):
+        data = os.urandom(size)
+        parallel_salsa20.salsa20_xor(key, nonce, data[:parallel_salsa20.PARALLEL_MIN_BYTES], workers=cores)  # start the pool
+        serial = None
+        for workers in counts:
+            t = timeit(lambda: parallel_salsa20.salsa20_xor(key, nonce, data, workers=workers), repeat=2, number=1)
+            serial = serial or t
+            print(f"salsa20 {size >> 20:>3} MiB {workers:>3} workers {size / t / 1e6:7.2f} MB/s  speedup {serial / t:4.2f}x")
+    parallel_salsa20.shutdown()
+
+
+def bench_rsa():
+    """Key generation and decryption time against the number of primes in the modulus."""
+    from custom_rsa import RSAKey, generate_rsa_keys, max_primes, encrypt, decrypt
+
+    print(f"{'bits':>6} {'primes':>6} {'keygen':>12} {'decrypt':>12} {'no CRT':>12}")
+    for bits in (1024, 2048, 4096):
+        for primes in range(2, max_primes(bits) + 1):
+            keygen = timeit(lambda: generate_rsa_keys(bit_length=bits, primes=primes), repeat=1, number=5 if bits < 4096 else 2)
+            private_key, public_key = generate_rsa_keys(bit_length=bits, primes=primes)
+            plain = RSAKey(private_key.n, private_key.e, private_key.d)
+            c = encrypt(os.urandom(32).hex(), public_key)
+            t_crt = timeit(lambda: decrypt(c, private_key), number=10)
+            t_plain = timeit(lambda: decrypt(c, plain), number=10)
+            print(f"{bits:>6} {primes:>6} {keygen * 1e3:>9.1f} ms {t_crt * 1e6:>9.1f} us {t_plain * 1e6:>9.1f} us")
+
+
+def bench_session_tokens():
+    """Cost of authenticating a register: bcrypt password check vs session token verification."""
+    import bcrypt
+    from session_tokens import TokenSigner
+
+    hashed = bcrypt.hashpw(b"password", bcrypt.gensalt())
+    t_bcrypt = timeit(lambda: bcrypt.checkpw(b"password", hashed), number=3)
+    signer = TokenSigner(os.urandom(32))
+    token, _ = signer.issue("alice")
+    t_token = timeit(lambda: signer.verify(token), number=10000)
+    print(f"bcrypt check: {t_bcrypt * 1e3:8.1f} ms")
+    print(f"token verify: {t_token * 1e6:8.1f} us")
+
+
+def bench_profiling():
+    """Cost of an instrumented stage with profiling off and on."""
+    from profiling import Profiler
+
+    for enabled in (False, True):
+        profiler = Profiler(enabled=enabled)
+
+        def timed():
+            with profiler.stage("bench"):
+                pass
+        t = timeit(timed, number=100000)
+        print(f"profiling {'on' if enabled else 'off':>3}: {t * 1e9:7.1f} ns per stage")
+
+
+def bench_offline_writes():
+    """Offline-message inserts/sec: one transaction per message vs group commit at several windows."""
+    import tempfile
+    import threading
+    import database
+    from write_behind import OfflineWriteQueue
+
+    senders, per_sender = 16, 150   # handlers storing one message at a time, waiting for the ack
+    fd, database.DATABASE_PATH = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        database.create_offline_messages_table()
+
+        def run(store):
+            threads = [threading.Thread(target=lambda i=i: [store((f"user{i}", "alice", "x" * 200))
+                                                              for _ in range(per_sender)])
+                       for i in range(senders)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            return senders * per_sender / (time.perf_counter() - start)
+
+        lock = threading.Lock()
+
+        def direct(message):
+            with lock:  # sqlite allows one writer; handlers would queue on its lock anyway
+                database.add_offline_message(*message)
+        print(f"{'per message':>14}: {run(direct):8.0f} inserts/s")
+
+        for window in (0, 0.001, 0.005, 0.02):
+            queue = OfflineWriteQueue(window=window)
+
+            def grouped(message):
+                done = threading.Event()
+                queue.put([message], lambda stored: done.set())
+                done.wait()
+            rate = run(grouped)
+            print(f"{'window ' + format(window * 1e3, 'g') + ' ms':>14}: {rate:8.0f} inserts/s "
+                  f"({queue.stats['rows'] / queue.stats['batches']:.1f} rows per transaction)")
+    finally:
+        os.remove(database.DATABASE_PATH)
+
+
+def bench_history_memory(count=1_000_000):
+    """Memory per history entry: list of strings vs MessageRecords, on a 1M-message fixture."""
+    import json
+    import random
+    from message_records import MessageRecords, SenderNames
+
+    # Half our own messages (stored as package JSON), half received plaintext,
+    # with sizes from MESSAGE_SIZES; packages carry a 2048-bit wrapped key.
+    rng = random.Random(0)
+    sizes = rng.choices(list(MESSAGE_SIZES), weights=list(MESSAGE_SIZES.values()), k=count)
+    contacts = [f"contact{i}" for i in range(50)]
+    entries = []
+    for i, size in enumerate(sizes):
+        if i % 2:
+            entries.append(f"{contacts[i % 50]}: " + "x" * size)
+        else:
+            package = {
+                'encrypted_sym_key': os.urandom(256).hex(),
+                'encrypted_message': os.urandom(8 + size).hex(),
+                'tag': os.urandom(16).hex(),
+                'key_fp': os.urandom(8).hex(),
+                'recipient': contacts[i % 50],
+            }
+            entries.append("me: " + json.dumps(package))
+    as_strings = sys.getsizeof(entries) + sum(sys.getsizeof(entry) for entry in entries)
+
+    start = time.perf_counter()
+    records = MessageRecords(SenderNames(), entries)
+    load = time.perf_counter() - start
+    # getsizeof of an array or bytearray includes its spare capacity
+    as_records = sum(sys.getsizeof(column) for column in (records.sender_ids, records.timestamps, records.offsets, records.data))
+    as_records += sys.getsizeof(records.senders.names) + sum(sys.getsizeof(name) for name in records.senders.names)
+
+    rows = [rng.randrange(count) for _ in range(10000)]
+    t_list = timeit(lambda: [entries[row] for row in rows], number=1) / len(rows)
+    t_records = timeit(lambda: [records[row] for row in rows], number=1) / len(rows)
+    assert all(records[row] == entries[row] for row in rows)
+    print(f"{count} messages")
+    print(f"list of strings  {as_strings / count:8.1f} B/message  {as_strings / 2**20:8.1f} MiB  read {t_list * 1e6:5.2f} us")
+    print(f"MessageRecords   {as_records / count:8.1f} B/message  {as_records / 2**20:8.1f} MiB  read {t_records * 1e6:5.2f} us")
+    print(f"reduction {1 - as_records / as_strings:.0%}, load {load / count * 1e6:.1f} us/message")
+
+
+def bench_compression():
+    """Compression ratio and CPU cost of the pre-encryption stage on sample chat text."""
+    import compression
+
+    samples = {
+        'short chat': "hey, are you coming to the meeting tomorrow?",
+        'paragraph': "I think that would be great. Let me know when you are free this weekend "
+                     "and we can go over the plan. Thanks again for sending me the file! " * 3,
+        'pasted log': "".join(f"2024-05-01 12:00:{i:02d} INFO worker-{i % 4} processed job {1000 + i} in {i * 7} ms\n"
+                              for i in range(60)),
+        'code block': "def handler(self, data):\n    if data is None:\n        return None\n"
+                      "    for item in data:\n        print(item)\n    return True\n" * 10,
+    }
+    for algorithm in compression.ALGORITHMS:
+        for name, text in samples.items():
+            data = text.encode('utf-8')
+            used, payload = compression.compress(data, algorithm)
+            t_compress = timeit(lambda: compression.compress(data, algorithm), number=50)
+            t_decompress = timeit(lambda: compression.decompress(used, payload), number=50)
+            print(f"{algorithm:>5} {name:>12} {len(data):>6} B -> {len(payload):>6} B "
+                  f"ratio {len(data) / len(payload):5.2f}  "
+                  f"compress {t_compress * 1e6:7.1f} us  decompress {t_decompress * 1e6:7.1f} us")
+
+
+def bench_startup():
+    """Client startup: -X importtime breakdown and time to the login window's first paint."""
+    env = dict(os.environ, VIBER_STARTUP_TIMING='1', VIBER_EXIT_AFTER_FIRST_PAINT='1')
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', 'main.py'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env, capture_output=True, text=True, timeout=120
+    )
+    wall = time.perf_counter() - start
+
+    # importtime lines: "import time: self [us] | cumulative | imported package"
+    imports = []
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line and 'cumulative' not in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            imports.append((int(cumulative), name.rstrip()))
+    top_level = [(us, name) for us, name in imports if not name.startswith(' ' * 3)]
+    print(f"{'cumulative':>12}  module")
+    for us, name in sorted(top_level, reverse=True)[:15]:
+        print(f"{us / 1000:>9.1f} ms  {name.strip()}")
+    for line in result.stdout.splitlines():
+        if line.startswith('STARTUP:'):
+            print(line)
+    print(f"process wall time {wall * 1000:.1f} ms (exit code {result.returncode})")
+
+
+BENCHMARKS = {
+    'ciphers': bench_ciphers,
+    'backends': bench_backends,
+    'rsa': bench_rsa,
+    'parallel_salsa20': bench_parallel_salsa20,
+    'compression': bench_compression,
+    'history_memory': bench_history_memory,
+    'profiling': bench_profiling,
+    'offline_writes': bench_offline_writes,
+    'session_tokens': bench_session_tokens,
+    'startup': bench_startup,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
+        print()
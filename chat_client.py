@@ -0,0 +1,1157 @@
+# chat_client.py
+"""
+Headless chat client library.
+
+Everything needed to talk to the /chat namespace without Qt:
+
+  - KeyCache:        contacts' RSA public keys, kept in the dashboard rows and
+                     revalidated against the server's key directory
+  - KeyDirectory:    client for the server's bulk /keys endpoint
+  - SessionAuth:     logs in against the server's /auth endpoints and keeps the
+                     signed session token used to register, refreshing it
+  - HistoryStore:    per-conversation history, optionally persisted to the dashboard table
+  - ContactSummaries: last message time, unread count and preview entry per
+                     conversation, for the contact list
+  - HistorySync:     per-conversation cursors into the server's message log, so a
+                     device fetches only the messages it missed
+  - load_keyring:    the user's private keys, every version, by fingerprint
+  - ChatSession:     encrypts outgoing messages and decrypts incoming ones;
+                     transport-agnostic, raises ChatClientError instead of showing dialogs
+  - InboundSequencer: puts sequenced deliveries back in order per conversation,
+                     detects gaps and tracks what to acknowledge
+  - OutgoingBatcher: coalesces 'message' events sent close together into one
+                     'message_batch' event, and acks into one 'ack' event
+  - AsyncChatClient: asyncio Socket.IO client built on a ChatSession
+                     (connect, register, send, `async for` over received messages)
+
+MainWindow is a view over a ChatSession; bots and load generators can use
+AsyncChatClient directly, many per process.
+"""
+import asyncio
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from chat_encryption import (
+    Keyring, PackageRejected, encrypt_chat_message, decrypt_chat_message,
+    encrypt_group_message, decrypt_group_message
+)
+from custom_rsa import (
+    generate_rsa_keys, parse_public_key, parse_private_key,
+    serialize_public_key, serialize_private_key
+)
+from database import (
+    add_contact, add_user_key, get_contacts, get_contact_public_keys, get_user_keys,
+    get_user_key_versions, get_sync_cursors, get_history_records, append_history_records, delete_contact, update_contact_keys,
+    get_contact_summaries, save_contact_summaries, mark_contact_read, delete_contact_summary, get_user_groups,
+    save_session_token, get_session_token, delete_session_token
+)
+from key_directory import directory_etag
+from message_records import MessageRecords, SenderNames
+from profiling import stage
+
+SERVER_URL = 'http://192.168.1.71:5000'
+BATCH_WINDOW = 0.02   # seconds an outgoing message waits for others to share its frame
+BATCH_MAX = 50        # messages per 'message_batch' frame, half the server's per-connection burst
+ACK_EVERY = 32        # received messages after which an ack is sent without waiting
+SESSION_REFRESH_MARGIN = 60 * 60   # seconds before expiry at which a session token is refreshed
+RECENT_ENTRIES = 1000  # newest entries per conversation that HistoryStore.contains() finds by hash
+
+
+class ChatClientError(Exception):
+    """
+    Raised when a message cannot be sent or received. `conversation` is set
+    when the failed message was still recorded in the history.
+    """
+    def __init__(self, message, conversation=None):
+        super().__init__(message)
+        self.conversation = conversation
+
+
+def load_user_keys(username):
+    """Loads a user's (private_key, public_key) from the users table."""
+    row = get_user_keys(username)
+    if row is None:
+        raise ChatClientError("User keys not found in database.")
+    return parse_private_key(row[0].strip()), parse_public_key(row[1].strip())
+
+
+def load_keyring(username, private_key):
+    """
+    Loads every key version of a user. `private_key` is the current key from
+    the users table; it is recorded as a new version if the keyring does not
+    have it yet (accounts created before key rotation).
+    """
+    keyring = Keyring()
+    for version, fingerprint, rsa_private in get_user_key_versions(username):
+        keyring.add(parse_private_key(rsa_private.strip()), version)
+    if private_key.fingerprint not in keyring:
+        version = add_user_key(
+            username, private_key.fingerprint,
+            serialize_private_key(private_key), serialize_public_key(private_key),
+            current=False
+        )
+        keyring.add(private_key, version)
+    return keyring
+
+
+class KeyDirectory:
+    """Client for the server's /keys endpoint (see key_directory.py)."""
+    def __init__(self, server_url=SERVER_URL, timeout=5):
+        self.url = server_url + '/keys'
+        self.timeout = timeout
+
+    def lookup(self, usernames, etag=None):
+        """
+        Looks up many users in one request. Returns
+        {username: {'rsa_public', 'version'}}, or None when `etag` shows the
+        caller already has every key (HTTP 304). Raises OSError if the server
+        cannot be reached.
+        """
+        headers = {'Content-Type': 'application/json'}
+        if etag is not None:
+            headers['If-None-Match'] = f'"{etag}"'
+        request = urllib.request.Request(
+            self.url, data=json.dumps({'usernames': list(usernames)}).encode('utf-8'),
+            headers=headers, method='POST'
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.load(response)['keys']
+        except urllib.error.HTTPError as ex:
+            if ex.code == 304:
+                return None
+            raise
+
+
+class SessionAuth:
+    """
+    Client for the server's /auth endpoints (see session_tokens.py). The
+    password is sent once, at login; after that the stored token is used
+    for 'register' and refreshed before it expires.
+    """
+    def __init__(self, server_url=SERVER_URL, timeout=5, persist=True):
+        self.url = server_url + '/auth'
+        self.timeout = timeout
+        self.persist = persist
+        self.tokens = {}   # username -> (token, expires_at), when not persisted
+
+    def _post(self, path, payload):
+        """The JSON response, or None if the server refused (HTTP 401). Raises OSError if unreachable."""
+        request = urllib.request.Request(
+            self.url + path, data=json.dumps(payload).encode('utf-8'),
+            headers={'Content-Type': 'application/json'}, method='POST'
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as ex:
+            if ex.code == 401:
+                return None
+            raise
+
+    def _store(self, username, result):
+        if self.persist:
+            save_session_token(username, result['token'], result['expires_at'])
+        else:
+            self.tokens[username] = (result['token'], result['expires_at'])
+        return result['token']
+
+    def login(self, username, password):
+        """Checks the password on the server. Returns the new token, or None if it was refused."""
+        result = self._post('/login', {'username': username, 'password': password})
+        return None if result is None else self._store(username, result)
+
+    def stored(self, username=None):
+        """
+        (username, token, expires_at) of the stored token that has not
+        expired, for `username` or else the most recently saved one; None if
+        there is none. Does not contact the server.
+        """
+        if self.persist:
+            row = get_session_token(username)
+        elif username in self.tokens:
+            row = (username, *self.tokens[username])
+        else:
+            row = None
+        if row is None or row[2] <= time.time():
+            return None
+        return row
+
+    def token(self, username):
+        """
+        A valid token for `username`, refreshed first if it expires within
+        SESSION_REFRESH_MARGIN; None if there is none or the server refused it.
+        """
+        row = self.stored(username)
+        if row is None:
+            return None
+        token, expires_at = row[1], row[2]
+        if expires_at - time.time() > SESSION_REFRESH_MARGIN:
+            return token
+        try:
+            result = self._post('/refresh', {'token': token})
+        except OSError as ex:
+            print("DEBUG: Session token refresh failed:", ex)
+            return token
+        if result is None:
+            self.forget(username)
+            return None
+        return self._store(username, result)
+
+    def forget(self, username):
+        if self.persist:
+            delete_session_token(username)
+        else:
+            self.tokens.pop(username, None)
+
+
+class KeyCache:
+    """
+    Maps contact usernames to RSAKey public keys. The keys are persisted in
+    the user's dashboard rows and revalidated with one directory lookup.
+
+    The first key seen for a contact is pinned (trust on first use). When the
+    directory later returns a different one, it is kept aside in `changed`
+    and only replaces the pinned key once accept() is called, after the user
+    has confirmed it.
+    """
+    def __init__(self):
+        self.keys = {}
+        self.versions = {}
+        self.changed = {}     # contact -> {'rsa_public', 'version'} waiting for confirmation
+        self.username = None  # owner of the dashboard rows, once loaded
+
+    def load(self, username):
+        """Loads every contact key stored in the user's dashboard rows in one query."""
+        self.username = username
+        for contact, rsa_public_str in get_contact_public_keys(username):
+            if rsa_public_str and rsa_public_str.strip():
+                self.add(contact, rsa_public_str)
+
+    def add(self, contact, rsa_public_str, version=None):
+        try:
+            self.keys[contact] = parse_public_key(rsa_public_str)
+            self.versions[contact] = version or self.keys[contact].fingerprint
+        except ValueError as ex:
+            print("DEBUG: Ignoring key for", contact, "-", ex)
+
+    def revalidate(self, directory, usernames):
+        """
+        Checks the cached keys of `usernames` against the directory in one
+        request; unchanged keys cost an empty 304. New keys are pinned.
+        Returns the usernames whose key differs from the pinned one.
+        """
+        return self.apply(self.fetch(directory, usernames))
+
+    def fetch(self, directory, usernames):
+        """
+        The network half of revalidate(): returns the directory's keys for
+        `usernames`, or None when the cached ones are current. Changes nothing,
+        so it can run on a worker thread.
+        """
+        usernames = list(usernames)
+        etag = directory_etag({u: self.versions[u] for u in usernames if u in self.versions})
+        return directory.lookup(usernames, etag)
+
+    def apply(self, keys):
+        """
+        Pins the keys of a fetch() result that are new and sets aside the
+        ones that differ from the pinned key. Returns the usernames of the latter.
+        """
+        if keys is None:
+            return []
+        new = {u: key for u, key in keys.items() if u not in self.keys}
+        for username, key in new.items():
+            self.add(username, key['rsa_public'], key['version'])
+        self._persist(new)
+        changed = [u for u, key in keys.items() if u not in new and self.versions.get(u) != key['version']]
+        for username in changed:
+            self.changed[username] = keys[username]
+        return changed
+
+    def accept(self, username):
+        """Replaces the pinned key of `username` with its changed key, once the user confirmed it."""
+        key = self.changed.pop(username)
+        self.add(username, key['rsa_public'], key['version'])
+        self._persist({username: key})
+
+    def _persist(self, keys):
+        if keys and self.username is not None:
+            update_contact_keys(self.username, {u: key['rsa_public'] for u, key in keys.items()})
+
+    def __contains__(self, contact):
+        return contact in self.keys
+
+    def __getitem__(self, contact):
+        return self.keys[contact]
+
+    def __setitem__(self, contact, public_key):
+        self.keys[contact] = public_key
+
+
+class HistoryStore:
+    """
+    Per-conversation sequences of "sender: text" entries, held compactly as
+    MessageRecords with one interned table of sender names. With
+    persist=True they are loaded from the user's history_records rows, and
+    each write only inserts the entries added since the previous one.
+
+    Conversations marked as changed are written later, together:
+    take_pending() collects them (cheap, on the caller's thread) and
+    write() stores them, which may run on another thread.
+    """
+    def __init__(self, username, persist=True):
+        self.username = username
+        self.persist = persist
+        self.senders = SenderNames()
+        self.conversations = {}
+        self.stored = set()  # conversations that have a dashboard row
+        self.saved = {}      # conversation -> number of its entries already in history_records
+        self.dirty = {}      # changed conversation -> newest sync cursor (or None), until written
+        self.recent = {}     # conversation -> (deque, Counter) of hashes of its newest entries
+
+    def load(self):
+        for contact, _ in get_contacts(self.username):
+            self.messages(contact)
+            self.stored.add(contact)
+        for contact, entry, created_at in get_history_records(self.username):
+            self.messages(contact).append(entry, created_at)
+        for contact, records in self.conversations.items():
+            self.saved[contact] = len(records)
+
+    def add(self, contact, rsa_public=None):
+        """
+        Starts a conversation (and its dashboard row) if it does not exist yet.
+        `rsa_public` is the contact's key from the key directory.
+        """
+        self.messages(contact)
+        if self.persist and contact not in self.stored:
+            add_contact(self.username, contact, rsa_public)
+            self.stored.add(contact)
+
+    def messages(self, contact):
+        records = self.conversations.get(contact)
+        if records is None:
+            records = self.conversations[contact] = MessageRecords(self.senders)
+        return records
+
+    def contains(self, contact, entry):
+        """Checks the newest RECENT_ENTRIES entries of a conversation (used for recent messages)."""
+        if hash(entry) not in self._recent(contact)[1]:
+            return False
+        return entry in self.messages(contact)[-RECENT_ENTRIES:]
+
+    def _recent(self, contact):
+        recent = self.recent.get(contact)
+        if recent is None:
+            recent = self.recent[contact] = (deque(), Counter())
+            for entry in self.messages(contact)[-RECENT_ENTRIES:]:
+                self._remember(recent, entry)
+        return recent
+
+    def _remember(self, recent, entry):
+        order, counts = recent
+        key = hash(entry)
+        order.append(key)
+        counts[key] += 1
+        if len(order) > RECENT_ENTRIES:
+            key = order.popleft()
+            counts[key] -= 1
+            if not counts[key]:
+                del counts[key]
+
+    def append(self, contact, entry):
+        self.messages(contact).append(entry, time.time())
+        if contact in self.recent:
+            self._remember(self.recent[contact], entry)
+
+    def mark(self, contact, sync_cursor=None):
+        """Notes that a conversation changed (and its sync cursor), for the next write."""
+        if not self.persist:
+            return
+        cursor = self.dirty.get(contact)
+        if sync_cursor is not None and (cursor is None or sync_cursor > cursor):
+            cursor = sync_cursor
+        self.dirty[contact] = cursor
+
+    def take_pending(self):
+        """(contact, new (contact, position, entry, created_at) rows, sync cursor, needs a dashboard row) per marked conversation."""
+        dirty, self.dirty = self.dirty, {}
+        pending = []
+        for contact, cursor in dirty.items():
+            records = self.messages(contact)
+            start = self.saved.get(contact, 0)
+            rows = [(contact, position, records[position], records.timestamp(position)) for position in range(start, len(records))]
+            self.saved[contact] = len(records)
+            pending.append((contact, rows, cursor, contact not in self.stored))
+            self.stored.add(contact)
+        return pending
+
+    def write(self, pending):
+        if not pending:
+            return
+        for contact, _, _, new in pending:
+            if new:
+                add_contact(self.username, contact)
+        append_history_records(
+            self.username,
+            [row for _, rows, _, _ in pending for row in rows],
+            {contact: cursor for contact, _, cursor, _ in pending if cursor is not None}
+        )
+
+    def remove(self, contact):
+        """Forgets a conversation; with persist=True its dashboard row and history rows are deleted."""
+        self.conversations.pop(contact, None)
+        self.saved.pop(contact, None)
+        self.dirty.pop(contact, None)
+        self.recent.pop(contact, None)
+        if contact in self.stored:
+            self.stored.discard(contact)
+            if self.persist:
+                delete_contact(self.username, contact)
+
+
+class ContactSummary:
+    __slots__ = ('last_message_at', 'unread', 'preview_id')
+
+    def __init__(self, last_message_at=0.0, unread=0, preview_id=None):
+        self.last_message_at = last_message_at
+        self.unread = unread
+        self.preview_id = preview_id  # position of the last message in the conversation's history
+
+
+class ContactSummaries:
+    """
+    What the contact list shows for each conversation. Updated incrementally
+    as messages are sent and received; with persist=True the changed
+    summaries are upserted into the contact_summary table by write(), like
+    HistoryStore's pending conversations.
+    """
+    def __init__(self, username, persist=True):
+        self.username = username
+        self.persist = persist
+        self.summaries = {}
+        self.dirty = set()  # contacts whose summary changed since the last write
+
+    def load(self, history):
+        """Loads the stored summaries; conversations without one start at time 0."""
+        for contact, last_message_at, unread, preview_id in get_contact_summaries(self.username):
+            self.summaries[contact] = ContactSummary(last_message_at, unread, preview_id)
+        for contact, messages in history.conversations.items():
+            if contact not in self.summaries:
+                self.summaries[contact] = ContactSummary(preview_id=len(messages) - 1 if messages else None)
+
+    def get(self, contact):
+        return self.summaries.get(contact)
+
+    def touch(self, contact, preview_id, unread=False, at=None):
+        """Records a new last message (the history entry at `preview_id`)."""
+        at = time.time() if at is None else at
+        summary = self.summaries.get(contact)
+        if summary is None:
+            summary = self.summaries[contact] = ContactSummary()
+        summary.last_message_at = max(summary.last_message_at, at)
+        summary.unread += int(unread)
+        summary.preview_id = preview_id
+        if self.persist:
+            self.dirty.add(contact)
+
+    def take_pending(self):
+        """(contact, last_message_at, unread, preview_id) per changed summary."""
+        dirty, self.dirty = self.dirty, set()
+        return [
+            (contact, summary.last_message_at, summary.unread, summary.preview_id)
+            for contact in dirty if (summary := self.summaries.get(contact)) is not None
+        ]
+
+    def write(self, pending):
+        if pending:
+            save_contact_summaries(self.username, pending)
+
+    def mark_read(self, contact):
+        summary = self.summaries.get(contact)
+        if summary is None or summary.unread == 0:
+            return
+        summary.unread = 0
+        if self.persist:
+            mark_contact_read(self.username, contact)
+
+    def remove(self, contact):
+        self.dirty.discard(contact)
+        if self.summaries.pop(contact, None) is not None and self.persist:
+            delete_contact_summary(self.username, contact)
+
+
+class HistorySync:
+    """
+    Client side of the server's message log (see database.append_message_log).
+
+    cursors[conversation] is the id of the newest log entry the local history
+    holds. Live deliveries carry their log_id and the prev_log_id of the
+    entry before them, so a device notices when it missed entries: those
+    deliveries are held back and the missing range is fetched with a 'sync'
+    request. 'sync_page' entries are complete ranges after the cursor and
+    are applied as they come.
+    """
+    def __init__(self, cursors=None):
+        self.cursors = dict(cursors or {})
+        self.held = {}  # conversation -> {prev_log_id: envelope} received after a gap
+
+    def request(self):
+        """Returns the payload of a 'sync' event."""
+        return {'cursors': dict(self.cursors)}
+
+    def accept(self, envelope):
+        """
+        Returns ([(text, log_id)] ready to apply, whether to send a 'sync' request).
+        """
+        conversation = envelope['conversation']
+        cursor = self.cursors.get(conversation, 0)
+        if envelope['log_id'] <= cursor:
+            return [], False
+        if envelope['prev_log_id'] != cursor:
+            held = self.held.setdefault(conversation, {})
+            held[envelope['prev_log_id']] = envelope
+            return [], len(held) == 1
+        self.cursors[conversation] = envelope['log_id']
+        return [(envelope['text'], envelope['log_id'])] + self._drain(conversation), False
+
+    def apply_page(self, page):
+        """
+        Handles a 'sync_page'. Returns ([(text, log_id)] to apply, whether to
+        ask for the next page).
+        """
+        ready = []
+        for conversation, entries in page['pages'].items():
+            for log_id, text in entries:
+                if log_id > self.cursors.get(conversation, 0):
+                    self.cursors[conversation] = log_id
+                    ready.append((text, log_id))
+            ready.extend(self._drain(conversation))
+        return ready, page['more']
+
+    def _drain(self, conversation):
+        held = self.held.get(conversation)
+        if not held:
+            return []
+        cursor = self.cursors.get(conversation, 0)
+        for prev_id in [p for p, envelope in held.items() if envelope['log_id'] <= cursor]:
+            del held[prev_id]
+        ready = []
+        while cursor in held:
+            envelope = held.pop(cursor)
+            cursor = envelope['log_id']
+            ready.append((envelope['text'], cursor))
+        self.cursors[conversation] = cursor
+        if not held:
+            del self.held[conversation]
+        return ready
+
+
+class ChatSession:
+    """
+    The client-side chat logic, independent of any UI or transport.
+
+    prepare_message() returns the (event, payload) to emit; receive() takes
+    the payload of a 'message' event and returns the decrypted message.
+    """
+    def __init__(self, username, private_key, public_key, keys=None, history=None, groups=None, search_index=None, log=None, keyring=None, summaries=None, load_groups=None, allow_untagged=False):
+        self.username = username
+        self.private_key = private_key
+        self.public_key = public_key
+        if keyring is None:
+            keyring = Keyring()
+            keyring.add(private_key, 1)
+        self.keyring = keyring
+        self.keys = keys if keys is not None else KeyCache()
+        self.history = history if history is not None else HistoryStore(username, persist=False)
+        self.groups = groups if groups is not None else {}
+        self.load_groups = load_groups  # returns the user's current {group: members}, or None
+        self.search_index = search_index
+        self.log = log if log is not None else HistorySync()
+        self.summaries = summaries if summaries is not None else ContactSummaries(username, persist=False)
+        self.rejected = Counter()  # packages refused before decryption, by PackageRejected.reason (or not_member, untagged)
+        self.allow_untagged = allow_untagged  # accept packages without a Poly1305 tag (peers from before tags)
+
+    @classmethod
+    def for_user(cls, username, **kwargs):
+        """Builds a session from the local database (keys, contacts and history)."""
+        private_key, public_key = load_user_keys(username)
+        keyring = load_keyring(username, private_key)
+        keys = KeyCache()
+        keys.load(username)
+        history = HistoryStore(username)
+        history.load()
+        log = HistorySync(get_sync_cursors(username))
+        summaries = ContactSummaries(username)
+        summaries.load(history)
+        kwargs.setdefault('load_groups', lambda: get_user_groups(username))
+        return cls(
+            username, private_key, public_key, keys=keys, history=history, log=log,
+            keyring=keyring, summaries=summaries, **kwargs
+        )
+
+    def rotate_keys(self, bit_length=1024, primes=2, persist=True):
+        """
+        Switches to a new RSA key pair. The old private key stays in the
+        keyring, so messages encrypted for it (archived or still in flight)
+        remain readable. Contacts pick up the new public key from the key
+        directory. `primes` > 2 makes a multi-prime key (see generate_rsa_keys).
+        Returns the new key's fingerprint.
+        """
+        private_key, public_key = generate_rsa_keys(bit_length=bit_length, primes=primes)
+        version = max(self.keyring.versions.values(), default=0) + 1
+        if persist:
+            version = add_user_key(
+                self.username, private_key.fingerprint,
+                serialize_private_key(private_key), serialize_public_key(public_key)
+            )
+        self.keyring.add(private_key, version)
+        self.private_key, self.public_key = private_key, public_key
+        return private_key.fingerprint
+
+    def take_pending(self):
+        """The history and summary changes not written yet; pass them to write_pending."""
+        return self.history.take_pending(), self.summaries.take_pending()
+
+    def write_pending(self, pending):
+        """Stores what take_pending returned. Only touches the database, so it can run on a worker thread."""
+        history, summaries = pending
+        self.history.write(history)
+        self.summaries.write(summaries)
+
+    def save(self):
+        """Writes the pending history and summary changes now."""
+        self.write_pending(self.take_pending())
+
+    def _index(self, contact, plaintext):
+        if self.search_index is not None:
+            self.search_index.add(contact, len(self.history.messages(contact)) - 1, plaintext)
+
+    def _group_members(self, group_name):
+        """Members of a group we belong to (reloading the groups once for a new one), or None."""
+        if group_name not in self.groups and self.load_groups is not None:
+            self.groups.update(self.load_groups())
+        return self.groups.get(group_name)
+
+    def _group_keys(self, group_name):
+        member_keys = {}
+        for member in self.groups[group_name]:
+            if member == self.username:
+                member_keys[member] = self.public_key
+            elif member in self.keys:
+                member_keys[member] = self.keys[member]
+            else:
+                print("DEBUG: No public key for group member:", member)
+        if len(member_keys) < 2:
+            raise ChatClientError("No public keys available for this group's members.")
+        return member_keys
+
+    def prepare_message(self, recipient, text):
+        """
+        Encrypts `text` for a contact or group, records it in the history and
+        returns (event_name, payload) for the /chat namespace. The history
+        change is written by the next save() (or take_pending/write_pending).
+        """
+        # Encrypt the message using the hybrid RSA–Salsa20 scheme. Group
+        # messages are encrypted once and the key is wrapped for every member
+        # (including ourselves, so our own history stays readable).
+        if recipient in self.groups:
+            member_keys = self._group_keys(recipient)
+            try:
+                with stage("send.encrypt"):
+                    package = encrypt_group_message(text, member_keys)
+            except Exception as ex:
+                raise ChatClientError(f"Failed to encrypt message: {ex}")
+            package['group'] = recipient
+            event, target = 'group_message', {'group': recipient}
+        else:
+            if recipient not in self.keys:
+                raise ChatClientError("Recipient's public key not available.")
+            try:
+                with stage("send.encrypt"):
+                    package = encrypt_chat_message(text, self.keys[recipient])
+            except Exception as ex:
+                raise ChatClientError(f"Failed to encrypt message: {ex}")
+            # Lets our other devices file their copy under the right conversation
+            package['recipient'] = recipient
+            event, target = 'message', {'recipient': recipient}
+
+        with stage("send.serialize"):
+            encrypted_message_str = json.dumps(package)
+        entry = f"{self.username}: {encrypted_message_str}"
+        with stage("send.history"):
+            self.history.append(recipient, entry)
+            self.history.mark(recipient)
+            self.summaries.touch(recipient, len(self.history.messages(recipient)) - 1)
+        with stage("send.index"):
+            self._index(recipient, text)
+
+        payload = {'text': entry, 'sender': self.username}
+        payload.update(target)
+        return event, payload
+
+    def decrypt_package(self, package):
+        """Decrypts a 1:1 or group package with the private key it names (see Keyring)."""
+        if 'encrypted_sym_keys' in package:
+            return decrypt_group_message(package, self.username, self.keyring)
+        return decrypt_chat_message(package, self.keyring)
+
+    def accept_delivery(self, envelope):
+        """
+        Takes a delivery released by InboundSequencer. Returns
+        ([(text, log_id)] to pass to receive(), whether to send a 'sync' request).
+        """
+        if isinstance(envelope, str):
+            return [(envelope, None)], False
+        if 'log_id' not in envelope:
+            return [(envelope['text'], None)], False
+        return self.log.accept(envelope)
+
+    def receive(self, data, log_id=None):
+        """
+        Expected data format: "sender: encrypted_message_str"
+        Returns (conversation, sender, plaintext), where conversation is the
+        group name for group messages and the sender otherwise. The message
+        is added to the history together with its message log position;
+        callers save() once per batch of received messages. Packages without
+        an authentication tag are refused unless the session allows them.
+
+        Our own messages (logged back to us, sent from this device or another)
+        are kept encrypted, like the ones prepare_message records, and
+        returned with plaintext None.
+        """
+        try:
+            sender, encrypted_message_str = data.split(": ", 1)
+        except Exception as ex:
+            self.history.append("Unknown", data)
+            raise ChatClientError(f"Message format error: {ex}", conversation="Unknown")
+
+        try:
+            with stage("receive.parse"):
+                package = json.loads(encrypted_message_str)
+        except Exception as ex:
+            raise ChatClientError(f"Failed to parse encrypted message: {ex}")
+
+        group = package.get('group')
+        if group is not None:
+            # Only groups we are in, and only from their members: the field is
+            # set by the sender and would otherwise pick any conversation
+            members = self._group_members(group)
+            if members is None or sender not in members:
+                self.rejected['not_member'] += 1
+                print("DEBUG: Rejected group message from", sender, "for group:", group)
+                raise ChatClientError(f"Message for group {group!r} from a non-member.")
+
+        if sender == self.username:
+            conversation = package.get('group', package.get('recipient'))
+            if conversation is None:
+                raise ChatClientError("Own message without a recipient.")
+            if not self.history.contains(conversation, data):
+                self.history.append(conversation, data)
+                self.summaries.touch(conversation, len(self.history.messages(conversation)) - 1)
+            self.history.mark(conversation, log_id)
+            return conversation, sender, None
+
+        if 'tag' not in package and not self.allow_untagged:
+            self.rejected['untagged'] += 1
+            print("DEBUG: Rejected untagged package from", sender)
+            raise ChatClientError("Rejected message: package has no authentication tag")
+
+        try:
+            with stage("receive.decrypt"):
+                plaintext = self.decrypt_package(package)
+        except PackageRejected as ex:
+            self.rejected[ex.reason] += 1
+            print("DEBUG: Rejected package from", sender, "-", ex.reason)
+            raise ChatClientError(f"Rejected message: {ex}")
+        except Exception as ex:
+            raise ChatClientError(f"Failed to decrypt message: {ex}")
+
+        conversation = package.get('group', sender)
+        with stage("receive.history"):
+            self.history.append(conversation, f"{sender}: {plaintext}")
+            self.history.mark(conversation, log_id)
+            self.summaries.touch(conversation, len(self.history.messages(conversation)) - 1, unread=True)
+        with stage("receive.index"):
+            self._index(conversation, plaintext)
+        return conversation, sender, plaintext
+
+
+class InboundSequencer:
+    """
+    Receiving side of the server's DeliveryWindow.
+
+    accept() takes a delivered envelope {'epoch', 'conversation', 'seq', 'text', ...}
+    and returns the envelopes that are now ready, in order. Messages that arrive
+    after a gap are held back until the gap is filled; duplicates (resends of
+    messages already received) are dropped. Plain text deliveries from a
+    server without sequencing are passed straight through.
+    """
+    def __init__(self):
+        self.epoch = None
+        self.delivered = {}   # conversation -> highest seq received in order
+        self.held = {}        # conversation -> {seq: envelope} received after a gap
+        self.unacked = set()  # conversations whose position changed since the last ack
+        self.received = 0     # messages received since the last ack
+        self.lock = threading.Lock()  # acks are taken from the batcher's timer thread
+
+    def sync(self, state):
+        """Handles 'delivery_state': {'epoch', 'delivered': {conversation: seq}}."""
+        with self.lock:
+            return self._sync(state)
+
+    def accept(self, envelope):
+        """
+        Returns (envelopes ready to display, 'resend' payload or None). A resend
+        payload is returned once per gap, when the first message after it arrives.
+        """
+        with self.lock:
+            return self._accept(envelope)
+
+    def reset(self, data):
+        """
+        Handles 'seq_reset': {'epoch', 'conversation', 'seq'}. The server can no
+        longer resend anything up to seq, so stop waiting for it.
+        """
+        with self.lock:
+            return self._reset(data)
+
+    def take_acks(self):
+        """
+        Returns the 'ack' payload covering everything received in order since
+        the last call (cumulative per conversation), or None if there is nothing new.
+        """
+        with self.lock:
+            return self._take_acks()
+
+    def _sync(self, state):
+        if state['epoch'] != self.epoch:
+            self.epoch = state['epoch']
+            self.delivered = {}
+            self.held = {}
+            self.unacked = set()
+        for conversation in set(self.delivered) | set(self.held):
+            if conversation not in state['delivered']:
+                # The server dropped its state for us; numbering starts over
+                self.delivered.pop(conversation, None)
+                self.held.pop(conversation, None)
+        for conversation, seq in state['delivered'].items():
+            if seq > self.delivered.get(conversation, 0):
+                self.delivered[conversation] = seq
+        # Held messages the server says we already have are delivered now
+        ready = []
+        for conversation in list(self.held):
+            ready.extend(self._drain(conversation, include_acked=True))
+        return ready
+
+    def _accept(self, envelope):
+        if isinstance(envelope, str):
+            return [envelope], None
+        if envelope['epoch'] != self.epoch:
+            self._sync({'epoch': envelope['epoch'], 'delivered': {}})
+        conversation, seq = envelope['conversation'], envelope['seq']
+        self.received += 1
+        self.unacked.add(conversation)
+        last = self.delivered.get(conversation, 0)
+        if seq <= last:
+            return [], None
+        held = self.held.setdefault(conversation, {})
+        held[seq] = envelope
+        if seq > last + 1:
+            if len(held) == 1:
+                print("DEBUG: Gap in", conversation, "- missing from seq", last + 1)
+                return [], {'epoch': self.epoch, 'conversation': conversation, 'from': last + 1}
+            return [], None
+        return self._drain(conversation), None
+
+    def _reset(self, data):
+        if data['epoch'] != self.epoch:
+            return []
+        conversation = data['conversation']
+        if data['seq'] > self.delivered.get(conversation, 0):
+            self.delivered[conversation] = data['seq']
+            self.unacked.add(conversation)
+        return self._drain(conversation, include_acked=True)
+
+    def _drain(self, conversation, include_acked=False):
+        held = self.held.get(conversation, {})
+        last = self.delivered.get(conversation, 0)
+        ready = []
+        if include_acked:
+            for seq in sorted(s for s in held if s <= last):
+                ready.append(held.pop(seq))
+        while last + 1 in held:
+            last += 1
+            ready.append(held.pop(last))
+        self.delivered[conversation] = last
+        if not held:
+            self.held.pop(conversation, None)
+        return ready
+
+    def _take_acks(self):
+        if not self.unacked:
+            return None
+        acks = {conversation: self.delivered.get(conversation, 0) for conversation in self.unacked}
+        self.unacked = set()
+        self.received = 0
+        return {'epoch': self.epoch, 'acks': acks}
+
+
+def _batch_event(pending):
+    """Returns the (event, payload) that sends the pending 'message' payloads."""
+    if len(pending) == 1:
+        return 'message', pending[0]
+    return 'message_batch', pending
+
+
+class OutgoingBatcher:
+    """
+    Holds 'message' events for up to `window` seconds and emits them together
+    as one 'message_batch' event. A lone message is still sent as 'message'.
+    Other events flush the pending messages first so ordering is preserved.
+
+    With an InboundSequencer, received messages are acknowledged the same way:
+    schedule_ack() makes the next flush send one cumulative 'ack', at the latest
+    `window` seconds later or straight away once ACK_EVERY messages are waiting.
+
+    Payloads the server sends back in 'throttled' are queued again with retry().
+
+    `emit` is called as emit(event, payload), from the caller's thread or a
+    timer thread.
+    """
+    def __init__(self, emit, window=BATCH_WINDOW, max_batch=BATCH_MAX, inbound=None):
+        self.emit = emit
+        self.window = window
+        self.max_batch = max_batch
+        self.inbound = inbound
+        self.pending = []
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def send(self, event, payload):
+        if event != 'message':
+            self.flush()
+            with stage("send.emit"):
+                self.emit(event, payload)
+            return
+        with self.lock:
+            self.pending.append(payload)
+            full = len(self.pending) >= self.max_batch
+            if not full and self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+
+    def after(self, delay, callback, *args):
+        """Calls callback(*args) on a timer thread `delay` seconds from now."""
+        timer = threading.Timer(delay, callback, args)
+        timer.daemon = True
+        timer.start()
+
+    def retry(self, event, payloads, delay):
+        """
+        Sends payloads of a throttled `event` again after `delay` seconds.
+        Throttled messages go out ahead of the ones queued since.
+        """
+        if event not in ('message', 'message_batch'):
+            self.after(delay, lambda: [self.send(event, payload) for payload in payloads])
+            return
+        with self.lock:
+            self.pending[:0] = payloads
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def schedule_ack(self):
+        if self.inbound.received >= ACK_EVERY:
+            self.flush()
+            return
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            acks = self.inbound.take_acks() if self.inbound is not None else None
+        for start in range(0, len(pending), self.max_batch):
+            with stage("send.emit"):
+                self.emit(*_batch_event(pending[start:start + self.max_batch]))
+        if acks:
+            self.emit('ack', acks)
+
+
+class AsyncChatClient:
+    """
+    asyncio Socket.IO client for the /chat namespace.
+
+        token = SessionAuth().login('alice', password)
+        client = AsyncChatClient(ChatSession.for_user('alice'), token=token)
+        await client.connect()
+        await client.send('bob', 'hi')
+        async for conversation, sender, text in client.messages():
+            ...
+    """
+    def __init__(self, session, server_url=SERVER_URL, token=None):
+        import socketio  # python-socketio[asyncio_client]
+        self.session = session
+        self.server_url = server_url
+        self.token = token      # session token from SessionAuth, sent with 'register'
+        self.sio = socketio.AsyncClient()
+        self.incoming = asyncio.Queue()
+        self.inbound = InboundSequencer()
+        self.pending = []       # 'message' payloads waiting for the batch window
+        self.flush_task = None
+        # History and summary writes run here, in order, off the event loop
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.sio.on('connect', self._on_connect, namespace='/chat')
+        self.sio.on('delivery_state', self._on_delivery_state, namespace='/chat')
+        self.sio.on('seq_reset', self._on_seq_reset, namespace='/chat')
+        self.sio.on('sync_page', self._on_sync_page, namespace='/chat')
+        self.sio.on('sync_hint', self._on_sync_hint, namespace='/chat')
+        self.sio.on('message', self._on_message, namespace='/chat')
+        self.sio.on('message_batch', self._on_message_batch, namespace='/chat')
+        self.sio.on('throttled', self._on_throttled, namespace='/chat')
+
+    async def connect(self):
+        await self.sio.connect(self.server_url, namespaces=['/chat'])
+
+    async def disconnect(self):
+        await self.flush()
+        await self.sio.disconnect()
+
+    async def register(self):
+        await self.sio.emit('register', {'username': self.session.username, 'token': self.token, 'sync': True}, namespace='/chat')
+
+    async def _on_connect(self):
+        await self.register()
+
+    async def _apply(self, entries):
+        for text, log_id in entries:
+            try:
+                result = self.session.receive(text, log_id)
+            except ChatClientError as ex:
+                print("DEBUG: Dropped incoming message:", ex)
+                continue
+            if result[2] is not None:
+                await self.incoming.put(result)
+
+    async def _deliver(self, envelopes):
+        for envelope in envelopes:
+            entries, needs_sync = self.session.accept_delivery(envelope)
+            await self._apply(entries)
+            if needs_sync:
+                await self.sync()
+        await self.save()
+
+    async def sync(self):
+        await self.sio.emit('sync', self.session.log.request(), namespace='/chat')
+
+    async def _on_delivery_state(self, data):
+        await self._deliver(self.inbound.sync(data))
+        await self.sync()
+
+    async def _on_sync_page(self, page):
+        entries, more = self.session.log.apply_page(page)
+        await self._apply(entries)
+        await self.save()
+        if more:
+            await self.sync()
+
+    async def _on_sync_hint(self, data):
+        await self.sync()
+
+    async def _on_seq_reset(self, data):
+        await self._deliver(self.inbound.reset(data))
+        self._schedule_flush()
+
+    async def _on_message(self, envelope):
+        await self._on_message_batch([envelope])
+
+    async def _on_message_batch(self, data):
+        released = []
+        for envelope in data:
+            envelopes, resend = self.inbound.accept(envelope)
+            if resend is not None:
+                await self.sio.emit('resend', resend, namespace='/chat')
+            released.extend(envelopes)
+        await self._deliver(released)
+        if self.inbound.received >= ACK_EVERY:
+            await self.flush()
+        else:
+            self._schedule_flush()
+
+    async def _on_throttled(self, data):
+        """Sends what the server throttled again once its rate limit allows."""
+        retry = data.get('retry')
+        if not retry:
+            print("DEBUG: Server refused", data.get('event'), "-", data.get('reason'))
+            return
+        await asyncio.sleep(data.get('retry_after', 0))
+        if data['event'] in ('message', 'message_batch'):
+            self.pending[:0] = retry
+            await self.flush()
+        else:
+            for payload in retry:
+                await self.sio.emit(data['event'], payload, namespace='/chat')
+
+    async def send(self, recipient, text):
+        """Messages sent within BATCH_WINDOW of each other share one frame."""
+        event, payload = self.session.prepare_message(recipient, text)
+        if event != 'message':
+            await self.flush()
+            await self.sio.emit(event, payload, namespace='/chat')
+            await self.save()
+            return
+        self.pending.append(payload)
+        if len(self.pending) >= BATCH_MAX:
+            await self.flush()
+        else:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(BATCH_WINDOW)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """
+        Sends the pending messages and a cumulative ack for what was received,
+        then saves the history changes.
+        """
+        pending, self.pending = self.pending, []
+        for start in range(0, len(pending), BATCH_MAX):
+            await self.sio.emit(*_batch_event(pending[start:start + BATCH_MAX]), namespace='/chat')
+        acks = self.inbound.take_acks()
+        if acks:
+            await self.sio.emit('ack', acks, namespace='/chat')
+        await self.save()
+
+    async def save(self):
+        """Writes the session's pending history and summary changes on the writer thread."""
+        writes = self.session.take_pending()
+        if any(writes):
+            await asyncio.get_running_loop().run_in_executor(self.writer, self.session.write_pending, writes)
+
+    async def messages(self):
+        """Yields (conversation, sender, plaintext) for every message received from others."""
+        while True:
+            yield await self.incoming.get()
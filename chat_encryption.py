@@ -1,71 +1,259 @@
-import os
-from encryption import EncryptionManager  # our Salsa20-based manager
-from custom_rsa import encrypt, decrypt
-
-def encrypt_chat_message(message, recipient_public_key):
-    """
-    Encrypts a chat message using a hybrid RSA-Salsa20 scheme.
-
-    Steps:
-      1. Generate a random 32-byte symmetric key.
-      2. Encrypt the message with Salsa20 using this key (via EncryptionManager).
-      3. Convert the symmetric key to a hex string.
-      4. Encrypt that hex string with the recipient's RSA public key.
-      5. Return a dictionary containing both encrypted parts as hex strings.
-    
-    :param message: The plaintext chat message.
-    :param recipient_public_key: An RSAKey object (public key) for the recipient.
-    :return: A dict with keys 'encrypted_sym_key' and 'encrypted_message'.
-    """
-    # 1. Generate a random symmetric key.
-    msg_sym_key = os.urandom(32)
-    
-    # 2. Encrypt the message using Salsa20 with msg_sym_key.
-    enc_manager = EncryptionManager(msg_sym_key)
-    encrypted_message = enc_manager.encrypt_message(message)  # hex string
-    
-    # 3. Convert the symmetric key to a hex string.
-    sym_key_str = msg_sym_key.hex()
-    
-    # 4. Encrypt the symmetric key using RSA.
-    # Our RSA encrypt function expects a string; it returns an integer.
-    rsa_encrypted_key_int = encrypt(sym_key_str, recipient_public_key)
-    # Convert the integer ciphertext to a hex string.
-    encrypted_sym_key = hex(rsa_encrypted_key_int)[2:]  # strip the "0x"
-    
-    # 5. Return the package.
-    return {
-        'encrypted_sym_key': encrypted_sym_key,
-        'encrypted_message': encrypted_message
-    }
-
-def decrypt_chat_message(package, recipient_private_key):
-    """
-    Decrypts a chat message that was encrypted using the hybrid RSA-Salsa20 scheme.
-
-    Steps:
-      1. Convert the RSA-encrypted symmetric key (hex) to an integer.
-      2. Decrypt it with the recipient's RSA private key to recover the symmetric key (as a hex string).
-      3. Convert the recovered symmetric key to bytes.
-      4. Use the symmetric key with Salsa20 (via EncryptionManager) to decrypt the encrypted message.
-    
-    :param package: A dict with keys 'encrypted_sym_key' and 'encrypted_message'.
-    :param recipient_private_key: An RSAKey object (private key) for the recipient.
-    :return: The decrypted plaintext message.
-    """
-    encrypted_sym_key_hex = package['encrypted_sym_key']
-    encrypted_message = package['encrypted_message']
-    
-    # 1. Convert the encrypted symmetric key from hex to integer.
-    rsa_encrypted_key_int = int(encrypted_sym_key_hex, 16)
-    
-    # 2. Decrypt the symmetric key using RSA.
-    sym_key_str = decrypt(rsa_encrypted_key_int, recipient_private_key)  # returns hex string
-    # 3. Convert the hex string to bytes.
-    msg_sym_key = bytes.fromhex(sym_key_str)
-    
-    # 4. Use this symmetric key to decrypt the message.
-    enc_manager = EncryptionManager(msg_sym_key)
-    decrypted_message = enc_manager.decrypt_message(encrypted_message)
-    
-    return decrypted_message
+import os
+from encryption import EncryptionManager, AuthenticationError  # our Salsa20-based manager
+from custom_rsa import encrypt, decrypt
+import compression
+
+class Keyring:
+    """
+    A user's RSA private keys, one per key version, indexed by fingerprint.
+
+    Packages name the key they were encrypted for in their 'key_fp' header,
+    so decryption looks the key up directly. Old versions stay in the ring
+    after a rotation to keep archived history readable; packages from before
+    the keyring (no header) were encrypted for the oldest key.
+    """
+    def __init__(self):
+        self.keys = {}       # fingerprint -> private RSAKey
+        self.versions = {}   # fingerprint -> version number
+        self.current = None  # private RSAKey with the highest version
+        self.oldest = None
+
+    def add(self, private_key, version):
+        fingerprint = private_key.fingerprint
+        self.keys[fingerprint] = private_key
+        self.versions[fingerprint] = version
+        if self.current is None or version > self.versions[self.current.fingerprint]:
+            self.current = private_key
+        if self.oldest is None or version < self.versions[self.oldest.fingerprint]:
+            self.oldest = private_key
+
+    def private_key(self, fingerprint=None):
+        if fingerprint is None:
+            return self.oldest
+        try:
+            return self.keys[fingerprint]
+        except KeyError:
+            raise ValueError(f"No private key with fingerprint {fingerprint}") from None
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+TAG_HEX_LENGTH = 32   # Poly1305 tag, hex
+
+class PackageRejected(ValueError):
+    """
+    A package that failed validation before it was decrypted. `reason` is
+    'malformed', 'unknown_key', 'bad_key' (the RSA-wrapped key does not
+    unwrap to a message key) or 'bad_tag'.
+    """
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+def _private_key_for(package, key):
+    """`key` is an RSAKey or a Keyring; a Keyring picks the key named in the package."""
+    if isinstance(key, Keyring):
+        try:
+            return key.private_key(package.get('key_fp'))
+        except ValueError as ex:
+            raise PackageRejected('unknown_key', str(ex)) from None
+    return key
+
+def _aad(algorithm):
+    """Header data the tag covers besides the ciphertext."""
+    return f"salsa20-poly1305:{algorithm or ''}".encode('ascii')
+
+def check_package(package, private_key):
+    """
+    Structural checks that cost next to nothing, done before any RSA or
+    Salsa20 work. Returns the RSA-encrypted message key as an integer;
+    raises PackageRejected.
+    """
+    encrypted_sym_key = package.get('encrypted_sym_key')
+    encrypted_message = package.get('encrypted_message')
+    tag = package.get('tag')
+    if not isinstance(encrypted_sym_key, str) or not isinstance(encrypted_message, str):
+        raise PackageRejected('malformed', "Package lacks its encrypted key or message")
+    if len(encrypted_message) < 16 or len(encrypted_message) % 2:
+        raise PackageRejected('malformed', "Encrypted message is too short or has an odd length")
+    if package.get('compression') not in (None, *compression.ALGORITHMS):
+        raise PackageRejected('malformed', f"Unsupported compression: {package.get('compression')}")
+    if tag is not None and (not isinstance(tag, str) or len(tag) != TAG_HEX_LENGTH):
+        raise PackageRejected('malformed', "Authentication tag has the wrong length")
+    try:
+        rsa_encrypted_key_int = int(encrypted_sym_key, 16)
+        if tag is not None:
+            bytes.fromhex(tag)
+    except ValueError:
+        raise PackageRejected('malformed', "Encrypted key or tag is not hex") from None
+    if not 0 < rsa_encrypted_key_int < private_key.n:
+        raise PackageRejected('malformed', "Encrypted key is out of range for the private key")
+    return rsa_encrypted_key_int
+
+def _encrypt_text(enc_manager, message, compress):
+    """
+    Optionally compresses the UTF-8 text, then encrypts and authenticates it.
+    Returns (hex ciphertext, hex Poly1305 tag, compression algorithm or None).
+    """
+    plaintext = message.encode('utf-8')
+    algorithm, payload = compression.compress(plaintext) if compress else (None, plaintext)
+    encrypted_message, tag = enc_manager.seal_bytes(payload, _aad(algorithm))
+    return encrypted_message, tag, algorithm
+
+def _decrypt_text(enc_manager, package):
+    """
+    Decrypts package['encrypted_message'] and undoes any compression named in
+    the header. Packages with a tag are authenticated first; packages from
+    before tags were added are decrypted as they are.
+    """
+    algorithm = package.get('compression')
+    if 'tag' in package:
+        try:
+            payload = enc_manager.open_bytes(package['encrypted_message'], package['tag'], _aad(algorithm))
+        except AuthenticationError as ex:
+            raise PackageRejected('bad_tag', str(ex)) from None
+    elif algorithm is None:
+        return enc_manager.decrypt_message(package['encrypted_message'])
+    else:
+        payload = enc_manager.decrypt_bytes(package['encrypted_message'])
+    if algorithm is None:
+        return payload.decode('utf-8')
+    return compression.decompress(algorithm, payload).decode('utf-8')
+
+def encrypt_chat_message(message, recipient_public_key, compress=True):
+    """
+    Encrypts a chat message using a hybrid RSA-Salsa20 scheme.
+
+    Steps:
+      1. Generate a random 32-byte symmetric key.
+      2. Compress the message if it is long enough to benefit, then encrypt it
+         with Salsa20-Poly1305 using this key (via EncryptionManager).
+      3. Convert the symmetric key to a hex string.
+      4. Encrypt that hex string with the recipient's RSA public key.
+      5. Return a dictionary containing both encrypted parts as hex strings.
+    
+    :param message: The plaintext chat message.
+    :param recipient_public_key: An RSAKey object (public key) for the recipient.
+    :param compress: Whether to try compressing the message first.
+    :return: A dict with keys 'encrypted_sym_key', 'encrypted_message', 'tag'
+             (Poly1305, hex) and 'key_fp' (the recipient key's fingerprint),
+             plus 'compression' when the message was compressed.
+    """
+    # 1. Generate a random symmetric key.
+    msg_sym_key = os.urandom(32)
+    
+    # 2. Encrypt the (possibly compressed) message using Salsa20 with msg_sym_key.
+    enc_manager = EncryptionManager(msg_sym_key)
+    encrypted_message, tag, algorithm = _encrypt_text(enc_manager, message, compress)  # hex strings
+    
+    # 3. Convert the symmetric key to a hex string.
+    sym_key_str = msg_sym_key.hex()
+    
+    # 4. Encrypt the symmetric key using RSA.
+    # Our RSA encrypt function expects a string; it returns an integer.
+    rsa_encrypted_key_int = encrypt(sym_key_str, recipient_public_key)
+    # Convert the integer ciphertext to a hex string.
+    encrypted_sym_key = hex(rsa_encrypted_key_int)[2:]  # strip the "0x"
+    
+    # 5. Return the package.
+    package = {
+        'encrypted_sym_key': encrypted_sym_key,
+        'encrypted_message': encrypted_message,
+        'tag': tag,
+        'key_fp': recipient_public_key.fingerprint
+    }
+    if algorithm:
+        package['compression'] = algorithm
+    return package
+
+def decrypt_chat_message(package, recipient_private_key):
+    """
+    Decrypts a chat message that was encrypted using the hybrid RSA-Salsa20 scheme.
+
+    Steps:
+      1. Check the package's shape and convert the RSA-encrypted symmetric key (hex) to an integer.
+      2. Decrypt it with the recipient's RSA private key to recover the symmetric key (as a hex string).
+      3. Convert the recovered symmetric key to bytes.
+      4. Use the symmetric key with Salsa20 (via EncryptionManager) to check the Poly1305 tag, then
+         decrypt the encrypted message and decompress it if the package says it was compressed.
+
+    Malformed, unaddressed or forged packages raise PackageRejected: the
+    header checks run before the RSA operation, the tag check before the
+    Salsa20 pass.
+    
+    :param package: A dict with keys 'encrypted_sym_key' and 'encrypted_message' (and optionally
+                    'tag', 'key_fp' and 'compression').
+    :param recipient_private_key: An RSAKey object (private key) for the recipient, or the
+                                  recipient's Keyring to pick the key named by 'key_fp'.
+    :return: The decrypted plaintext message.
+    """
+    # 1. Validate the header and convert the encrypted symmetric key from hex to integer.
+    private_key = _private_key_for(package, recipient_private_key)
+    rsa_encrypted_key_int = check_package(package, private_key)
+    
+    # 2. Decrypt the symmetric key using RSA (it returns a hex string).
+    # 3. Convert the hex string to bytes.
+    try:
+        msg_sym_key = bytes.fromhex(decrypt(rsa_encrypted_key_int, private_key))
+    except ValueError:
+        msg_sym_key = b''
+    if len(msg_sym_key) != 32:
+        raise PackageRejected('bad_key', "Encrypted key does not unwrap to a message key")
+    
+    # 4. Use this symmetric key to authenticate and decrypt the message.
+    enc_manager = EncryptionManager(msg_sym_key)
+    decrypted_message = _decrypt_text(enc_manager, package)
+    
+    return decrypted_message
+
+def encrypt_group_message(message, member_public_keys, compress=True):
+    """
+    Encrypts a chat message once for a whole group.
+
+    The message is encrypted a single time with Salsa20 under a random 32-byte
+    key; only that key is RSA-encrypted for each member. Sending to N members
+    therefore costs one symmetric pass plus N small RSA operations.
+
+    :param message: The plaintext chat message.
+    :param member_public_keys: A dict mapping member usernames to RSAKey objects (public keys).
+    :return: A dict with keys 'encrypted_sym_keys' (member -> hex), 'key_fps'
+             (member -> key fingerprint), 'encrypted_message' and 'tag'.
+    """
+    msg_sym_key = os.urandom(32)
+    enc_manager = EncryptionManager(msg_sym_key)
+    encrypted_message, tag, algorithm = _encrypt_text(enc_manager, message, compress)
+
+    sym_key_str = msg_sym_key.hex()
+    encrypted_sym_keys = {}
+    key_fps = {}
+    for member, public_key in member_public_keys.items():
+        encrypted_sym_keys[member] = hex(encrypt(sym_key_str, public_key))[2:]
+        key_fps[member] = public_key.fingerprint
+
+    package = {
+        'encrypted_sym_keys': encrypted_sym_keys,
+        'key_fps': key_fps,
+        'encrypted_message': encrypted_message,
+        'tag': tag
+    }
+    if algorithm:
+        package['compression'] = algorithm
+    return package
+
+def decrypt_group_message(package, member, member_private_key):
+    """
+    Decrypts a group message produced by encrypt_group_message.
+
+    :param package: A dict with keys 'encrypted_sym_keys' and 'encrypted_message'.
+    :param member: The username whose wrapped key should be used.
+    :param member_private_key: An RSAKey object (private key) for that member, or their Keyring.
+    :return: The decrypted plaintext message.
+    """
+    single = {key: value for key, value in package.items() if key not in ('encrypted_sym_keys', 'key_fps')}
+    single['encrypted_sym_key'] = package['encrypted_sym_keys'][member]
+    if member in package.get('key_fps', {}):
+        single['key_fp'] = package['key_fps'][member]
+    return decrypt_chat_message(single, member_private_key)
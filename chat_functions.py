@@ -1,125 +1,273 @@
-import json
-from database import update_chat_history
-from imports import *
-# Import our hybrid encryption routines from chat_encryption.py
-from chat_encryption import encrypt_chat_message, decrypt_chat_message
-
-class ChatFunctions:
-    def send_message(self):
-        # Get the selected contact's name.
-        selected_contact_name = self.contact_list_widget.currentItem().text()
-        message_text = self.chat_input_widget.text().strip()
-        
-        if message_text != "":
-            # Retrieve the recipient's RSA public key.
-            if selected_contact_name not in self.contact_keys:
-                QMessageBox.warning(self, "Encryption Error", "Recipient's public key not available.")
-                print("DEBUG: No public key for contact:", selected_contact_name)
-                return
-            recipient_public_key = self.contact_keys[selected_contact_name]
-            
-            # Encrypt the message using the hybrid RSA–Salsa20 scheme.
-            # This returns a package (a dict) containing the RSA-encrypted symmetric key
-            # and the Salsa20-encrypted message.
-            try:
-                package = encrypt_chat_message(message_text, recipient_public_key)
-            except Exception as ex:
-                QMessageBox.warning(self, "Encryption Error", f"Failed to encrypt message: {ex}")
-                print("DEBUG: Encryption failed:", ex)
-                return           
-            # Convert the package to a JSON string for transmission.
-            encrypted_message_str = json.dumps(package)
-            print("DEBUG: Outgoing package:", encrypted_message_str)
-            
-            # Append the encrypted message (as a JSON string) to the chat history.
-            self.chat_history[selected_contact_name].append(f"{self.username}: {encrypted_message_str}")
-            self.display_chat_history(selected_contact_name)
-            self.chat_input_widget.clear()
-            
-            # Update the chat history in the database.
-            update_chat_history(
-                self.username,
-                selected_contact_name,
-                "\n".join(self.chat_history[selected_contact_name])
-            )
-            self.socketio.emit(
-                'message',
-                {
-                    'text': f"{self.username}: {encrypted_message_str}",
-                    'recipient': selected_contact_name,
-                    'sender': self.username
-                },
-                namespace='/chat'
-            )
-            print("DEBUG: Message emitted to server.")
-
-    def receive_message(self, data):
-        """
-        Expected data format: "sender: encrypted_message_str"
-        where encrypted_message_str is a JSON string representing the encryption package.
-        """
-        print("DEBUG: Raw received data:", data)
-        try:
-            sender, encrypted_message_str = data.split(": ", 1)
-        except Exception as ex:
-            QMessageBox.warning(None, "Decryption Error", f"Message format error: {ex}")
-            self.chat_history.setdefault("Unknown", []).append(data)
-            self.update_gui_signal.emit("Unknown")
-            return
-
-        # Attempt to parse the encrypted message package.
-        try:
-            package = json.loads(encrypted_message_str)
-            print("DEBUG: Parsed package:", package)
-        except Exception as e:
-            QMessageBox.warning(None, "Decryption Error", f"Failed to parse encrypted message: {e}")
-            return
-
-        # Decrypt the message using our hybrid decryption routine and our RSA private key.
-        try:
-            decrypted_message = decrypt_chat_message(package, self.rsa_private_key)
-            print("DEBUG: Decrypted message:", decrypted_message)
-        except Exception as e:
-            QMessageBox.warning(None, "Decryption Error", f"Failed to decrypt message: {e}")
-            return
-        
-        # Update the chat history for the sender.
-        if sender not in self.chat_history:
-            self.chat_history[sender] = []
-        self.chat_history[sender].append(f"{sender}: {decrypted_message}")
-        self.update_gui_signal.emit(sender)
-
-    def show_conversation(self):
-        selected_item = self.contact_list_widget.currentItem()
-        if selected_item is None:
-            return
-
-        selected_contact_name = selected_item.text()
-        if selected_contact_name in self.chat_history:
-            chat_contact_name_label = self.chat_header_widget.findChild(QLabel)
-            chat_contact_name_label.setText(selected_contact_name)
-            self.display_chat_history(selected_contact_name)
-            self.stacked_widget.setCurrentWidget(self.chat_widget)
-
-    def display_chat_history(self, contact_name):
-        self.chat_history_widget.clear()
-        chat_history = self.chat_history[contact_name]
-        for message in chat_history:
-            if message.startswith("File Sent: "):
-                file_path = message.replace("File Sent: ", "")
-                self.chat_history_widget.append(f'<a href="file:{file_path}">{file_path}</a>')
-            else:
-                parts = message.split(": ", 1)
-                if len(parts) == 2:
-                    sender, text = parts
-                    try:
-                        # Try to parse the text as a JSON package and decrypt it.
-                        package = json.loads(text)
-                        decrypted_message = decrypt_chat_message(package, self.rsa_private_key)
-                        formatted_message = f"<b>{sender}</b>: {decrypted_message}"
-                    except Exception:
-                        formatted_message = message
-                else:
-                    formatted_message = message
-                self.chat_history_widget.append(formatted_message)
-            self.chat_history_widget.append("")
+from imports import *
+# The headless chat logic (hybrid RSA-Salsa20 encryption, keys, history)
+from chat_client import ChatClientError
+from file_transfer import FileSender, FileReceiver
+from profiling import stage
+
+class ChatFunctions:
+    """
+    Qt view logic for sending and receiving chat messages. The encryption,
+    key and history handling lives in self.session (a chat_client.ChatSession).
+    """
+    def send_message(self):
+        # Get the selected contact's name.
+        selected_contact_name = self.current_contact()
+        message_text = self.chat_input_widget.text().strip()
+        
+        if selected_contact_name is not None and message_text != "":
+            with stage("send"):
+                # Encrypt the message, record it in the history and build the event to emit.
+                try:
+                    event, payload = self.session.prepare_message(selected_contact_name, message_text)
+                except ChatClientError as ex:
+                    QMessageBox.warning(self, "Encryption Error", str(ex))
+                    print("DEBUG: Could not send message to", selected_contact_name, "-", ex)
+                    return
+                self.session.save()
+                print("DEBUG: Outgoing payload:", payload)
+
+                self.display_chat_history(selected_contact_name)
+                self.contacts.update(selected_contact_name)
+                self.chat_input_widget.clear()
+                self.outgoing.send(event, payload)
+                print("DEBUG: Message queued for the server.")
+
+    def send_file(self):
+        recipient = self.current_contact()
+        if recipient is None:
+            return
+        if recipient not in self.contact_keys:
+            QMessageBox.warning(self, "Encryption Error", "Recipient's public key not available.")
+            return
+        file_path, _ = QFileDialog.getOpenFileName(self, "Send File")
+        if not file_path:
+            return
+
+        sender = FileSender(file_path, recipient, self.contact_keys[recipient])
+        self.outgoing_files[sender.transfer_id] = sender
+        self.socketio.emit('file_offer', sender.offer(self.username), namespace='/chat')
+        print("DEBUG: Offered file", file_path, "to", recipient, "as transfer", sender.transfer_id)
+
+    def resume_file_transfers(self):
+        """
+        After a reconnect, offers unfinished outgoing transfers again and asks
+        the senders of unfinished incoming ones to do the same.
+        """
+        for sender in self.outgoing_files.values():
+            self.socketio.emit('file_offer', sender.offer(self.username), namespace='/chat')
+        for receiver in self.incoming_files.values():
+            self.socketio.emit('file_resume', {'transfer_id': receiver.transfer_id, 'sender': receiver.sender}, namespace='/chat')
+
+    def handle_file_resume(self, data):
+        # The recipient reconnected; offer the transfer again so it continues
+        sender = self.outgoing_files.get(data.get('transfer_id'))
+        if sender is not None and sender.recipient == data.get('recipient'):
+            self.socketio.emit('file_offer', sender.offer(self.username), namespace='/chat')
+
+    def pump_file(self, sender):
+        """Sends as many chunks as the flow-control window allows."""
+        for index, data in sender.next_chunks():
+            self.socketio.emit(
+                'file_chunk',
+                {'transfer_id': sender.transfer_id, 'index': index, 'data': data},
+                namespace='/chat'
+            )
+
+    def handle_file_accept(self, data):
+        sender = self.outgoing_files.get(data['transfer_id'])
+        if sender is None:
+            return
+        sender.resume(data['next_index'])
+        print("DEBUG: Sending transfer", sender.transfer_id, "from chunk", data['next_index'])
+        self.handle_file_ack({'transfer_id': sender.transfer_id, 'index': data['next_index'] - 1})
+
+    def handle_file_ack(self, data):
+        sender = self.outgoing_files.get(data['transfer_id'])
+        if sender is None:
+            return
+        sender.ack(data['index'])
+        if not sender.done:
+            self.pump_file(sender)
+            return
+
+        sender.close()
+        del self.outgoing_files[sender.transfer_id]
+        self.socketio.emit('file_complete', {'transfer_id': sender.transfer_id}, namespace='/chat')
+        self.file_sent_flag = True
+        self.session.history.append(sender.recipient, f"File Sent: {sender.path}")
+        self.session.history.mark(sender.recipient)
+        self.session.save()
+        self.update_gui_signal.emit(sender.recipient)
+
+    def handle_file_error(self, data):
+        sender = self.outgoing_files.pop(data.get('transfer_id'), None)
+        if sender is not None:
+            sender.close()
+        print("DEBUG: File transfer failed:", data)
+
+    def handle_throttled(self, data):
+        """
+        The server refused an event over its limits. What it sent back in
+        'retry' goes out again after 'retry_after' seconds; a transfer with a
+        throttled chunk resumes after its last acked chunk.
+        """
+        delay = data.get('retry_after', 0)
+        if data.get('event') == 'file_chunk' and 'transfer_id' in data:
+            sender = self.outgoing_files.get(data['transfer_id'])
+            if sender is not None:
+                sender.resume(sender.acked)
+                self.outgoing.after(delay, self.gui_call_signal.emit, self.pump_file, (sender,))
+            return
+        if not data.get('retry'):
+            print("DEBUG: Server refused", data.get('event'), "-", data.get('reason'))
+            return
+        print("DEBUG: Server throttled", len(data['retry']), data.get('event'), "events, retrying in", delay, "s")
+        self.outgoing.retry(data['event'], data['retry'], delay)
+
+    def handle_file_offer(self, data):
+        receiver = self.incoming_files.get(data['transfer_id'])
+        if receiver is None:
+            try:
+                receiver = FileReceiver(data, self.session.keyring)
+            except Exception as ex:
+                print("DEBUG: Rejected file offer:", ex)
+                return
+            self.incoming_files[receiver.transfer_id] = receiver
+        self.socketio.emit(
+            'file_accept',
+            {'transfer_id': receiver.transfer_id, 'next_index': receiver.next_index},
+            namespace='/chat'
+        )
+        if receiver.done:
+            # An empty file has no chunks to wait for
+            self.finish_incoming_file(receiver)
+
+    def handle_file_chunk(self, data):
+        receiver = self.incoming_files.get(data['transfer_id'])
+        if receiver is None:
+            return
+        try:
+            last_index = receiver.write_chunk(data['index'], data['data'])
+        except ValueError as ex:
+            print("DEBUG: Dropped file chunk:", ex)
+            return
+        self.socketio.emit('file_ack', {'transfer_id': receiver.transfer_id, 'index': last_index}, namespace='/chat')
+        if receiver.done:
+            self.finish_incoming_file(receiver)
+
+    def finish_incoming_file(self, receiver):
+        receiver.close()
+        del self.incoming_files[receiver.transfer_id]
+        self.session.history.append(receiver.sender, f"File Received: {receiver.path}")
+        self.session.history.mark(receiver.sender)
+        self.session.save()
+        self.update_gui_signal.emit(receiver.sender)
+
+    def decrypt_package(self, package):
+        return self.session.decrypt_package(package)
+
+    def receive_message(self, envelope):
+        """
+        Handles a sequenced delivery (see delivery.DeliveryWindow). The
+        envelopes it releases, in order, are passed to deliver.
+        """
+        with stage("receive"):
+            self.deliver(self.accept_envelope(envelope))
+            self.outgoing.schedule_ack()
+
+    def accept_envelope(self, envelope):
+        """Passes a delivery through the sequencer; returns the envelopes it releases."""
+        with stage("receive.sequence"):
+            envelopes, resend = self.inbound.accept(envelope)
+        if resend is not None:
+            self.socketio.emit('resend', resend, namespace='/chat')
+        return envelopes
+
+    def deliver(self, envelopes):
+        """Receives the released envelopes and saves the history once for all of them."""
+        for envelope in envelopes:
+            entries, needs_sync = self.session.accept_delivery(envelope)
+            for text, log_id in entries:
+                self.receive_text(text, log_id)
+            if needs_sync:
+                self.request_sync()
+        self.session.save()
+
+    def request_sync(self, data=None):
+        """Asks the server for the message log entries this device is missing."""
+        self.socketio.emit('sync', self.session.log.request(), namespace='/chat')
+
+    def receive_sync_page(self, page):
+        entries, more = self.session.log.apply_page(page)
+        for text, log_id in entries:
+            self.receive_text(text, log_id)
+        self.session.save()
+        if more:
+            self.request_sync()
+
+    def receive_message_batch(self, data):
+        """data is a list of envelopes, each in the format receive_message expects."""
+        with stage("receive"):
+            self.deliver([released for envelope in data for released in self.accept_envelope(envelope)])
+            self.outgoing.schedule_ack()
+
+    def receive_delivery_state(self, data):
+        # Sent when we register: deliver what it releases, then catch up on history
+        self.deliver(self.inbound.sync(data))
+        self.request_sync()
+
+    def receive_seq_reset(self, data):
+        self.deliver(self.inbound.reset(data))
+        self.outgoing.schedule_ack()
+
+    def receive_text(self, data, log_id=None):
+        """
+        Expected data format: "sender: encrypted_message_str"
+        where encrypted_message_str is a JSON string representing the encryption package.
+        A package that is refused is logged and shown in the status bar; this
+        runs on the socket thread, which must not open dialogs.
+        """
+        print("DEBUG: Raw received data:", data)
+        try:
+            conversation, sender, decrypted_message = self.session.receive(data, log_id)
+            print("DEBUG: Decrypted message from", sender)
+        except ChatClientError as ex:
+            print("DEBUG: Rejected incoming message:", ex)
+            self.message_rejected_signal.emit(str(ex))
+            if ex.conversation:
+                self.update_gui_signal.emit(ex.conversation)
+            return
+        self.update_gui_signal.emit(conversation)
+
+    def search_messages(self):
+        query = self.search_input_widget.text().strip()
+        if query == "" or self.search_index is None:
+            return
+        results = self.search_index.search(query)
+        if not results:
+            QMessageBox.information(self, "Search", "No messages found.")
+            return
+        labels = [f"{contact}: {text}" for contact, _, text in results]
+        choice, ok = QInputDialog.getItem(self, "Search Results", f"Messages matching '{query}':", labels, 0, False)
+        if not ok:
+            return
+        contact = results[labels.index(choice)][0]
+        self.select_contact(contact)
+
+    def show_conversation(self):
+        selected_contact_name = self.current_contact()
+        if selected_contact_name is None:
+            return
+
+        if selected_contact_name in self.chat_history:
+            chat_contact_name_label = self.chat_header_widget.findChild(QLabel)
+            chat_contact_name_label.setText(selected_contact_name)
+            self.display_chat_history(selected_contact_name)
+            self.stacked_widget.setCurrentWidget(self.chat_widget)
+            self.session.summaries.mark_read(selected_contact_name)
+            self.contacts.update(selected_contact_name)
+
+    def display_chat_history(self, contact_name):
+        # The transcript view only decrypts and paints the rows that are visible.
+        with stage("render"):
+            self.chat_history_widget.show_history(contact_name, self.chat_history[contact_name])
@@ -0,0 +1,177 @@
+# chat_view.py
+"""
+Virtualized chat transcript: a list model over one conversation's history.
+
+Only the rows the view paints are parsed and decrypted, and formatted rows
+are kept in a bounded LRU cache, so memory and repaint cost do not grow with
+the length of the conversation. Rows have a fixed height, which lets the
+view place a million rows without asking for each row's size; long messages
+are elided and shown in full as a tooltip.
+
+The view is a single-column QTableView rather than a QListView: QListView
+lays out every item even with uniform item sizes (about a second per
+million rows, again on every append), while a table with fixed-size rows
+computes positions arithmetically.
+"""
+import json
+from collections import OrderedDict
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QSize, QUrl
+from PyQt5.QtGui import QDesktopServices, QFont, QFontMetrics, QColor
+from PyQt5.QtWidgets import QTableView, QHeaderView, QStyledItemDelegate, QStyle, QAbstractItemView
+
+TRANSCRIPT_CACHE_ROWS = 512   # formatted rows kept in memory
+ROW_PADDING = 6
+
+SenderRole = Qt.UserRole + 1
+FileRole = Qt.UserRole + 2    # local path for "File Sent" / "File Received" rows
+
+
+def format_entry(entry, decrypt):
+    """
+    Splits a history entry ("sender: text", where text may be an encrypted
+    package) into (sender, text, file_path), decrypting the package if we can.
+    """
+    if entry.startswith(("File Sent: ", "File Received: ")):
+        label, file_path = entry.split(": ", 1)
+        return label, file_path, file_path
+    parts = entry.split(": ", 1)
+    if len(parts) != 2:
+        return "", entry, None
+    sender, text = parts
+    if text.startswith("{"):
+        try:
+            text = decrypt(json.loads(text))
+        except Exception:
+            # Our own 1:1 messages are encrypted for the recipient: show them as stored
+            pass
+    return sender, text, None
+
+
+class TranscriptModel(QAbstractListModel):
+    """
+    Rows of one conversation, read from its HistoryStore list (which is not
+    copied). `decrypt` takes a package dict and returns the plaintext.
+    """
+    def __init__(self, decrypt, cache_rows=TRANSCRIPT_CACHE_ROWS, parent=None):
+        super().__init__(parent)
+        self.decrypt = decrypt
+        self.cache_rows = cache_rows
+        self.conversation = None
+        self.messages = []
+        self.count = 0               # rows announced to the view
+        self.rows = OrderedDict()    # row -> (sender, text, file_path), least recently used first
+
+    def show(self, conversation, messages):
+        """
+        Shows `messages`, the history list of `conversation`. Calling it again
+        for the same list after messages were appended only inserts the new rows.
+        """
+        if conversation == self.conversation and messages is self.messages and len(messages) >= self.count:
+            if len(messages) > self.count:
+                self.beginInsertRows(QModelIndex(), self.count, len(messages) - 1)
+                self.count = len(messages)
+                self.endInsertRows()
+            return
+        self.beginResetModel()
+        self.conversation = conversation
+        self.messages = messages
+        self.count = len(messages)
+        self.rows.clear()
+        self.endResetModel()
+
+    def clear(self):
+        self.show(None, [])
+
+    def row(self, row):
+        formatted = self.rows.get(row)
+        if formatted is not None:
+            self.rows.move_to_end(row)
+            return formatted
+        formatted = self.rows[row] = format_entry(self.messages[row], self.decrypt)
+        if len(self.rows) > self.cache_rows:
+            self.rows.popitem(last=False)
+        return formatted
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.count
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self.count:
+            return None
+        if role not in (Qt.DisplayRole, Qt.ToolTipRole, SenderRole, FileRole):
+            return None
+        sender, text, file_path = self.row(index.row())
+        if role == Qt.DisplayRole:
+            return f"{sender}: {text}" if sender else text
+        if role == Qt.ToolTipRole:
+            return text
+        if role == SenderRole:
+            return sender
+        return file_path
+
+
+class TranscriptDelegate(QStyledItemDelegate):
+    """Paints a row as a bold sender followed by the message, elided to one line."""
+    def paint(self, painter, option, index):
+        painter.save()
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+        rect = option.rect.adjusted(ROW_PADDING, 0, -ROW_PADDING, 0)
+        sender = index.data(SenderRole)
+        if sender:
+            bold = QFont(option.font)
+            bold.setBold(True)
+            label = sender + ": "
+            painter.setFont(bold)
+            painter.drawText(rect, Qt.AlignLeft | Qt.AlignVCenter, label)
+            rect.setLeft(rect.left() + QFontMetrics(bold).horizontalAdvance(label))
+        painter.setFont(option.font)
+        if index.data(FileRole):
+            painter.setPen(QColor("#0645AD"))
+        text = index.data(Qt.ToolTipRole).replace("\n", " ")
+        painter.drawText(rect, Qt.AlignLeft | Qt.AlignVCenter,
+                         QFontMetrics(option.font).elidedText(text, Qt.ElideRight, rect.width()))
+        painter.restore()
+
+    def sizeHint(self, option, index):
+        return QSize(0, row_height(option.font))
+
+
+def row_height(font):
+    return QFontMetrics(font).height() + 2 * ROW_PADDING
+
+
+class TranscriptView(QTableView):
+    """The chat history widget. Activating a file row opens the file."""
+    def __init__(self, decrypt, parent=None):
+        super().__init__(parent)
+        self.transcript = TranscriptModel(decrypt, parent=self)
+        self.setModel(self.transcript)
+        self.setItemDelegate(TranscriptDelegate(self))
+        self.horizontalHeader().hide()
+        self.horizontalHeader().setStretchLastSection(True)
+        self.verticalHeader().hide()
+        self.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.verticalHeader().setDefaultSectionSize(row_height(self.font()))
+        self.setShowGrid(False)
+        self.setWordWrap(False)
+        self.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.activated.connect(self.open_file)
+
+    def show_history(self, conversation, messages):
+        """Shows a conversation, following new messages if the view was at the bottom."""
+        scrollbar = self.verticalScrollBar()
+        follow = conversation != self.transcript.conversation or scrollbar.value() == scrollbar.maximum()
+        self.transcript.show(conversation, messages)
+        if follow:
+            self.scrollToBottom()
+
+    def clear(self):
+        self.transcript.clear()
+
+    def open_file(self, index):
+        file_path = index.data(FileRole)
+        if file_path:
+            QDesktopServices.openUrl(QUrl.fromLocalFile(file_path))
@@ -0,0 +1,96 @@
+# compression.py
+"""
+Optional compression stage applied to chat plaintext before encryption.
+
+Messages shorter than COMPRESSION_THRESHOLD are left alone, and so is any
+message that would not get smaller. zlib is the default because every
+client can inflate it; zstd (from the `zstandard` package) can be chosen
+with CHAT_COMPRESSION=zstd once all clients have it installed. Both are
+primed with a small shared dictionary of common chat text so that short
+messages compress too.
+"""
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_THRESHOLD = 64             # bytes; shorter messages skip compression
+MAX_DECOMPRESSED_SIZE = 1024 * 1024    # refuse to inflate beyond this
+
+# Shared dictionary: phrases and fragments that show up in typical chat text.
+# Changing it breaks decompression of existing messages, so only ever append
+# under a new algorithm name.
+CHAT_DICTIONARY = (
+    b"hello hi hey thanks thank you please sorry okay ok yes no maybe "
+    b"good morning good night see you later talk to you soon how are you "
+    b"what are you doing where are you i am going to the meeting tomorrow today "
+    b"tonight this weekend let me know can you send me the file did you get my message "
+    b"haha lol :) :( :D I don't know I think that would be great sounds good "
+    b"Traceback (most recent call last):\n  File \"\", line , in \nError: Exception "
+    b"def return import from class self if else for while None True False print( "
+    b"https://www. .com .org http:// "
+)
+
+ALGORITHMS = ['zlib', 'zstd'] if zstandard is not None else ['zlib']
+DEFAULT_ALGORITHM = os.environ.get('CHAT_COMPRESSION', 'zlib')
+if DEFAULT_ALGORITHM not in ALGORITHMS:
+    DEFAULT_ALGORITHM = 'zlib'
+
+
+def _zlib_compress(data):
+    compressor = zlib.compressobj(level=6, zdict=CHAT_DICTIONARY)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _zlib_decompress(payload):
+    decompressor = zlib.decompressobj(zdict=CHAT_DICTIONARY)
+    data = decompressor.decompress(payload, MAX_DECOMPRESSED_SIZE)
+    if decompressor.unconsumed_tail:
+        raise ValueError("Decompressed message too large")
+    return data
+
+
+if zstandard is not None:
+    _zstd_dict = zstandard.ZstdCompressionDict(CHAT_DICTIONARY, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+    _zstd_compressor = zstandard.ZstdCompressor(level=3, dict_data=_zstd_dict)
+    _zstd_decompressor = zstandard.ZstdDecompressor(dict_data=_zstd_dict)
+
+
+def _zstd_compress(data):
+    return _zstd_compressor.compress(data)
+
+
+def _zstd_decompress(payload):
+    if zstandard.frame_content_size(payload) > MAX_DECOMPRESSED_SIZE:
+        raise ValueError("Decompressed message too large")
+    return _zstd_decompressor.decompress(payload, max_output_size=MAX_DECOMPRESSED_SIZE)
+
+
+_COMPRESSORS = {'zlib': _zlib_compress, 'zstd': _zstd_compress}
+_DECOMPRESSORS = {'zlib': _zlib_decompress, 'zstd': _zstd_decompress}
+
+
+def compress(data, algorithm=None):
+    """
+    Compresses `data` (bytes) if it is worth it.
+    :return: (algorithm name or None, payload bytes)
+    """
+    if len(data) < COMPRESSION_THRESHOLD:
+        return None, data
+    algorithm = algorithm or DEFAULT_ALGORITHM
+    compressed = _COMPRESSORS[algorithm](data)
+    if len(compressed) >= len(data):
+        return None, data
+    return algorithm, compressed
+
+
+def decompress(algorithm, payload):
+    """Reverses compress(). `algorithm` is the name from the package header (or None)."""
+    if algorithm is None:
+        return payload
+    if algorithm not in ALGORITHMS:
+        raise ValueError("Unsupported compression: " + str(algorithm))
+    return _DECOMPRESSORS[algorithm](payload)
@@ -1,82 +1,171 @@
-from database import add_contact, get_contacts, update_chat_history
-import sqlite3
-from PyQt5.QtWidgets import QInputDialog, QMessageBox, QListWidgetItem
-from imports import *
-
-from custom_rsa import RSAKey
-
-class ContactFunctions:
-    def add_contact(self):
-        # Ask for the new contact's username.
-        new_contact_name, ok = QInputDialog.getText(self, "Add Contact", "Enter the name of the new contact:")
-        if ok and new_contact_name != "":
-            # Check if the contact exists in the users table.
-            conn = sqlite3.connect('database.db')
-            cursor = conn.cursor()
-            cursor.execute("SELECT rsa_public FROM users WHERE username = ?", (new_contact_name,))
-            result = cursor.fetchone()
-            conn.close()
-            if result is None:
-                QMessageBox.warning(self, "Error", "User does not exist.")
-                return
-            elif new_contact_name in self.chat_history:
-                QMessageBox.warning(self, "Error", "User already exists in your conversation.")
-                return
-            else:
-                # Add the contact to the UI list.
-                item = QListWidgetItem(new_contact_name)
-                self.contact_list_widget.addItem(item)
-                self.chat_history[new_contact_name] = []
-                
-                # Store the contact in the dashboard table (which saves the RSA public key).
-                add_contact(self.username, new_contact_name)
-                
-                # Update in-memory contact_keys.
-                rsa_public_str = result[0]  # expected to be in "n,e" format
-                parts = rsa_public_str.split(",")
-                if len(parts) == 2:
-                    n, e = map(int, parts)
-                    self.contact_keys[new_contact_name] = RSAKey(n, e)
-
-
-    def delete_contact(self):
-        # Get the selected contact's name
-        selected_contact_name = self.contact_list_widget.currentItem().text()
-
-        # Show a confirmation dialog box before deleting the contact
-        reply = QMessageBox.question(
-            self, "Delete Contact", f"Are you sure you want to delete {selected_contact_name}?",
-            QMessageBox.Yes | QMessageBox.No, QMessageBox.No
-        )
-
-        if reply == QMessageBox.Yes:
-            # Remove the contact from the contact list widget
-            selected_item = self.contact_list_widget.currentItem()
-            self.contact_list_widget.takeItem(self.contact_list_widget.row(selected_item))
-
-            # Remove the chat history of the selected contact
-            del self.chat_history[selected_contact_name]
-
-            # Clear the chat history widget
-            self.chat_history_widget.clear()
-
-            # Update the chat header with empty values
-            chat_contact_name_label = self.chat_header_widget.findChild(QLabel)
-            chat_contact_name_label.setText("")
-
-            # Switch to the conversation list if there are no contacts left
-            if self.contact_list_widget.count() == 0:
-                self.stacked_widget.setCurrentWidget(self.conversation_list_widget)
-            else:
-                # Select the first contact in the list
-                self.contact_list_widget.setCurrentRow(0)
-                self.show_conversation()
-
-            # Delete the contact from the database
-            conn = sqlite3.connect('database.db')
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM dashboard WHERE username=? AND contact=?", (self.username, selected_contact_name))
-            conn.commit()
-            conn.close()
-        else:
-            return
+from database import add_contact, get_contacts
+import threading
+from PyQt5.QtWidgets import QInputDialog, QMessageBox
+from imports import *
+from chat_view import format_entry
+
+class ContactFunctions:
+    def current_contact(self):
+        """The selected conversation's name, or None."""
+        return self.contacts.contact(self.contact_list_widget.currentIndex().row())
+
+    def select_contact(self, contact):
+        row = self.contacts.row_of(contact)
+        if row < 0 and contact in self.contacts:
+            # Hidden by the filter
+            self.contact_filter_widget.clear()
+            row = self.contacts.row_of(contact)
+        if row >= 0:
+            self.contact_list_widget.setCurrentIndex(self.contacts.index(row))
+
+    def filter_contacts(self, text):
+        # Keep the open conversation selected if it still matches
+        selected_contact_name = self.current_contact()
+        self.contacts.set_filter(text)
+        row = self.contacts.row_of(selected_contact_name) if selected_contact_name is not None else -1
+        if row >= 0:
+            self.contact_list_widget.setCurrentIndex(self.contacts.index(row))
+
+    def contact_preview(self, contact, preview_id):
+        """The contact list's preview of a conversation's history entry."""
+        messages = self.chat_history.get(contact, [])
+        if preview_id >= len(messages):
+            return ""
+        sender, text, _ = format_entry(messages[preview_id], self.decrypt_package)
+        if text.startswith("{"):
+            text = "Encrypted message"  # our own 1:1 messages are encrypted for the recipient
+        return f"{sender}: {text}" if sender else text
+
+    def add_contact(self):
+        # Ask for the new contact's username.
+        new_contact_name, ok = QInputDialog.getText(self, "Add Contact", "Enter the name of the new contact:")
+        if ok and new_contact_name != "":
+            # Check if the contact exists in the server's key directory.
+            try:
+                keys = self.key_directory.lookup([new_contact_name])
+            except OSError as ex:
+                QMessageBox.warning(self, "Error", f"Could not reach the key directory: {ex}")
+                return
+            if new_contact_name not in keys:
+                QMessageBox.warning(self, "Error", "User does not exist.")
+                return
+            elif new_contact_name in self.chat_history:
+                QMessageBox.warning(self, "Error", "User already exists in your conversation.")
+                return
+            else:
+                # Store the contact in the dashboard table (which saves the RSA public key).
+                key = keys[new_contact_name]  # "n,e" format plus its version
+                self.session.history.add(new_contact_name, key['rsa_public'])
+                
+                # Update in-memory contact_keys.
+                self.contact_keys.add(new_contact_name, key['rsa_public'], key['version'])
+
+                # Add the contact to the UI list.
+                self.contacts.update(new_contact_name)
+
+    def refresh_contact_keys(self):
+        """
+        Revalidates every cached contact key with a single directory request,
+        made on a worker thread; the result comes back through contact_keys_signal.
+        """
+        contacts = [c for c in self.chat_history if c not in self.groups]
+        threading.Thread(target=self.fetch_contact_keys, args=(contacts,), daemon=True).start()
+
+    def fetch_contact_keys(self, contacts):
+        try:
+            keys = self.contact_keys.fetch(self.key_directory, contacts)
+        except (OSError, ValueError) as ex:
+            print("DEBUG: Key directory unavailable, using cached keys -", ex)
+            return
+        self.contact_keys_signal.emit(keys)
+
+    def apply_contact_keys(self, keys):
+        changed = self.contact_keys.apply(keys)
+        print("DEBUG: Contact keys revalidated,", len(changed), "changed")
+        for contact in changed:
+            self.confirm_key_change(contact)
+
+    def confirm_key_change(self, contact):
+        """Asks before replacing a contact's pinned key; until then messages use the old one."""
+        fingerprint = self.contact_keys.changed[contact]['version']
+        answer = QMessageBox.question(
+            self, "Contact Key Changed",
+            f"The public key of {contact} has changed (new fingerprint {fingerprint}).\n\n"
+            f"This happens when {contact} rotates keys, but it can also mean someone "
+            f"is impersonating them. Use the new key?",
+            QMessageBox.Yes | QMessageBox.No, QMessageBox.No
+        )
+        if answer == QMessageBox.Yes:
+            self.contact_keys.accept(contact)
+            print("DEBUG: Accepted the new key of", contact)
+        else:
+            print("DEBUG: Kept the pinned key of", contact)
+
+
+    def create_group(self):
+        # Ask for the group's name and its members (comma separated contacts).
+        group_name, ok = QInputDialog.getText(self, "New Group", "Enter the name of the new group:")
+        if not ok or group_name == "":
+            return
+        if group_name in self.chat_history:
+            QMessageBox.warning(self, "Error", "A conversation with this name already exists.")
+            return
+        members_text, ok = QInputDialog.getText(self, "New Group", "Enter the members (comma separated):")
+        if not ok:
+            return
+        members = [m.strip() for m in members_text.split(",") if m.strip()]
+        unknown = [m for m in members if m not in self.contact_keys]
+        if not members or unknown:
+            QMessageBox.warning(self, "Error", "Group members must be existing contacts.")
+            return
+
+        members.append(self.username)
+        self.groups[group_name] = members
+        # A dashboard row (without a public key) keeps the group's history.
+        self.session.history.add(group_name, "")
+        self.contacts.update(group_name)
+        self.socketio.emit('create_group', {'group': group_name, 'members': members}, namespace='/chat')
+
+    def handle_group_error(self, data):
+        # The server refused the group (its name belongs to a group we are not in).
+        print("DEBUG: Group", data.get('group'), "refused:", data.get('reason'))
+        self.groups.pop(data.get('group'), None)
+
+    def delete_contact(self):
+        # Get the selected contact's name
+        selected_contact_name = self.current_contact()
+        if selected_contact_name is None:
+            return
+
+        # Show a confirmation dialog box before deleting the contact
+        reply = QMessageBox.question(
+            self, "Delete Contact", f"Are you sure you want to delete {selected_contact_name}?",
+            QMessageBox.Yes | QMessageBox.No, QMessageBox.No
+        )
+
+        if reply == QMessageBox.Yes:
+            # Remove the contact from the contact list widget
+            self.contacts.remove(selected_contact_name)
+
+            # Remove the chat history of the selected contact (and its database rows)
+            self.session.history.remove(selected_contact_name)
+            self.session.summaries.remove(selected_contact_name)
+            if self.search_index is not None:
+                self.search_index.remove_contact(selected_contact_name)
+
+            # Clear the chat history widget
+            self.chat_history_widget.clear()
+
+            # Update the chat header with empty values
+            chat_contact_name_label = self.chat_header_widget.findChild(QLabel)
+            chat_contact_name_label.setText("")
+
+            # Switch to the conversation list if there are no contacts left
+            if self.contacts.rowCount() == 0:
+                self.stacked_widget.setCurrentWidget(self.conversation_list_widget)
+            else:
+                # Select the first contact in the list
+                self.contact_list_widget.setCurrentIndex(self.contacts.index(0))
+                self.show_conversation()
+        else:
+            return
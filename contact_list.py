@@ -0,0 +1,234 @@
+# contact_list.py
+"""
+Contact list model: conversations sorted by recency, with unread counts, a
+last-message preview and type-ahead filtering.
+
+Visible rows are kept sorted by (-last_message_at, name) with bisect, so a
+new message moves one row instead of re-sorting the list. The filter is a
+prefix search over a sorted list of lower-cased names (two bisections per
+keystroke plus the matches). Previews are formatted only for the rows the
+view paints, and only again when the conversation's last message changes.
+Like the chat transcript (chat_view.py), the view is a one-column table with
+fixed-height rows, so moving a row does not re-lay out the whole list.
+"""
+import bisect
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QSize
+from PyQt5.QtGui import QFont, QFontMetrics, QColor
+from PyQt5.QtWidgets import QTableView, QHeaderView, QStyledItemDelegate, QStyle, QAbstractItemView
+
+UnreadRole = Qt.UserRole + 1
+PreviewRole = Qt.UserRole + 2
+
+
+class ContactListModel(QAbstractListModel):
+    """
+    `summaries` is the session's ContactSummaries; `preview(contact,
+    preview_id)` returns the text to show for a history entry.
+    """
+    def __init__(self, summaries, preview, parent=None):
+        super().__init__(parent)
+        self.summaries = summaries
+        self.preview = preview
+        self.prefix = ""
+        self.names = []       # sorted (lower-cased name, name): the prefix index
+        self.sort_keys = {}   # contact -> sort key of its current position
+        self.rows = []        # visible contacts, in display order
+        self.keys = []        # sort keys of self.rows
+        self.previews = {}    # contact -> (preview_id, text)
+
+    def _sort_key(self, contact):
+        summary = self.summaries.get(contact)
+        return (-summary.last_message_at if summary is not None else 0.0, contact.lower(), contact)
+
+    def _matches(self, contact):
+        return contact.lower().startswith(self.prefix)
+
+    def _filtered(self):
+        lo = bisect.bisect_left(self.names, (self.prefix,))
+        hi = bisect.bisect_left(self.names, (self.prefix + "\U0010ffff",))
+        return sorted(self.sort_keys[name] for _, name in self.names[lo:hi])
+
+    def load(self, contacts):
+        self.beginResetModel()
+        self.sort_keys = {contact: self._sort_key(contact) for contact in contacts}
+        self.names = sorted((contact.lower(), contact) for contact in self.sort_keys)
+        self.keys = self._filtered()
+        self.rows = [key[2] for key in self.keys]
+        self.previews.clear()
+        self.endResetModel()
+
+    def set_filter(self, text):
+        prefix = text.strip().lower()
+        if prefix == self.prefix:
+            return
+        self.beginResetModel()
+        self.prefix = prefix
+        self.keys = self._filtered()
+        self.rows = [key[2] for key in self.keys]
+        self.endResetModel()
+
+    def __contains__(self, contact):
+        return contact in self.sort_keys
+
+    def update(self, contact):
+        """Adds a contact, or moves it to the position its summary now calls for."""
+        key = self._sort_key(contact)
+        old_key = self.sort_keys.get(contact)
+        self.sort_keys[contact] = key
+        if old_key is None:
+            bisect.insort(self.names, (contact.lower(), contact))
+            if self._matches(contact):
+                row = bisect.bisect_left(self.keys, key)
+                self.beginInsertRows(QModelIndex(), row, row)
+                self.rows.insert(row, contact)
+                self.keys.insert(row, key)
+                self.endInsertRows()
+            return
+        if not self._matches(contact):
+            return
+        old_row = bisect.bisect_left(self.keys, old_key)
+        row = bisect.bisect_left(self.keys, key)
+        if row > old_row:
+            row -= 1  # position once the contact is taken out
+        if row != old_row:
+            self.beginMoveRows(QModelIndex(), old_row, old_row, QModelIndex(), row if row < old_row else row + 1)
+            del self.rows[old_row], self.keys[old_row]
+            self.rows.insert(row, contact)
+            self.keys.insert(row, key)
+            self.endMoveRows()
+        else:
+            self.keys[row] = key
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+
+    def remove(self, contact):
+        key = self.sort_keys.pop(contact, None)
+        if key is None:
+            return
+        self.names.remove((contact.lower(), contact))
+        self.previews.pop(contact, None)
+        if self._matches(contact):
+            row = bisect.bisect_left(self.keys, key)
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.rows[row], self.keys[row]
+            self.endRemoveRows()
+
+    def contact(self, row):
+        return self.rows[row] if 0 <= row < len(self.rows) else None
+
+    def row_of(self, contact):
+        """The contact's row, or -1 if it is not visible."""
+        key = self.sort_keys.get(contact)
+        if key is None:
+            return -1
+        row = bisect.bisect_left(self.keys, key)
+        return row if row < len(self.keys) and self.keys[row] == key else -1
+
+    def _preview(self, contact):
+        summary = self.summaries.get(contact)
+        if summary is None or summary.preview_id is None:
+            return ""
+        cached = self.previews.get(contact)
+        if cached is not None and cached[0] == summary.preview_id:
+            return cached[1]
+        text = self.preview(contact, summary.preview_id)
+        self.previews[contact] = (summary.preview_id, text)
+        return text
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        contact = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            return contact
+        if role == UnreadRole:
+            summary = self.summaries.get(contact)
+            return summary.unread if summary is not None else 0
+        if role == PreviewRole:
+            return self._preview(contact)
+        return None
+
+
+def small_font(font):
+    """The preview font: 60% of `font`, which may be sized in pixels (style sheets) or points."""
+    small = QFont(font)
+    if font.pixelSize() > 0:
+        small.setPixelSize(max(1, round(font.pixelSize() * 0.6)))
+    else:
+        small.setPointSizeF(font.pointSizeF() * 0.6)
+    return small
+
+
+class ContactDelegate(QStyledItemDelegate):
+    """Paints the contact's name, the preview below it and an unread badge."""
+    PADDING = 6
+
+    def paint(self, painter, option, index):
+        painter.save()
+        selected = option.state & QStyle.State_Selected
+        if selected:
+            painter.fillRect(option.rect, QColor("#440099"))
+        rect = option.rect.adjusted(self.PADDING, self.PADDING, -self.PADDING, -self.PADDING)
+        name_font = QFont(option.font)
+        preview_font = small_font(option.font)
+        name_height = QFontMetrics(name_font).height()
+
+        unread = index.data(UnreadRole)
+        if unread:
+            badge = str(unread) if unread < 1000 else "999+"
+            badge_font = QFont(preview_font)
+            badge_font.setBold(True)
+            metrics = QFontMetrics(badge_font)
+            width = max(metrics.horizontalAdvance(badge) + 10, metrics.height())
+            badge_rect = rect.adjusted(rect.width() - width, 0, 0, 0)
+            badge_rect.setHeight(metrics.height())
+            painter.setRenderHint(painter.Antialiasing)
+            painter.setPen(Qt.NoPen)
+            painter.setBrush(QColor("#7360F2"))
+            painter.drawRoundedRect(badge_rect, badge_rect.height() / 2, badge_rect.height() / 2)
+            painter.setPen(QColor("white"))
+            painter.setFont(badge_font)
+            painter.drawText(badge_rect, Qt.AlignCenter, badge)
+            rect.setRight(badge_rect.left() - self.PADDING)
+
+        painter.setPen(QColor("white") if selected else QColor("black"))
+        painter.setFont(name_font)
+        name_rect = rect.adjusted(0, 0, 0, name_height - rect.height())
+        painter.drawText(name_rect, Qt.AlignLeft | Qt.AlignVCenter,
+                         QFontMetrics(name_font).elidedText(index.data(Qt.DisplayRole), Qt.ElideRight, rect.width()))
+
+        painter.setPen(QColor("#DDDDDD") if selected else QColor("#777777"))
+        painter.setFont(preview_font)
+        preview_rect = rect.adjusted(0, name_height, 0, 0)
+        preview = index.data(PreviewRole).replace("\n", " ")
+        painter.drawText(preview_rect, Qt.AlignLeft | Qt.AlignTop,
+                         QFontMetrics(preview_font).elidedText(preview, Qt.ElideRight, rect.width()))
+        painter.restore()
+
+    def sizeHint(self, option, index):
+        preview_font = small_font(option.font)
+        height = QFontMetrics(option.font).height() + QFontMetrics(preview_font).height()
+        return QSize(0, height + 2 * self.PADDING)
+
+
+class ContactListView(QTableView):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setItemDelegate(ContactDelegate(self))
+        self.horizontalHeader().hide()
+        self.horizontalHeader().setStretchLastSection(True)
+        self.verticalHeader().hide()
+        self.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.setShowGrid(False)
+        self.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+
+    def setModel(self, model):
+        super().setModel(model)
+        # Row height follows the font, which the style sheet may have changed
+        height = self.itemDelegate().sizeHint(self.viewOptions(), model.index(0)).height()
+        self.verticalHeader().setDefaultSectionSize(height)
@@ -0,0 +1,104 @@
+# crypto_backends.py
+"""
+Registry of implementations for the two primitives the chat crypto is built on:
+
+  - salsa20: XOR data with the Salsa20 keystream for (key, 8-byte nonce), starting
+             at block `counter` (0 unless a file chunk is resumed mid-stream)
+  - powmod:  modular exponentiation used by custom_rsa
+
+The pure-Python code in this repository is always registered as 'python'.
+Accelerated libraries are registered when they are installed, and the
+fastest available implementation of each primitive is selected at import time.
+Set CHAT_CRYPTO_BACKEND=python to force the pure-Python fallback.
+"""
+import os
+
+# Preferred implementation names for each primitive, fastest first.
+PREFERENCE = {
+    'salsa20': ['pycryptodome', 'python'],
+    'powmod': ['gmpy2', 'python'],
+}
+
+_implementations = {'salsa20': {}, 'powmod': {}}
+_selected = {}
+
+
+def register(kind, name, func):
+    _implementations[kind][name] = func
+
+
+def available(kind):
+    """Returns the names of the registered implementations of a primitive."""
+    return list(_implementations[kind])
+
+
+def implementation(kind, name):
+    return _implementations[kind][name]
+
+
+def select(kind, name=None):
+    """
+    Makes `name` (or the most preferred registered implementation) the one
+    used by salsa20_xor / powmod. Returns the selected name.
+    """
+    if name is None:
+        name = next(n for n in PREFERENCE[kind] if n in _implementations[kind])
+    if name not in _implementations[kind]:
+        raise ValueError(f"No {kind} implementation named {name!r}")
+    _selected[kind] = name
+    return name
+
+
+def selected(kind):
+    return _selected[kind]
+
+
+def salsa20_xor(key, nonce, data, counter=0):
+    return _implementations['salsa20'][_selected['salsa20']](key, nonce, data, counter)
+
+
+def powmod(base, exponent, modulus):
+    return _implementations['powmod'][_selected['powmod']](base, exponent, modulus)
+
+
+# --- pure-Python fallback (always available) ---
+
+def _python_salsa20_xor(key, nonce, data, counter=0):
+    # imported late: encryption imports this module. Large buffers are split across cores.
+    from parallel_salsa20 import salsa20_xor
+    return salsa20_xor(key, nonce, data, counter)
+
+register('salsa20', 'python', _python_salsa20_xor)
+register('powmod', 'python', pow)
+
+# --- optional accelerated libraries ---
+
+try:
+    from Crypto.Cipher import Salsa20 as _pycryptodome_salsa20
+
+    def _pycryptodome_salsa20_xor(key, nonce, data, counter=0):
+        if counter:
+            # pycryptodome's Salsa20 always starts at block 0 and cannot seek
+            return _python_salsa20_xor(key, nonce, data, counter)
+        return _pycryptodome_salsa20.new(key=key, nonce=nonce).encrypt(data)
+
+    register('salsa20', 'pycryptodome', _pycryptodome_salsa20_xor)
+except ImportError:
+    pass
+
+try:
+    import gmpy2 as _gmpy2
+
+    def _gmpy2_powmod(base, exponent, modulus):
+        return int(_gmpy2.powmod(base, exponent, modulus))
+
+    register('powmod', 'gmpy2', _gmpy2_powmod)
+except ImportError:
+    pass
+
+if os.environ.get('CHAT_CRYPTO_BACKEND') == 'python':
+    select('salsa20', 'python')
+    select('powmod', 'python')
+else:
+    select('salsa20')
+    select('powmod')
@@ -1,70 +1,241 @@
-# custom_aes.py
-
-def pad(plaintext):
-    """
-    Apply PKCS7 padding to ensure the plaintext is a multiple of 16 bytes.
-    """
-    padding_len = 16 - (len(plaintext) % 16)
-    return plaintext + chr(padding_len) * padding_len
-
-def unpad(padded_text):
-    """
-    Remove PKCS7 padding.
-    """
-    padding_len = ord(padded_text[-1])
-    return padded_text[:-padding_len]
-
-class AES:
-    """
-    A **very simplified** AES-128 dummy implementation in ECB mode.
-    
-    This example does not implement the full AES algorithm.
-    Instead, for demonstration purposes, it simply XORs each 16-byte block
-    with the key. (Note: This is NOT secure.)
-    """
-    block_size = 16
-
-    def __init__(self, key):
-        if len(key) != 16:
-            raise ValueError("Key must be 16 bytes long for AES-128.")
-        self.key = key
-
-    def encrypt_block(self, block):
-        # For demonstration, simply XOR each byte with the corresponding key byte.
-        return bytes([b ^ self.key[i] for i, b in enumerate(block)])
-
-    def decrypt_block(self, block):
-        # XOR decryption is identical to encryption.
-        return bytes([b ^ self.key[i] for i, b in enumerate(block)])
-
-def aes_encrypt(plaintext, key):
-    """
-    Encrypts a string (plaintext) using our dummy AES in ECB mode.
-    Returns a hex-encoded string.
-    """
-    # Pad the plaintext so its length is a multiple of 16.
-    padded = pad(plaintext)
-    cipher = AES(key)
-    ciphertext = b""
-    # Process each 16-byte block.
-    for i in range(0, len(padded), AES.block_size):
-        block = padded[i:i+AES.block_size].encode('utf-8')
-        encrypted_block = cipher.encrypt_block(block)
-        ciphertext += encrypted_block
-    return ciphertext.hex()
-
-def aes_decrypt(ciphertext_hex, key):
-    """
-    Decrypts a hex-encoded string that was encrypted using aes_encrypt.
-    Returns the plaintext.
-    """
-    ciphertext = bytes.fromhex(ciphertext_hex)
-    cipher = AES(key)
-    decrypted = b""
-    for i in range(0, len(ciphertext), AES.block_size):
-        block = ciphertext[i:i+AES.block_size]
-        decrypted_block = cipher.decrypt_block(block)
-        decrypted += decrypted_block
-    # Convert to string and remove padding.
-    decrypted_text = decrypted.decode('utf-8', errors='ignore')
-    return unpad(decrypted_text)
+# custom_aes.py
+import struct
+
+def pad(plaintext):
+    """
+    Apply PKCS7 padding to ensure the plaintext is a multiple of 16 bytes.
+    Works on both bytes and str.
+    """
+    padding_len = 16 - (len(plaintext) % 16)
+    if isinstance(plaintext, (bytes, bytearray)):
+        return bytes(plaintext) + bytes([padding_len]) * padding_len
+    return plaintext + chr(padding_len) * padding_len
+
+def unpad(padded_text):
+    """
+    Remove PKCS7 padding.
+    """
+    if isinstance(padded_text, (bytes, bytearray)):
+        padding_len = padded_text[-1]
+    else:
+        padding_len = ord(padded_text[-1])
+    return padded_text[:-padding_len]
+
+def _xtime(a):
+    """Multiply by x (i.e. 2) in GF(2^8)."""
+    a <<= 1
+    return a ^ 0x11b if a & 0x100 else a
+
+def _gmul(a, b):
+    """Multiply two elements of GF(2^8)."""
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        a = _xtime(a)
+        b >>= 1
+    return result
+
+def _build_tables():
+    """
+    Builds the S-box, its inverse and the encryption/decryption T-tables.
+    Each T-table entry combines SubBytes, ShiftRows and MixColumns for one
+    byte position, so a full round is 16 lookups and XORs.
+    """
+    sbox = [0] * 256
+    inv_sbox = [0] * 256
+    # Walk the multiplicative group with generator 3 to get inverses cheaply.
+    p = q = 1
+    while True:
+        p = p ^ _xtime(p)           # p *= 3
+        q ^= q << 1                 # q /= 3
+        q ^= q << 2
+        q ^= q << 4
+        q &= 0xff
+        if q & 0x80:
+            q ^= 0x09
+        x = q ^ ((q << 1) | (q >> 7)) ^ ((q << 2) | (q >> 6)) ^ ((q << 3) | (q >> 5)) ^ ((q << 4) | (q >> 4))
+        x = (x ^ 0x63) & 0xff
+        sbox[p] = x
+        inv_sbox[x] = p
+        if p == 1:
+            break
+    sbox[0] = 0x63
+    inv_sbox[0x63] = 0
+
+    te = [[0] * 256 for _ in range(4)]
+    td = [[0] * 256 for _ in range(4)]
+    for i in range(256):
+        s = sbox[i]
+        word = (_gmul(s, 2) << 24) | (s << 16) | (s << 8) | _gmul(s, 3)
+        t = inv_sbox[i]
+        inv_word = (_gmul(t, 14) << 24) | (_gmul(t, 9) << 16) | (_gmul(t, 13) << 8) | _gmul(t, 11)
+        for j in range(4):
+            shift = 8 * j
+            te[j][i] = ((word >> shift) | (word << (32 - shift))) & 0xffffffff
+            td[j][i] = ((inv_word >> shift) | (inv_word << (32 - shift))) & 0xffffffff
+    return sbox, inv_sbox, te, td
+
+SBOX, INV_SBOX, (TE0, TE1, TE2, TE3), (TD0, TD1, TD2, TD3) = _build_tables()
+RCON = [0x01, 0x02, 0x04, 0x08, 0x10, 0x20, 0x40, 0x80, 0x1b, 0x36]
+
+class AES:
+    """
+    AES block cipher (FIPS-197) for 128, 192 and 256-bit keys.
+
+    Rounds are computed with precomputed T-table lookups on 32-bit words.
+    Only single blocks are handled here; see aes_encrypt (ECB) and
+    AESCTRCipher (CTR) for modes of operation.
+    """
+    block_size = 16
+
+    def __init__(self, key):
+        if len(key) not in (16, 24, 32):
+            raise ValueError("Key must be 16, 24 or 32 bytes long.")
+        self.key = key
+        self.rounds = {16: 10, 24: 12, 32: 14}[len(key)]
+        self.enc_keys = self._expand_key(key)
+        self.dec_keys = self._invert_key_schedule(self.enc_keys)
+
+    def _expand_key(self, key):
+        nk = len(key) // 4
+        words = list(struct.unpack('>%dI' % nk, key))
+        for i in range(nk, 4 * (self.rounds + 1)):
+            temp = words[i - 1]
+            if i % nk == 0:
+                temp = ((temp << 8) | (temp >> 24)) & 0xffffffff
+                temp = ((SBOX[temp >> 24] << 24) | (SBOX[(temp >> 16) & 0xff] << 16) |
+                        (SBOX[(temp >> 8) & 0xff] << 8) | SBOX[temp & 0xff])
+                temp ^= RCON[i // nk - 1] << 24
+            elif nk > 6 and i % nk == 4:
+                temp = ((SBOX[temp >> 24] << 24) | (SBOX[(temp >> 16) & 0xff] << 16) |
+                        (SBOX[(temp >> 8) & 0xff] << 8) | SBOX[temp & 0xff])
+            words.append(words[i - nk] ^ temp)
+        return [tuple(words[4 * r:4 * r + 4]) for r in range(self.rounds + 1)]
+
+    def _invert_key_schedule(self, enc_keys):
+        """Round keys for the equivalent inverse cipher (InvMixColumns applied to the middle rounds)."""
+        dec_keys = [enc_keys[self.rounds]]
+        for r in range(self.rounds - 1, 0, -1):
+            dec_keys.append(tuple(
+                TD0[SBOX[w >> 24]] ^ TD1[SBOX[(w >> 16) & 0xff]] ^
+                TD2[SBOX[(w >> 8) & 0xff]] ^ TD3[SBOX[w & 0xff]]
+                for w in enc_keys[r]
+            ))
+        dec_keys.append(enc_keys[0])
+        return dec_keys
+
+    def encrypt_block(self, block):
+        k = self.enc_keys
+        s0, s1, s2, s3 = struct.unpack('>4I', block)
+        s0 ^= k[0][0]; s1 ^= k[0][1]; s2 ^= k[0][2]; s3 ^= k[0][3]
+        for r in range(1, self.rounds):
+            rk = k[r]
+            t0 = TE0[s0 >> 24] ^ TE1[(s1 >> 16) & 0xff] ^ TE2[(s2 >> 8) & 0xff] ^ TE3[s3 & 0xff] ^ rk[0]
+            t1 = TE0[s1 >> 24] ^ TE1[(s2 >> 16) & 0xff] ^ TE2[(s3 >> 8) & 0xff] ^ TE3[s0 & 0xff] ^ rk[1]
+            t2 = TE0[s2 >> 24] ^ TE1[(s3 >> 16) & 0xff] ^ TE2[(s0 >> 8) & 0xff] ^ TE3[s1 & 0xff] ^ rk[2]
+            t3 = TE0[s3 >> 24] ^ TE1[(s0 >> 16) & 0xff] ^ TE2[(s1 >> 8) & 0xff] ^ TE3[s2 & 0xff] ^ rk[3]
+            s0, s1, s2, s3 = t0, t1, t2, t3
+        rk = k[self.rounds]
+        return struct.pack(
+            '>4I',
+            ((SBOX[s0 >> 24] << 24) | (SBOX[(s1 >> 16) & 0xff] << 16) | (SBOX[(s2 >> 8) & 0xff] << 8) | SBOX[s3 & 0xff]) ^ rk[0],
+            ((SBOX[s1 >> 24] << 24) | (SBOX[(s2 >> 16) & 0xff] << 16) | (SBOX[(s3 >> 8) & 0xff] << 8) | SBOX[s0 & 0xff]) ^ rk[1],
+            ((SBOX[s2 >> 24] << 24) | (SBOX[(s3 >> 16) & 0xff] << 16) | (SBOX[(s0 >> 8) & 0xff] << 8) | SBOX[s1 & 0xff]) ^ rk[2],
+            ((SBOX[s3 >> 24] << 24) | (SBOX[(s0 >> 16) & 0xff] << 16) | (SBOX[(s1 >> 8) & 0xff] << 8) | SBOX[s2 & 0xff]) ^ rk[3],
+        )
+
+    def decrypt_block(self, block):
+        k = self.dec_keys
+        s0, s1, s2, s3 = struct.unpack('>4I', block)
+        s0 ^= k[0][0]; s1 ^= k[0][1]; s2 ^= k[0][2]; s3 ^= k[0][3]
+        for r in range(1, self.rounds):
+            rk = k[r]
+            t0 = TD0[s0 >> 24] ^ TD1[(s3 >> 16) & 0xff] ^ TD2[(s2 >> 8) & 0xff] ^ TD3[s1 & 0xff] ^ rk[0]
+            t1 = TD0[s1 >> 24] ^ TD1[(s0 >> 16) & 0xff] ^ TD2[(s3 >> 8) & 0xff] ^ TD3[s2 & 0xff] ^ rk[1]
+            t2 = TD0[s2 >> 24] ^ TD1[(s1 >> 16) & 0xff] ^ TD2[(s0 >> 8) & 0xff] ^ TD3[s3 & 0xff] ^ rk[2]
+            t3 = TD0[s3 >> 24] ^ TD1[(s2 >> 16) & 0xff] ^ TD2[(s1 >> 8) & 0xff] ^ TD3[s0 & 0xff] ^ rk[3]
+            s0, s1, s2, s3 = t0, t1, t2, t3
+        rk = k[self.rounds]
+        return struct.pack(
+            '>4I',
+            ((INV_SBOX[s0 >> 24] << 24) | (INV_SBOX[(s3 >> 16) & 0xff] << 16) | (INV_SBOX[(s2 >> 8) & 0xff] << 8) | INV_SBOX[s1 & 0xff]) ^ rk[0],
+            ((INV_SBOX[s1 >> 24] << 24) | (INV_SBOX[(s0 >> 16) & 0xff] << 16) | (INV_SBOX[(s3 >> 8) & 0xff] << 8) | INV_SBOX[s2 & 0xff]) ^ rk[1],
+            ((INV_SBOX[s2 >> 24] << 24) | (INV_SBOX[(s1 >> 16) & 0xff] << 16) | (INV_SBOX[(s0 >> 8) & 0xff] << 8) | INV_SBOX[s3 & 0xff]) ^ rk[2],
+            ((INV_SBOX[s3 >> 24] << 24) | (INV_SBOX[(s2 >> 16) & 0xff] << 16) | (INV_SBOX[(s1 >> 8) & 0xff] << 8) | INV_SBOX[s0 & 0xff]) ^ rk[3],
+        )
+
+class AESCTRCipher:
+    """
+    AES in counter mode, with the same interface as encryption.Salsa20Cipher.
+
+    The counter block is the 8-byte nonce followed by a 64-bit big-endian
+    block counter. Keystream is produced CTR_BATCH_BLOCKS blocks at a time
+    and XORed into a preallocated output buffer.
+    """
+    CTR_BATCH_BLOCKS = 64
+
+    def __init__(self, key, nonce):
+        """
+        key: 16, 24 or 32 bytes
+        nonce: 8 bytes
+        """
+        if len(nonce) != 8:
+            raise ValueError("Nonce must be 8 bytes long")
+        self.aes = AES(key)
+        self.nonce = nonce
+        self.counter = 0
+
+    def keystream(self, length):
+        nblocks = (length + 15) // 16
+        out = bytearray(nblocks * 16)
+        encrypt_block = self.aes.encrypt_block
+        prefix = self.nonce
+        counter = self.counter
+        for i in range(nblocks):
+            out[16 * i:16 * i + 16] = encrypt_block(prefix + struct.pack('>Q', counter & 0xffffffffffffffff))
+            counter += 1
+        self.counter = counter
+        del out[length:]
+        return bytes(out)
+
+    def encrypt(self, data):
+        out = bytearray(len(data))
+        batch = 16 * self.CTR_BATCH_BLOCKS
+        for offset in range(0, len(data), batch):
+            chunk = data[offset:offset + batch]
+            ks = self.keystream(len(chunk))
+            x = int.from_bytes(chunk, 'little') ^ int.from_bytes(ks, 'little')
+            out[offset:offset + len(chunk)] = x.to_bytes(len(chunk), 'little')
+        return bytes(out)
+
+    def decrypt(self, data):
+        # Decryption is the same as encryption (XOR is reversible)
+        return self.encrypt(data)
+
+def aes_encrypt(plaintext, key):
+    """
+    Encrypts a string (plaintext) using AES in ECB mode.
+    Returns a hex-encoded string.
+    """
+    # Pad the plaintext so its length is a multiple of 16.
+    padded = pad(plaintext.encode('utf-8'))
+    cipher = AES(key)
+    ciphertext = bytearray(len(padded))
+    # Process each 16-byte block.
+    for i in range(0, len(padded), AES.block_size):
+        ciphertext[i:i + AES.block_size] = cipher.encrypt_block(padded[i:i + AES.block_size])
+    return ciphertext.hex()
+
+def aes_decrypt(ciphertext_hex, key):
+    """
+    Decrypts a hex-encoded string that was encrypted using aes_encrypt.
+    Returns the plaintext.
+    """
+    ciphertext = bytes.fromhex(ciphertext_hex)
+    cipher = AES(key)
+    decrypted = bytearray(len(ciphertext))
+    for i in range(0, len(ciphertext), AES.block_size):
+        decrypted[i:i + AES.block_size] = cipher.decrypt_block(ciphertext[i:i + AES.block_size])
+    # Remove padding and convert to string.
+    return unpad(bytes(decrypted)).decode('utf-8', errors='ignore')
@@ -1,138 +1,234 @@
-# custom_rsa.py
-import random
-import math
-
-def is_prime(n, k=5):
-    """Use Miller-Rabin primality test for a better probabilistic prime test."""
-    if n < 2:
-        return False
-    # Check small primes first
-    for p in [2, 3, 5, 7, 11, 13, 17, 19, 23, 29]:
-        if n % p == 0:
-            return n == p
-    # Write n-1 as d * 2^s
-    s = 0
-    d = n - 1
-    while d % 2 == 0:
-        d //= 2
-        s += 1
-    # Witness loop
-    for _ in range(k):
-        a = random.randrange(2, n - 1)
-        x = pow(a, d, n)
-        if x == 1 or x == n - 1:
-            continue
-        for _ in range(s - 1):
-            x = pow(x, 2, n)
-            if x == n - 1:
-                break
-        else:
-            return False
-    return True
-
-def generate_prime_candidate(length):
-    """
-    Generate an odd integer randomly with the given bit length.
-    Ensures the most significant bit is 1 (so the number has the desired length)
-    and the number is odd.
-    """
-    p = random.getrandbits(length)
-    p |= (1 << (length - 1)) | 1
-    return p
-
-def generate_prime_number(length):
-    """Generate a prime number of approximately 'length' bits using Miller-Rabin."""
-    p = generate_prime_candidate(length)
-    while not is_prime(p):
-        p = generate_prime_candidate(length)
-    return p
-
-def egcd(a, b):
-    """Extended Euclidean algorithm.
-    Returns a tuple of (g, x, y) such that a*x + b*y = g = gcd(a, b).
-    """
-    if a == 0:
-        return (b, 0, 1)
-    g, y, x = egcd(b % a, a)
-    return (g, x - (b // a) * y, y)
-
-def modinv(a, m):
-    """Compute the modular inverse of a modulo m.
-    Returns x such that (a * x) % m == 1.
-    Raises an exception if the modular inverse does not exist.
-    """
-    g, x, _ = egcd(a, m)
-    if g != 1:
-        raise Exception("Modular inverse does not exist")
-    return x % m
-
-class RSAKey:
-    """
-    Simple RSA key container.
-    For a public key, only n and e are defined.
-    For a private key, n, e, and d are defined.
-    """
-    def __init__(self, n, e, d=None):
-        self.n = n
-        self.e = e
-        self.d = d
-
-def generate_rsa_keys(bit_length=512):
-    """
-    Generate an RSA key pair.
-    :param bit_length: Total bit length for the modulus n.
-    :return: (private_key, public_key) where keys are RSAKey objects.
-    """
-    # Generate two distinct primes of bit_length/2 each.
-    p = generate_prime_number(bit_length // 2)
-    q = generate_prime_number(bit_length // 2)
-    while q == p:
-        q = generate_prime_number(bit_length // 2)
-        
-    n = p * q
-    phi = (p - 1) * (q - 1)
-    
-    # Use a common public exponent
-    e = 65537  
-    if math.gcd(e, phi) != 1:
-        e = 3
-        while math.gcd(e, phi) != 1:
-            e += 2
-    d = modinv(e, phi)
-    
-    public_key = RSAKey(n, e)
-    private_key = RSAKey(n, e, d)
-    return private_key, public_key
-
-def encrypt(message, key):
-    """
-    Encrypt a message (string) using the RSA public key.
-    Converts the message into an integer and then applies RSA encryption.
-    :param message: The plaintext string to encrypt.
-    :param key: An RSAKey instance (public key).
-    :return: The ciphertext as an integer.
-    """
-    m = int.from_bytes(message.encode('utf-8'), byteorder='big')
-    if m >= key.n:
-        raise ValueError("Message too long for the key size")
-    c = pow(m, key.e, key.n)
-    return c
-
-def decrypt(ciphertext, key):
-    """
-    Decrypt an RSA-encrypted ciphertext (an integer) using the RSA private key.
-    Converts the resulting integer back into a string.
-    :param ciphertext: The ciphertext as an integer.
-    :param key: An RSAKey instance (must include the private exponent d).
-    :return: The decrypted plaintext string.
-    """
-    m = pow(ciphertext, key.d, key.n)
-    message_length = (m.bit_length() + 7) // 8
-    message_bytes = m.to_bytes(message_length, byteorder='big')
-    return message_bytes.decode('utf-8')
-
-if __name__ == "__main__":
-    # For demonstration, generate a 512-bit key pair.
-    private_key, public_key = generate_rsa_keys(bit_length=512)
-    print("Public key (n,e):", f"{public_key.n},{public_key.e}")
-    print("Private key (n,e,d):", f"{private_key.n},{private_key.e},{private_key.d}")
+# custom_rsa.py
+import hashlib
+import random
+import math
+import crypto_backends
+
+# Largest prime count that keeps every prime big enough for the modulus size
+# (smaller primes are easier to find with ECM): {minimum modulus bits: primes}
+MAX_PRIMES = {1024: 3, 4096: 4, 8192: 5}
+
+def is_prime(n, k=5):
+    """Use Miller-Rabin primality test for a better probabilistic prime test."""
+    if n < 2:
+        return False
+    # Check small primes first
+    for p in [2, 3, 5, 7, 11, 13, 17, 19, 23, 29]:
+        if n % p == 0:
+            return n == p
+    # Write n-1 as d * 2^s
+    s = 0
+    d = n - 1
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    # Witness loop
+    for _ in range(k):
+        a = random.randrange(2, n - 1)
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+def generate_prime_candidate(length):
+    """
+    Generate an odd integer randomly with the given bit length.
+    Ensures the most significant bit is 1 (so the number has the desired length)
+    and the number is odd.
+    """
+    p = random.getrandbits(length)
+    p |= (1 << (length - 1)) | 1
+    return p
+
+def generate_prime_number(length):
+    """Generate a prime number of approximately 'length' bits using Miller-Rabin."""
+    p = generate_prime_candidate(length)
+    while not is_prime(p):
+        p = generate_prime_candidate(length)
+    return p
+
+def egcd(a, b):
+    """Extended Euclidean algorithm.
+    Returns a tuple of (g, x, y) such that a*x + b*y = g = gcd(a, b).
+    Iterative, so large operands (CRT coefficients of big keys) cannot
+    exhaust the recursion limit.
+    """
+    x0, y0, x1, y1 = 0, 1, 1, 0
+    while a != 0:
+        q = b // a
+        a, b = b % a, a
+        x0, x1 = x1, x0 - q * x1
+        y0, y1 = y1, y0 - q * y1
+    return (b, x0, y0)
+
+def modinv(a, m):
+    """Compute the modular inverse of a modulo m.
+    Returns x such that (a * x) % m == 1.
+    Raises an exception if the modular inverse does not exist.
+    """
+    g, x, _ = egcd(a, m)
+    if g != 1:
+        raise Exception("Modular inverse does not exist")
+    return x % m
+
+def max_primes(bit_length):
+    """The most primes a modulus of `bit_length` bits may have (2 below 1024 bits)."""
+    allowed = 2
+    for min_bits, primes in sorted(MAX_PRIMES.items()):
+        if bit_length >= min_bits:
+            allowed = primes
+    return allowed
+
+class RSAKey:
+    """
+    Simple RSA key container.
+    For a public key, only n and e are defined.
+    For a private key, n, e, and d are defined. A private key that knows the
+    primes of n (two or more) decrypts with the Chinese Remainder Theorem:
+    one exponentiation per prime, each with a much smaller modulus.
+    """
+    def __init__(self, n, e, d=None, primes=None):
+        self.n = n
+        self.e = e
+        self.d = d
+        self.primes = list(primes) if primes else None
+        self.crt = None  # [(prime, d mod (prime - 1), inverse of the product of earlier primes mod prime)]
+        if d is not None and self.primes:
+            self.crt = []
+            product = 1
+            for r in self.primes:
+                self.crt.append((r, d % (r - 1), modinv(product % r, r) if product > 1 else 1))
+                product *= r
+
+    @property
+    def fingerprint(self):
+        """Short ID of the key pair (the same for its public and private halves)."""
+        return hashlib.sha256(f"{self.n},{self.e}".encode('utf-8')).hexdigest()[:16]
+
+def parse_public_key(rsa_public_str):
+    """Parses a public key stored as "n,e"."""
+    parts = [p.strip() for p in rsa_public_str.split(",")]
+    if len(parts) != 2:
+        raise ValueError("Invalid RSA public key format: " + rsa_public_str)
+    n, e = map(int, parts)
+    return RSAKey(n, e)
+
+def parse_private_key(rsa_private_str):
+    """
+    Parses a private key stored as "n,e,d", or as "n,e,d,p1,p2,..." when the
+    primes are known.
+    """
+    parts = [p.strip() for p in rsa_private_str.split(",")]
+    if len(parts) == 4 or len(parts) < 3:
+        raise ValueError("Invalid RSA private key format: " + rsa_private_str)
+    n, e, d, *primes = map(int, parts)
+    if primes and math.prod(primes) != n:
+        raise ValueError("RSA private key primes do not match the modulus")
+    return RSAKey(n, e, d, primes)
+
+def serialize_public_key(key):
+    return f"{key.n},{key.e}"
+
+def serialize_private_key(key):
+    """The inverse of parse_private_key."""
+    fields = [key.n, key.e, key.d] + (key.primes or [])
+    return ",".join(str(field) for field in fields)
+
+def generate_rsa_keys(bit_length=512, primes=2):
+    """
+    Generate an RSA key pair.
+    :param bit_length: Total bit length for the modulus n.
+    :param primes: Number of primes in n. More primes make key generation and
+                   (CRT) decryption faster; a count above max_primes(bit_length)
+                   falls back to two primes.
+    :return: (private_key, public_key) where keys are RSAKey objects.
+    """
+    if primes < 2:
+        raise ValueError("RSA needs at least two primes")
+    if primes > max_primes(bit_length):
+        print(f"DEBUG: {primes} primes are too many for a {bit_length}-bit key, using 2")
+        primes = 2
+
+    # Generate distinct primes of bit_length/primes bits each (the last one
+    # takes the remaining bits).
+    while True:
+        factors = []
+        for i in range(primes):
+            length = bit_length // primes if i < primes - 1 else bit_length - (bit_length // primes) * (primes - 1)
+            r = generate_prime_number(length)
+            while r in factors:
+                r = generate_prime_number(length)
+            factors.append(r)
+        n = math.prod(factors)
+        # The full bit length, so any key of bit_length // 2 bits wraps (as hex)
+        if n.bit_length() == bit_length:
+            break
+
+    phi = math.prod(r - 1 for r in factors)
+    
+    # Use a common public exponent
+    e = 65537  
+    if math.gcd(e, phi) != 1:
+        e = 3
+        while math.gcd(e, phi) != 1:
+            e += 2
+    d = modinv(e, phi)
+    
+    public_key = RSAKey(n, e)
+    private_key = RSAKey(n, e, d, factors)
+    return private_key, public_key
+
+def encrypt(message, key):
+    """
+    Encrypt a message (string) using the RSA public key.
+    Converts the message into an integer and then applies RSA encryption.
+    :param message: The plaintext string to encrypt.
+    :param key: An RSAKey instance (public key).
+    :return: The ciphertext as an integer.
+    """
+    m = int.from_bytes(message.encode('utf-8'), byteorder='big')
+    if m >= key.n:
+        raise ValueError("Message too long for the key size")
+    c = crypto_backends.powmod(m, key.e, key.n)
+    return c
+
+def decrypt(ciphertext, key):
+    """
+    Decrypt an RSA-encrypted ciphertext (an integer) using the RSA private key.
+    Converts the resulting integer back into a string.
+    :param ciphertext: The ciphertext as an integer.
+    :param key: An RSAKey instance (must include the private exponent d).
+    :return: The decrypted plaintext string.
+    """
+    if key.crt:
+        m = _crt_powmod(ciphertext, key.crt)
+    else:
+        m = crypto_backends.powmod(ciphertext, key.d, key.n)
+    message_length = (m.bit_length() + 7) // 8
+    message_bytes = m.to_bytes(message_length, byteorder='big')
+    return message_bytes.decode('utf-8')
+
+def _crt_powmod(ciphertext, crt):
+    """ciphertext^d mod n from one exponentiation per prime (Garner's recombination)."""
+    m = None
+    product = 1
+    for r, d_r, coefficient in crt:
+        m_r = crypto_backends.powmod(ciphertext % r, d_r, r)
+        if m is None:
+            m = m_r
+        else:
+            m += product * ((m_r - m) * coefficient % r)
+        product *= r
+    return m
+
+if __name__ == "__main__":
+    # For demonstration, generate a 512-bit key pair.
+    private_key, public_key = generate_rsa_keys(bit_length=512)
+    print("Public key (n,e):", serialize_public_key(public_key))
+    print("Private key (n,e,d,primes):", serialize_private_key(private_key))
@@ -1,110 +1,836 @@
-import sqlite3
-
-def create_connection():
-    conn = sqlite3.connect('database.db')
-    return conn
-
-def create_table_if_not_exists():
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS dashboard (
-            username TEXT NOT NULL,
-            contact TEXT NOT NULL,
-            chat_history TEXT NOT NULL,
-            contact_rsa_public TEXT
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-create_table_if_not_exists()
-
-def add_contact(username, contact):
-    conn = create_connection()
-    cursor = conn.cursor()
-    # Retrieve the contact's RSA public key from the users table.
-    cursor.execute("SELECT rsa_public FROM users WHERE username = ?", (contact,))
-    result = cursor.fetchone()
-    rsa_public = result[0] if result is not None else ""
-    cursor.execute("""
-        INSERT INTO dashboard (username, contact, chat_history, contact_rsa_public)
-        VALUES (?, ?, ?, ?)
-    """, (username, contact, "", rsa_public))
-    conn.commit()
-    conn.close()
-
-
-
-def get_contacts(username):
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT contact, chat_history
-        FROM dashboard
-        WHERE username = ?
-    """, (username,))
-    contacts = cursor.fetchall()
-    conn.close()
-    return contacts
-
-def update_chat_history(username, contact, chat_history):
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE dashboard
-        SET chat_history = ?
-        WHERE username = ? AND contact = ?
-    """, (chat_history, username, contact))
-    conn.commit()
-    conn.close()
-
-create_table_if_not_exists()
-
-def create_offline_messages_table():
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS offline_messages (
-            recipient TEXT NOT NULL,
-            sender TEXT NOT NULL,
-            message TEXT NOT NULL
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-create_offline_messages_table()
-
-def add_offline_message(recipient, sender, message):
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO offline_messages (recipient, sender, message)
-        VALUES (?, ?, ?)
-    """, (recipient, sender, message))
-    conn.commit()
-    conn.close()
-
-
-def get_offline_messages(recipient):
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT sender, message
-        FROM offline_messages
-        WHERE recipient = ?
-    """, (recipient,))
-    messages = cursor.fetchall()
-    conn.close()
-    return messages
-
-def delete_offline_messages(recipient):
-    conn = create_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        DELETE FROM offline_messages
-        WHERE recipient = ?
-    """, (recipient,))
-    conn.commit()
-    conn.close()
+import os
+import sqlite3
+import time
+
+DATABASE_PATH = os.environ.get('VIBER_DATABASE_PATH', 'database.db')
+
+# Offline-message store limits
+OFFLINE_MESSAGE_TTL = 7 * 24 * 60 * 60      # seconds a message waits for its recipient
+OFFLINE_MAX_MESSAGES = 1000                 # per recipient
+OFFLINE_MAX_BYTES = 5 * 1024 * 1024         # per recipient
+OFFLINE_OVERFLOW_POLICY = "drop_oldest"     # "drop_oldest" or "reject"
+
+# Message log retention
+MESSAGE_LOG_TTL = 90 * 24 * 60 * 60         # seconds an entry stays available for sync
+MESSAGE_LOG_MAX_MESSAGES = 10000            # newest entries kept per owner
+
+def create_connection():
+    conn = sqlite3.connect(DATABASE_PATH)
+    return conn
+
+def create_table_if_not_exists():
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS dashboard (
+            username TEXT NOT NULL,
+            contact TEXT NOT NULL,
+            chat_history TEXT NOT NULL,
+            contact_rsa_public TEXT,
+            sync_cursor INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # Older databases were created without the history sync cursor.
+    cursor.execute("PRAGMA table_info(dashboard)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if "sync_cursor" not in columns:
+        cursor.execute("ALTER TABLE dashboard ADD COLUMN sync_cursor INTEGER NOT NULL DEFAULT 0")
+    conn.commit()
+    conn.close()
+
+create_table_if_not_exists()
+
+def create_user_keys_table():
+    """
+    Every RSA key version of a user, identified by its fingerprint. The
+    users table keeps the current key; older versions are kept here so
+    archived messages stay readable after a rotation.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_keys (
+            username TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            rsa_public TEXT NOT NULL,
+            rsa_private TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (username, fingerprint)
+        )
+    """)
+    conn.commit()
+    conn.close()
+
+create_user_keys_table()
+
+def add_contact(username, contact, rsa_public=None):
+    """
+    Adds a dashboard row. `rsa_public` is the contact's key as returned by the
+    key directory; without it the key is read from the local users table.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    if rsa_public is None:
+        # Retrieve the contact's RSA public key from the users table.
+        cursor.execute("SELECT rsa_public FROM users WHERE username = ?", (contact,))
+        result = cursor.fetchone()
+        rsa_public = result[0] if result is not None else ""
+    cursor.execute("""
+        INSERT INTO dashboard (username, contact, chat_history, contact_rsa_public)
+        VALUES (?, ?, ?, ?)
+    """, (username, contact, "", rsa_public))
+    conn.commit()
+    conn.close()
+
+
+
+def get_user_keys(username):
+    """Returns (rsa_private, rsa_public) strings for a user, or None."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT rsa_private, rsa_public FROM users WHERE username = ?", (username,))
+    row = cursor.fetchone()
+    conn.close()
+    return row
+
+def get_password_hash(username):
+    """Returns the user's bcrypt password hash, or None (server side)."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT password FROM users WHERE username = ?", (username,))
+    row = cursor.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def get_user_key_versions(username):
+    """Returns (version, fingerprint, rsa_private) for each of a user's keys, oldest first."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT version, fingerprint, rsa_private FROM user_keys WHERE username = ? ORDER BY version",
+        (username,)
+    )
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+def add_user_key(username, fingerprint, rsa_private, rsa_public, current=True):
+    """
+    Stores a new key version and returns its version number. With
+    current=True the key also replaces the one in the users table, which is
+    the key the directory hands out.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM user_keys WHERE username = ?", (username,))
+    version = cursor.fetchone()[0]
+    cursor.execute("""
+        INSERT INTO user_keys (username, fingerprint, version, rsa_public, rsa_private, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (username, fingerprint, version, rsa_public, rsa_private, time.time()))
+    if current:
+        cursor.execute(
+            "UPDATE users SET rsa_private = ?, rsa_public = ? WHERE username = ?",
+            (rsa_private, rsa_public, username)
+        )
+    conn.commit()
+    conn.close()
+    return version
+
+def get_contact_public_keys(username):
+    """Returns (contact, contact_rsa_public) for every contact of a user."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT contact, contact_rsa_public
+        FROM dashboard
+        WHERE username = ?
+    """, (username,))
+    keys = cursor.fetchall()
+    conn.close()
+    return keys
+
+def update_contact_keys(username, keys):
+    """Stores refreshed {contact: rsa_public} keys in a user's dashboard rows."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.executemany("""
+        UPDATE dashboard
+        SET contact_rsa_public = ?
+        WHERE username = ? AND contact = ?
+    """, [(rsa_public, username, contact) for contact, rsa_public in keys.items()])
+    conn.commit()
+    conn.close()
+
+def get_public_keys(usernames):
+    """Returns {username: rsa_public} for the given users that exist (server side)."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    usernames = list(usernames)
+    keys = {}
+    # Stay well below SQLite's limit on bound parameters
+    for start in range(0, len(usernames), 500):
+        chunk = usernames[start:start + 500]
+        cursor.execute(
+            "SELECT username, rsa_public FROM users WHERE username IN (%s)" % ",".join("?" * len(chunk)),
+            chunk
+        )
+        keys.update(cursor.fetchall())
+    conn.close()
+    return keys
+
+def get_contacts(username):
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT contact, chat_history
+        FROM dashboard
+        WHERE username = ?
+    """, (username,))
+    contacts = cursor.fetchall()
+    conn.close()
+    return contacts
+
+def delete_contact(username, contact):
+    """Removes a conversation: its dashboard row and its stored history."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM dashboard WHERE username = ? AND contact = ?", (username, contact))
+    cursor.execute("DELETE FROM history_records WHERE username = ? AND contact = ?", (username, contact))
+    conn.commit()
+    conn.close()
+
+def create_contact_summary_table():
+    """
+    One row per conversation for the contact list: when the last message was
+    sent or received, how many received messages are unread, and which
+    history entry (by position) the preview shows.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS contact_summary (
+            username TEXT NOT NULL,
+            contact TEXT NOT NULL,
+            last_message_at REAL NOT NULL DEFAULT 0,
+            unread INTEGER NOT NULL DEFAULT 0,
+            preview_id INTEGER,
+            PRIMARY KEY (username, contact)
+        )
+    """)
+    conn.commit()
+    conn.close()
+
+create_contact_summary_table()
+
+def get_contact_summaries(username):
+    """Returns (contact, last_message_at, unread, preview_id) for every conversation of a user."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT contact, last_message_at, unread, preview_id FROM contact_summary WHERE username = ?",
+        (username,)
+    )
+    rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+def save_contact_summaries(username, summaries):
+    """
+    Stores (contact, last_message_at, unread, preview_id) summaries, as the
+    client holds them, in one transaction.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.executemany("""
+        INSERT INTO contact_summary (username, contact, last_message_at, unread, preview_id)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (username, contact) DO UPDATE SET
+            last_message_at = excluded.last_message_at,
+            unread = excluded.unread,
+            preview_id = excluded.preview_id
+    """, [(username, *summary) for summary in summaries])
+    conn.commit()
+    conn.close()
+
+def mark_contact_read(username, contact):
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE contact_summary SET unread = 0 WHERE username = ? AND contact = ? AND unread != 0",
+        (username, contact)
+    )
+    conn.commit()
+    conn.close()
+
+def delete_contact_summary(username, contact):
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM contact_summary WHERE username = ? AND contact = ?", (username, contact))
+    conn.commit()
+    conn.close()
+
+def create_session_tokens_table():
+    """The client's session tokens (see session_tokens.py), one per user logged in on this device."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS session_tokens (
+            username TEXT PRIMARY KEY,
+            token TEXT NOT NULL,
+            expires_at INTEGER NOT NULL,
+            saved_at REAL NOT NULL
+        )
+    """)
+    conn.commit()
+    conn.close()
+
+create_session_tokens_table()
+
+def save_session_token(username, token, expires_at):
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO session_tokens (username, token, expires_at, saved_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (username) DO UPDATE SET
+            token = excluded.token, expires_at = excluded.expires_at, saved_at = excluded.saved_at
+    """, (username, token, expires_at, time.time()))
+    conn.commit()
+    conn.close()
+
+def get_session_token(username=None):
+    """
+    Returns (username, token, expires_at) for the user's stored token, or for
+    the most recently saved one when `username` is None; None if there is none.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    if username is None:
+        cursor.execute("SELECT username, token, expires_at FROM session_tokens ORDER BY saved_at DESC LIMIT 1")
+    else:
+        cursor.execute("SELECT username, token, expires_at FROM session_tokens WHERE username = ?", (username,))
+    row = cursor.fetchone()
+    conn.close()
+    return row
+
+def delete_session_token(username):
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM session_tokens WHERE username = ?", (username,))
+    conn.commit()
+    conn.close()
+
+def get_sync_cursors(username):
+    """Returns {contact: sync_cursor} for every conversation of a user."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT contact, sync_cursor
+        FROM dashboard
+        WHERE username = ?
+    """, (username,))
+    cursors = dict(cursor.fetchall())
+    conn.close()
+    return cursors
+
+def create_history_records_table():
+    """
+    The client's chat history, one row per entry, so a save only inserts
+    the entries added since the last one. `position` is the entry's index
+    in its conversation and `created_at` when it was added (0 if unknown).
+    Histories from before this table, newline-joined in
+    dashboard.chat_history, are moved over once.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS history_records (
+            username TEXT NOT NULL,
+            contact TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            entry TEXT NOT NULL,
+            created_at REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (username, contact, position)
+        )
+    """)
+    cursor.execute("SELECT username, contact, chat_history FROM dashboard WHERE chat_history != ''")
+    for username, contact, chat_history in cursor.fetchall():
+        cursor.executemany("""
+            INSERT OR IGNORE INTO history_records (username, contact, position, entry)
+            VALUES (?, ?, ?, ?)
+        """, [(username, contact, position, entry) for position, entry in enumerate(chat_history.split("\n"))])
+    cursor.execute("UPDATE dashboard SET chat_history = '' WHERE chat_history != ''")
+    conn.commit()
+    conn.close()
+
+create_history_records_table()
+
+def get_history_records(username):
+    """Returns (contact, entry, created_at) for every history entry of a user, in order."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT contact, entry, created_at
+        FROM history_records
+        WHERE username = ?
+        ORDER BY contact, position
+    """, (username,))
+    records = cursor.fetchall()
+    conn.close()
+    return records
+
+def append_history_records(username, records, sync_cursors):
+    """
+    Stores new history entries, given as (contact, position, entry, created_at).
+    `sync_cursors` maps contacts to the id of the last server message_log
+    entry their history now includes.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.executemany("""
+        INSERT OR REPLACE INTO history_records (username, contact, position, entry, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(username, *record) for record in records])
+    cursor.executemany("""
+        UPDATE dashboard
+        SET sync_cursor = MAX(sync_cursor, ?)
+        WHERE username = ? AND contact = ?
+    """, [(sync_cursor, username, contact) for contact, sync_cursor in sync_cursors.items()])
+    conn.commit()
+    conn.close()
+
+def create_message_log_table():
+    """
+    Server-side message log used for history sync. Every message is logged
+    once per owner (its recipient and its sender), filed under the
+    conversation as that owner sees it; group messages are logged once, under
+    the group's own owner name. message_log_heads
+    holds the newest id per (owner, conversation), so a device can find the
+    conversations it is behind on without scanning their history.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS message_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner TEXT NOT NULL,
+            conversation TEXT NOT NULL,
+            message TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_message_log_cursor
+        ON message_log (owner, conversation, id)
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS message_log_heads (
+            owner TEXT NOT NULL,
+            conversation TEXT NOT NULL,
+            last_id INTEGER NOT NULL,
+            PRIMARY KEY (owner, conversation)
+        )
+    """)
+    conn.commit()
+    conn.close()
+
+create_message_log_table()
+
+def get_message_log_next_id():
+    """The id the next message log entry gets."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'message_log'")
+    row = cursor.fetchone()
+    conn.close()
+    return (row[0] if row is not None else 0) + 1
+
+def get_message_log_head(owner, conversation):
+    """The newest log id of one conversation of `owner` (0 if it has none)."""
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT last_id FROM message_log_heads
+        WHERE owner = ? AND conversation = ?
+    """, (owner, conversation))
+    row = cursor.fetchone()
+    conn.close()
+    return row[0] if row is not None else 0
+
+def write_message_log(rows):
+    """
+    Stores (log_id, owner, conversation, message, created_at) rows whose ids
+    were assigned by the caller, in one transaction. Returns True per row.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.executemany("""
+        INSERT INTO message_log (id, owner, conversation, message, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, rows)
+    cursor.executemany("""
+        INSERT INTO message_log_heads (owner, conversation, last_id) VALUES (?, ?, ?)
+        ON CONFLICT (owner, conversation) DO UPDATE SET last_id = MAX(last_id, excluded.last_id)
+    """, [(owner, conversation, log_id) for log_id, owner, conversation, _, _ in rows])
+    conn.commit()
+    conn.close()
+    return [True] * len(rows)
+
+def compact_message_log():
+    """
+    Deletes log entries older than MESSAGE_LOG_TTL and all but the newest
+    MESSAGE_LOG_MAX_MESSAGES of each owner. Returns the number deleted.
+    The heads stay, so ids keep increasing per conversation.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM message_log WHERE created_at < ?", (time.time() - MESSAGE_LOG_TTL,))
+    deleted = cursor.rowcount
+    cursor.execute("""
+        DELETE FROM message_log WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (PARTITION BY owner ORDER BY id DESC) AS newer
+                FROM message_log
+            )
+            WHERE newer > ?
+        )
+    """, (MESSAGE_LOG_MAX_MESSAGES,))
+    deleted += cursor.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+def append_message_log(entries):
+    """
+    Logs (owner, conversation, message) tuples in one transaction.
+    Returns [(log_id, prev_log_id)] in the same order, where prev_log_id is
+    the previous entry of the same owner and conversation (0 for the first).
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    now = time.time()
+    ids = []
+    for owner, conversation, message in entries:
+        cursor.execute("""
+            SELECT last_id FROM message_log_heads
+            WHERE owner = ? AND conversation = ?
+        """, (owner, conversation))
+        row = cursor.fetchone()
+        prev_id = row[0] if row is not None else 0
+        cursor.execute("""
+            INSERT INTO message_log (owner, conversation, message, created_at)
+            VALUES (?, ?, ?, ?)
+        """, (owner, conversation, message, now))
+        log_id = cursor.lastrowid
+        cursor.execute("""
+            INSERT INTO message_log_heads (owner, conversation, last_id) VALUES (?, ?, ?)
+            ON CONFLICT (owner, conversation) DO UPDATE SET last_id = excluded.last_id
+        """, (owner, conversation, log_id))
+        ids.append((log_id, prev_id))
+    conn.commit()
+    conn.close()
+    return ids
+
+def get_message_log_heads(*owners):
+    """
+    Returns {conversation: newest log id} for every conversation of the
+    owners (a user, plus the shared logs of the user's groups).
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT conversation, MAX(last_id)
+        FROM message_log_heads
+        WHERE owner IN ({", ".join("?" * len(owners))})
+        GROUP BY conversation
+    """, owners)
+    heads = dict(cursor.fetchall())
+    conn.close()
+    return heads
+
+def get_message_log_page(owners, conversation, after_id, limit):
+    """
+    Returns up to `limit` (log_id, message) entries after `after_id`, oldest
+    first. `owners` is an owner or a tuple of owners whose entries are merged.
+    """
+    if isinstance(owners, str):
+        owners = (owners,)
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT id, message
+        FROM message_log
+        WHERE owner IN ({", ".join("?" * len(owners))}) AND conversation = ? AND id > ?
+        ORDER BY id
+        LIMIT ?
+    """, (*owners, conversation, after_id, limit))
+    entries = cursor.fetchall()
+    conn.close()
+    return entries
+
+def create_offline_messages_table():
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS offline_messages (
+            recipient TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            message TEXT NOT NULL,
+            enqueued_at REAL,
+            size INTEGER,
+            logged INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # Older databases were created without the enqueue time, size and logged
+    # columns. Their rows predate the message log, so they stay logged = 0.
+    cursor.execute("PRAGMA table_info(offline_messages)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if "enqueued_at" not in columns:
+        cursor.execute("ALTER TABLE offline_messages ADD COLUMN enqueued_at REAL")
+    if "size" not in columns:
+        cursor.execute("ALTER TABLE offline_messages ADD COLUMN size INTEGER")
+    if "logged" not in columns:
+        cursor.execute("ALTER TABLE offline_messages ADD COLUMN logged INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("""
+        UPDATE offline_messages
+        SET enqueued_at = ?, size = length(message)
+        WHERE enqueued_at IS NULL
+    """, (time.time(),))
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_offline_recipient
+        ON offline_messages (recipient, enqueued_at)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_offline_enqueued_at
+        ON offline_messages (enqueued_at)
+    """)
+    conn.commit()
+    conn.close()
+
+create_offline_messages_table()
+
+def _make_room_for_offline_message(cursor, recipient, size):
+    """
+    Applies the per-recipient quota before inserting a message of `size` bytes.
+    Returns False if the message must be rejected.
+    """
+    if size > OFFLINE_MAX_BYTES:
+        return False
+    cursor.execute("""
+        SELECT COUNT(*), COALESCE(SUM(size), 0)
+        FROM offline_messages
+        WHERE recipient = ?
+    """, (recipient,))
+    count, total = cursor.fetchone()
+    excess_messages = count + 1 - OFFLINE_MAX_MESSAGES
+    excess_bytes = total + size - OFFLINE_MAX_BYTES
+    if excess_messages <= 0 and excess_bytes <= 0:
+        return True
+    if OFFLINE_OVERFLOW_POLICY != "drop_oldest":
+        return False
+
+    # Drop the oldest messages until the new one fits.
+    cursor.execute("""
+        SELECT rowid, size
+        FROM offline_messages
+        WHERE recipient = ?
+        ORDER BY enqueued_at
+    """, (recipient,))
+    doomed = []
+    for rowid, row_size in cursor.fetchall():
+        if excess_messages <= 0 and excess_bytes <= 0:
+            break
+        doomed.append((rowid,))
+        excess_messages -= 1
+        excess_bytes -= row_size
+    cursor.executemany("DELETE FROM offline_messages WHERE rowid = ?", doomed)
+    print("DEBUG: Offline quota reached for", recipient, "- dropped", len(doomed), "oldest messages")
+    return True
+
+def add_offline_message(recipient, sender, message):
+    """
+    Queues a message for an offline recipient.
+    Returns True if it was stored, False if the recipient's quota rejected it.
+    """
+    return add_offline_messages([(recipient, sender, message)])[0]
+
+def add_offline_messages(messages):
+    """
+    Queues several (recipient, sender, message) tuples in one transaction.
+    Returns a list of booleans, in the same order, telling which were stored.
+    The server logs every message it stores offline, so the rows are marked
+    as being in the message log as well.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    results = []
+    now = time.time()
+    for recipient, sender, message in messages:
+        size = len(message.encode('utf-8'))
+        stored = _make_room_for_offline_message(cursor, recipient, size)
+        if stored:
+            cursor.execute("""
+                INSERT INTO offline_messages (recipient, sender, message, enqueued_at, size, logged)
+                VALUES (?, ?, ?, ?, ?, 1)
+            """, (recipient, sender, message, now, size))
+        results.append(stored)
+    conn.commit()
+    conn.close()
+    return results
+
+
+def get_offline_messages(recipient, logged=True):
+    """
+    Returns the recipient's (sender, message) rows, oldest first. With
+    logged=False only those missing from the message log.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT sender, message
+        FROM offline_messages
+        WHERE recipient = ? AND enqueued_at >= ? AND logged <= ?
+        ORDER BY enqueued_at, rowid
+    """, (recipient, time.time() - OFFLINE_MESSAGE_TTL, int(logged)))
+    messages = cursor.fetchall()
+    conn.close()
+    return messages
+
+def take_offline_messages(recipient, logged=True):
+    """
+    Returns the recipient's (sender, message) rows like get_offline_messages
+    and deletes, in the same transaction, the rows it read (expired ones and,
+    with logged=False, logged ones included). Rows committed afterwards stay
+    for the next delivery.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("""
+        SELECT rowid, sender, message, enqueued_at, logged
+        FROM offline_messages
+        WHERE recipient = ?
+        ORDER BY enqueued_at, rowid
+    """, (recipient,))
+    rows = cursor.fetchall()
+    cutoff = time.time() - OFFLINE_MESSAGE_TTL
+    messages = [(sender, message) for _, sender, message, enqueued_at, row_logged in rows
+                if enqueued_at >= cutoff and row_logged <= int(logged)]
+    cursor.executemany("DELETE FROM offline_messages WHERE rowid = ?", [(row[0],) for row in rows])
+    conn.commit()
+    conn.close()
+    return messages
+
+def enable_incremental_vacuum():
+    """
+    Switches the database to auto_vacuum=INCREMENTAL so compaction can give
+    free pages back to the file system. Changing the mode needs a full VACUUM,
+    which only happens the first time.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA auto_vacuum")
+    if cursor.fetchone()[0] != 2:
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+    conn.close()
+
+def compact_offline_messages(max_pages=1000):
+    """
+    Deletes expired offline messages and releases up to `max_pages` free pages.
+    Returns the number of deleted messages.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        DELETE FROM offline_messages
+        WHERE enqueued_at < ?
+    """, (time.time() - OFFLINE_MESSAGE_TTL,))
+    deleted = cursor.rowcount
+    conn.commit()
+    cursor.execute(f"PRAGMA incremental_vacuum({int(max_pages)})")
+    cursor.fetchall()
+    conn.close()
+    return deleted
+
+def get_offline_queue_stats():
+    """
+    Returns the offline queue depth, overall and per recipient.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT recipient, COUNT(*), COALESCE(SUM(size), 0), MIN(enqueued_at)
+        FROM offline_messages
+        GROUP BY recipient
+    """)
+    recipients = {}
+    total_messages = 0
+    total_bytes = 0
+    for recipient, count, size, oldest in cursor.fetchall():
+        recipients[recipient] = {'messages': count, 'bytes': size, 'oldest': oldest}
+        total_messages += count
+        total_bytes += size
+    conn.close()
+    return {
+        'total_messages': total_messages,
+        'total_bytes': total_bytes,
+        'recipients': recipients
+    }
+
+def create_groups_table():
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_groups (
+            group_name TEXT NOT NULL,
+            member TEXT NOT NULL,
+            UNIQUE (group_name, member)
+        )
+    """)
+    conn.commit()
+    conn.close()
+
+create_groups_table()
+
+def add_group(group_name, members):
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.executemany("""
+        INSERT OR IGNORE INTO chat_groups (group_name, member)
+        VALUES (?, ?)
+    """, [(group_name, member) for member in members])
+    conn.commit()
+    conn.close()
+
+def get_group_members(group_name):
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT member
+        FROM chat_groups
+        WHERE group_name = ?
+    """, (group_name,))
+    members = [row[0] for row in cursor.fetchall()]
+    conn.close()
+    return members
+
+def get_user_groups(username):
+    """
+    Returns a dict mapping each group the user belongs to onto its member list.
+    """
+    conn = create_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT g.group_name, g.member
+        FROM chat_groups g
+        JOIN chat_groups mine ON mine.group_name = g.group_name
+        WHERE mine.member = ?
+    """, (username,))
+    groups = {}
+    for group_name, member in cursor.fetchall():
+        groups.setdefault(group_name, []).append(member)
+    conn.close()
+    return groups
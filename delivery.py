@@ -0,0 +1,146 @@
+# delivery.py
+import uuid
+from collections import OrderedDict
+
+
+class DeliveryWindow:
+    """
+    Sequence numbers and unacknowledged messages for the /chat namespace.
+
+    Every message delivered to a user gets the next sequence number of its
+    conversation (the sender, or the group name) for that user, and stays in
+    the user's window until one of the user's devices acknowledges it.
+    Acknowledgements are cumulative: acking seq n of a conversation releases
+    every message up to n. Whatever is still in the window is sent again when
+    the user registers.
+
+    Group messages are numbered once per group instead, so one envelope can
+    be emitted to the whole group room; each member still acks it separately.
+
+    Sequence numbers are only meaningful within one `epoch`, a random ID
+    chosen when the server starts; clients reset their counters when it changes.
+    The state of a user who has been gone for a while is dropped by expire(),
+    after which the user's conversations are numbered from 1 again.
+    """
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex
+        self.last_seq = {}   # recipient -> {conversation: last sequence number assigned}
+        self.group_seq = {}  # group -> last sequence number assigned
+        self.unacked = {}    # recipient -> {conversation: OrderedDict(seq -> envelope)}
+        self.gone = {}       # recipient -> when its last session went away
+
+    def envelope(self, recipient, conversation, text, log_id=None, prev_log_id=None):
+        """
+        Numbers a message for `recipient`, keeps it until acked and returns the
+        envelope to emit: {'epoch', 'conversation', 'seq', 'text'}, plus
+        'log_id' and 'prev_log_id' for messages in the server's message log.
+        """
+        last_seq = self.last_seq.setdefault(recipient, {})
+        seq = last_seq.get(conversation, 0) + 1
+        last_seq[conversation] = seq
+        envelope = self._make(conversation, seq, text, log_id, prev_log_id)
+        self.unacked.setdefault(recipient, {}).setdefault(conversation, OrderedDict())[seq] = envelope
+        return envelope
+
+    def group_envelope(self, group, recipients, text, log_id=None, prev_log_id=None):
+        """
+        Numbers a group message in the group's own sequence and keeps the one
+        envelope until each of `recipients` acks it.
+        """
+        seq = self.group_seq.get(group, 0) + 1
+        self.group_seq[group] = seq
+        envelope = self._make(group, seq, text, log_id, prev_log_id)
+        for recipient in recipients:
+            self.unacked.setdefault(recipient, {}).setdefault(group, OrderedDict())[seq] = envelope
+        return envelope
+
+    def _make(self, conversation, seq, text, log_id, prev_log_id):
+        envelope = {'epoch': self.epoch, 'conversation': conversation, 'seq': seq, 'text': text}
+        if log_id is not None:
+            envelope['log_id'] = log_id
+            envelope['prev_log_id'] = prev_log_id
+        return envelope
+
+    def ack(self, recipient, acks):
+        """
+        Releases every message up to acks[conversation] in each conversation.
+        Returns the number of messages released.
+        """
+        conversations = self.unacked.get(recipient)
+        if not conversations:
+            return 0
+        released = 0
+        for conversation, acked_seq in acks.items():
+            window = conversations.get(conversation)
+            if window is None:
+                continue
+            while window and next(iter(window)) <= acked_seq:
+                window.popitem(last=False)
+                released += 1
+            if not window:
+                del conversations[conversation]
+        if not conversations:
+            del self.unacked[recipient]
+        return released
+
+    def pending(self, recipient, conversation=None, from_seq=1):
+        """
+        Returns the unacked envelopes for a recipient, oldest first within each
+        conversation, optionally only those of one conversation from `from_seq` on.
+        """
+        conversations = self.unacked.get(recipient, {})
+        if conversation is not None:
+            conversations = {conversation: conversations.get(conversation, {})}
+        return [
+            envelope
+            for window in conversations.values()
+            for seq, envelope in window.items()
+            if seq >= from_seq
+        ]
+
+    def delivered(self, recipient, groups=()):
+        """
+        Returns {conversation: highest seq the recipient has acked}, which is
+        where a freshly started client should begin counting. `groups` are the
+        groups the recipient belongs to. Conversations missing from it start at 0.
+        """
+        positions = dict(self.last_seq.get(recipient, {}))
+        positions.update((group, self.group_seq[group]) for group in groups if group in self.group_seq)
+        delivered = {}
+        unacked = self.unacked.get(recipient, {})
+        for conversation, seq in positions.items():
+            window = unacked.get(conversation)
+            delivered[conversation] = next(iter(window)) - 1 if window else seq
+        return delivered
+
+    def connected(self, recipient):
+        self.gone.pop(recipient, None)
+
+    def disconnected(self, recipient, at):
+        """Called when the recipient's last session goes away."""
+        self.gone[recipient] = at
+
+    def expire(self, max_age, now):
+        """
+        Forgets the state of recipients gone for longer than `max_age`
+        seconds. Returns {recipient: [unacked envelopes]} so the caller can
+        store those messages elsewhere.
+        """
+        expired = {}
+        for recipient, at in list(self.gone.items()):
+            if now - at > max_age:
+                del self.gone[recipient]
+                self.last_seq.pop(recipient, None)
+                expired[recipient] = [
+                    envelope
+                    for window in self.unacked.pop(recipient, {}).values()
+                    for envelope in window.values()
+                ]
+        return expired
+
+    def unacked_count(self, recipient):
+        return sum(len(window) for window in self.unacked.get(recipient, {}).values())
+
+    def __len__(self):
+        """Number of unacked messages across all recipients."""
+        return sum(len(window) for conversations in self.unacked.values() for window in conversations.values())
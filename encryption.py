@@ -1,134 +1,223 @@
-import os
-import struct
-
-class Salsa20Cipher:
-    def __init__(self, key, nonce, rounds=20):
-        """
-        key: 16 or 32 bytes
-        nonce: 8 bytes
-        rounds: typically 20
-        """
-        if len(key) not in (16, 32):
-            raise ValueError("Key must be either 16 or 32 bytes long")
-        if len(nonce) != 8:
-            raise ValueError("Nonce must be 8 bytes long")
-        self.key = key
-        self.nonce = nonce
-        self.rounds = rounds
-        self.counter = 0
-        # Use different constants based on key length
-        if len(key) == 32:
-            self.constants = b"expand 32-byte k"
-        else:
-            self.constants = b"expand 16-byte k"
-
-    def _rotl(self, x, n):
-        return ((x << n) & 0xffffffff) | (x >> (32 - n))
-
-    def _quarterround(self, a, b, c, d):
-        b ^= self._rotl((a + d) & 0xffffffff, 7)
-        c ^= self._rotl((b + a) & 0xffffffff, 9)
-        d ^= self._rotl((c + b) & 0xffffffff, 13)
-        a ^= self._rotl((d + c) & 0xffffffff, 18)
-        return a, b, c, d
-
-    def _salsa20_block(self, counter):
-        if len(self.key) == 32:
-            k = struct.unpack('<8I', self.key)
-            constants = struct.unpack('<4I', self.constants)
-            n = struct.unpack('<2I', self.nonce)
-            state = [
-                constants[0],
-                k[0], k[1], k[2], k[3],
-                constants[1],
-                n[0], n[1],
-                counter & 0xffffffff,
-                (counter >> 32) & 0xffffffff,
-                constants[2],
-                k[4], k[5], k[6], k[7],
-                constants[3]
-            ]
-        else:  # 16-byte key
-            k = struct.unpack('<4I', self.key)
-            constants = struct.unpack('<4I', self.constants)
-            n = struct.unpack('<2I', self.nonce)
-            state = [
-                constants[0],
-                k[0], k[1], k[2],
-                k[3],
-                constants[1],
-                n[0], n[1],
-                counter & 0xffffffff,
-                (counter >> 32) & 0xffffffff,
-                constants[2],
-                k[0], k[1], k[2], k[3],
-                constants[3]
-            ]
-        x = state[:]  # copy the state
-        for i in range(self.rounds // 2):
-            # Column rounds
-            x[0], x[4], x[8],  x[12] = self._quarterround(x[0], x[4], x[8],  x[12])
-            x[5], x[9], x[13], x[1]  = self._quarterround(x[5], x[9], x[13], x[1])
-            x[10], x[14], x[2], x[6]  = self._quarterround(x[10], x[14], x[2], x[6])
-            x[15], x[3], x[7],  x[11] = self._quarterround(x[15], x[3], x[7],  x[11])
-            # Row rounds
-            x[0], x[1], x[2],  x[3]  = self._quarterround(x[0], x[1], x[2],  x[3])
-            x[5], x[6], x[7],  x[4]  = self._quarterround(x[5], x[6], x[7],  x[4])
-            x[10], x[11], x[8], x[9]  = self._quarterround(x[10], x[11], x[8], x[9])
-            x[15], x[12], x[13], x[14] = self._quarterround(x[15], x[12], x[13], x[14])
-        output = [(x[i] + state[i]) & 0xffffffff for i in range(16)]
-        return struct.pack('<16I', *output)
-
-    def keystream(self, length):
-        out = b""
-        counter = self.counter
-        while len(out) < length:
-            block = self._salsa20_block(counter)
-            out += block
-            counter += 1
-        self.counter = counter
-        return out[:length]
-
-    def encrypt(self, data):
-        ks = self.keystream(len(data))
-        return bytes(a ^ b for a, b in zip(data, ks))
-
-    def decrypt(self, data):
-        # Decryption is the same as encryption (XOR is reversible)
-        return self.encrypt(data)
-
-class EncryptionManager:
-    def __init__(self, key=None):
-        """
-        If no key is provided, generate a new 32-byte key for the session.
-        """
-        if key is None:
-            key = os.urandom(32)
-        self.key = key
-
-    def encrypt_message(self, message):
-        """
-        Encrypts the message using Salsa20. Generates a random 8-byte nonce,
-        prepends it to the ciphertext, and returns the hex-encoded string.
-        """
-        plaintext = message.encode('utf-8')
-        nonce = os.urandom(8)  # Salsa20 uses an 8-byte nonce.
-        cipher = Salsa20Cipher(self.key, nonce)
-        encrypted_bytes = cipher.encrypt(plaintext)
-        # Prepend nonce to ciphertext and return as hex.
-        return (nonce + encrypted_bytes).hex()
-
-    def decrypt_message(self, encrypted_message):
-        """
-        Expects a hex-encoded message with the first 8 bytes as the nonce.
-        Returns the decrypted plaintext.
-        """
-        try:
-            data = bytes.fromhex(encrypted_message)
-            nonce = data[:8]
-            ciphertext = data[8:]
-            cipher = Salsa20Cipher(self.key, nonce)
-            decrypted_bytes = cipher.decrypt(ciphertext)
-            return decrypted_bytes.decode('utf-8')
-        except Exception:
-            return encrypted_message
+import hmac
+import os
+import struct
+from custom_aes import AESCTRCipher
+import crypto_backends
+
+class Salsa20Cipher:
+    def __init__(self, key, nonce, rounds=20, counter=0):
+        """
+        key: 16 or 32 bytes
+        nonce: 8 bytes
+        rounds: typically 20
+        counter: block (64 bytes of keystream) to start at
+        """
+        if len(key) not in (16, 32):
+            raise ValueError("Key must be either 16 or 32 bytes long")
+        if len(nonce) != 8:
+            raise ValueError("Nonce must be 8 bytes long")
+        self.key = key
+        self.nonce = nonce
+        self.rounds = rounds
+        self.counter = counter
+        # Use different constants based on key length
+        if len(key) == 32:
+            self.constants = b"expand 32-byte k"
+        else:
+            self.constants = b"expand 16-byte k"
+
+    def _rotl(self, x, n):
+        return ((x << n) & 0xffffffff) | (x >> (32 - n))
+
+    def _quarterround(self, a, b, c, d):
+        b ^= self._rotl((a + d) & 0xffffffff, 7)
+        c ^= self._rotl((b + a) & 0xffffffff, 9)
+        d ^= self._rotl((c + b) & 0xffffffff, 13)
+        a ^= self._rotl((d + c) & 0xffffffff, 18)
+        return a, b, c, d
+
+    def _salsa20_block(self, counter):
+        if len(self.key) == 32:
+            k = struct.unpack('<8I', self.key)
+            constants = struct.unpack('<4I', self.constants)
+            n = struct.unpack('<2I', self.nonce)
+            state = [
+                constants[0],
+                k[0], k[1], k[2], k[3],
+                constants[1],
+                n[0], n[1],
+                counter & 0xffffffff,
+                (counter >> 32) & 0xffffffff,
+                constants[2],
+                k[4], k[5], k[6], k[7],
+                constants[3]
+            ]
+        else:  # 16-byte key
+            k = struct.unpack('<4I', self.key)
+            constants = struct.unpack('<4I', self.constants)
+            n = struct.unpack('<2I', self.nonce)
+            state = [
+                constants[0],
+                k[0], k[1], k[2],
+                k[3],
+                constants[1],
+                n[0], n[1],
+                counter & 0xffffffff,
+                (counter >> 32) & 0xffffffff,
+                constants[2],
+                k[0], k[1], k[2], k[3],
+                constants[3]
+            ]
+        x = state[:]  # copy the state
+        for i in range(self.rounds // 2):
+            # Column rounds
+            x[0], x[4], x[8],  x[12] = self._quarterround(x[0], x[4], x[8],  x[12])
+            x[5], x[9], x[13], x[1]  = self._quarterround(x[5], x[9], x[13], x[1])
+            x[10], x[14], x[2], x[6]  = self._quarterround(x[10], x[14], x[2], x[6])
+            x[15], x[3], x[7],  x[11] = self._quarterround(x[15], x[3], x[7],  x[11])
+            # Row rounds
+            x[0], x[1], x[2],  x[3]  = self._quarterround(x[0], x[1], x[2],  x[3])
+            x[5], x[6], x[7],  x[4]  = self._quarterround(x[5], x[6], x[7],  x[4])
+            x[10], x[11], x[8], x[9]  = self._quarterround(x[10], x[11], x[8], x[9])
+            x[15], x[12], x[13], x[14] = self._quarterround(x[15], x[12], x[13], x[14])
+        output = [(x[i] + state[i]) & 0xffffffff for i in range(16)]
+        return struct.pack('<16I', *output)
+
+    def keystream(self, length):
+        counter = self.counter
+        blocks = []
+        for _ in range((length + 63) // 64):
+            blocks.append(self._salsa20_block(counter))
+            counter += 1
+        self.counter = counter
+        return b"".join(blocks)[:length]
+
+    def encrypt(self, data):
+        ks = self.keystream(len(data))
+        # XOR the whole buffer at once as big integers instead of byte by byte.
+        x = int.from_bytes(data, 'little') ^ int.from_bytes(ks, 'little')
+        return x.to_bytes(len(data), 'little')
+
+    def decrypt(self, data):
+        # Decryption is the same as encryption (XOR is reversible)
+        return self.encrypt(data)
+
+POLY1305_P = (1 << 130) - 5
+POLY1305_CLAMP = 0x0ffffffc0ffffffc0ffffffc0fffffff
+
+def poly1305(key, message):
+    """One-time Poly1305 tag (16 bytes) of `message` under a 32-byte key (RFC 8439)."""
+    r = int.from_bytes(key[:16], 'little') & POLY1305_CLAMP
+    s = int.from_bytes(key[16:32], 'little')
+    acc = 0
+    for i in range(0, len(message), 16):
+        acc = (acc + int.from_bytes(message[i:i + 16] + b'\x01', 'little')) * r % POLY1305_P
+    return ((acc + s) & ((1 << 128) - 1)).to_bytes(16, 'little')
+
+def _mac_data(aad, ciphertext):
+    """What the tag covers: aad and ciphertext, each zero-padded to 16 bytes, then both lengths."""
+    def pad(data):
+        return data + bytes(-len(data) % 16)
+    return pad(aad) + pad(ciphertext) + struct.pack('<QQ', len(aad), len(ciphertext))
+
+class AuthenticationError(ValueError):
+    pass
+
+# Stream ciphers EncryptionManager can use. Both take (key, 8-byte nonce).
+CIPHERS = {
+    'salsa20': Salsa20Cipher,
+    'aes-ctr': AESCTRCipher,
+}
+
+class EncryptionManager:
+    def __init__(self, key=None, cipher='salsa20'):
+        """
+        If no key is provided, generate a new 32-byte key for the session.
+        cipher selects the stream cipher: 'salsa20' (default) or 'aes-ctr'.
+        """
+        if key is None:
+            key = os.urandom(32)
+        if cipher not in CIPHERS:
+            raise ValueError("Unknown cipher: " + str(cipher))
+        self.key = key
+        self.cipher = cipher
+        self.cipher_class = CIPHERS[cipher]
+
+    def _stream_xor(self, nonce, data):
+        # Salsa20 goes through the backend registry so an accelerated library is used when installed.
+        if self.cipher == 'salsa20':
+            return crypto_backends.salsa20_xor(self.key, nonce, data)
+        return self.cipher_class(self.key, nonce).encrypt(data)
+
+    def encrypt_bytes(self, plaintext):
+        """
+        Encrypts raw bytes with a random 8-byte nonce and returns
+        hex(nonce + ciphertext).
+        """
+        nonce = os.urandom(8)  # Both ciphers use an 8-byte nonce.
+        encrypted_bytes = self._stream_xor(nonce, plaintext)
+        # Prepend nonce to ciphertext and return as hex.
+        return (nonce + encrypted_bytes).hex()
+
+    def decrypt_bytes(self, encrypted_message):
+        """
+        Reverses encrypt_bytes. Raises ValueError on malformed input.
+        """
+        data = bytes.fromhex(encrypted_message)
+        if len(data) < 8:
+            raise ValueError("Encrypted message is shorter than its nonce")
+        return self._stream_xor(data[:8], data[8:])
+
+    def seal_raw(self, plaintext, aad=b""):
+        """
+        Authenticated encryption (Salsa20-Poly1305): keystream block 0 keys
+        Poly1305 and the data is encrypted from block 1 on. Returns
+        (nonce + ciphertext, 16-byte tag); the tag also covers `aad`.
+        """
+        if self.cipher != 'salsa20':
+            raise ValueError("Authenticated encryption needs the salsa20 cipher")
+        nonce = os.urandom(8)
+        stream = self._stream_xor(nonce, bytes(64) + plaintext)
+        ciphertext = stream[64:]
+        return nonce + ciphertext, poly1305(stream[:32], _mac_data(aad, ciphertext))
+
+    def open_raw(self, data, tag, aad=b""):
+        """
+        Reverses seal_raw. The tag is checked (in constant time) before
+        anything is decrypted; raises AuthenticationError if it does not match.
+        """
+        if self.cipher != 'salsa20':
+            raise ValueError("Authenticated encryption needs the salsa20 cipher")
+        if len(data) < 8:
+            raise ValueError("Encrypted message is shorter than its nonce")
+        nonce, ciphertext = data[:8], data[8:]
+        poly_key = self._stream_xor(nonce, bytes(32))
+        if not hmac.compare_digest(poly1305(poly_key, _mac_data(aad, ciphertext)), tag):
+            raise AuthenticationError("Message authentication failed")
+        return self._stream_xor(nonce, bytes(64) + ciphertext)[64:]
+
+    def seal_bytes(self, plaintext, aad=b""):
+        """seal_raw for packages: returns (hex(nonce + ciphertext), hex tag)."""
+        data, tag = self.seal_raw(plaintext, aad)
+        return data.hex(), tag.hex()
+
+    def open_bytes(self, encrypted_message, tag, aad=b""):
+        """Reverses seal_bytes; raises AuthenticationError if the tag does not match."""
+        return self.open_raw(bytes.fromhex(encrypted_message), bytes.fromhex(tag), aad)
+
+    def encrypt_message(self, message):
+        """
+        Encrypts the message using the selected stream cipher. Generates a random
+        8-byte nonce, prepends it to the ciphertext, and returns the hex-encoded string.
+        """
+        return self.encrypt_bytes(message.encode('utf-8'))
+
+    def decrypt_message(self, encrypted_message):
+        """
+        Expects a hex-encoded message with the first 8 bytes as the nonce.
+        Returns the decrypted plaintext.
+        """
+        try:
+            return self.decrypt_bytes(encrypted_message).decode('utf-8')
+        except Exception:
+            return encrypted_message
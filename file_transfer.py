@@ -0,0 +1,170 @@
+import os
+import crypto_backends
+from parallel_salsa20 import PARALLEL_MIN_BYTES
+from custom_rsa import encrypt, decrypt
+from chat_encryption import Keyring
+
+FILE_CHUNK_SIZE = 64 * 1024    # bytes per chunk; a multiple of the 64-byte Salsa20 block
+FILE_WINDOW = 8                # chunks in flight before waiting for an ack
+FILE_DOWNLOAD_DIR = "downloads"
+
+
+def _chunk_xor(file_key, nonce, index, chunk_size, data):
+    """
+    Encrypts or decrypts `data`, which starts at chunk `index`, with the file's
+    Salsa20 keystream. The whole file is one keystream, so any run of chunks
+    can be processed on its own (which is what makes resuming possible).
+    """
+    return crypto_backends.salsa20_xor(file_key, nonce, data, counter=index * (chunk_size // 64))
+
+
+class FileSender:
+    """
+    Reads a file one chunk at a time and encrypts each chunk with a per-file
+    Salsa20 key. At most FILE_WINDOW chunks are unacknowledged, so memory use
+    does not depend on the file size.
+
+    Chunks are encrypted ahead in batches of at least a window and at least
+    PARALLEL_MIN_BYTES, so that the refills after each ack are also large
+    enough to be spread over several cores.
+    """
+    def __init__(self, path, recipient, recipient_public_key, chunk_size=FILE_CHUNK_SIZE, window=FILE_WINDOW):
+        if chunk_size % 64 != 0:
+            raise ValueError("Chunk size must be a multiple of 64 bytes")
+        self.transfer_id = os.urandom(8).hex()
+        self.path = path
+        self.recipient = recipient
+        self.recipient_public_key = recipient_public_key
+        self.size = os.path.getsize(path)
+        self.chunk_size = chunk_size
+        self.window = window
+        self.total_chunks = (self.size + chunk_size - 1) // chunk_size
+        self.file_key = os.urandom(32)
+        self.nonce = os.urandom(8)
+        self.next_chunk = 0  # next chunk to send
+        self.acked = 0       # chunks [0, acked) are confirmed by the recipient
+        self.batch = max(window, -(-PARALLEL_MIN_BYTES // chunk_size))  # chunks encrypted per read
+        self._ahead = {}     # index -> encrypted chunk, read but not sent yet
+        self._file = open(path, 'rb')
+
+    def offer(self, sender):
+        """Builds the 'file_offer' payload, with the file key wrapped for the recipient."""
+        wrapped_key = encrypt(self.file_key.hex(), self.recipient_public_key)
+        return {
+            'transfer_id': self.transfer_id,
+            'sender': sender,
+            'recipient': self.recipient,
+            'filename': os.path.basename(self.path),
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'total_chunks': self.total_chunks,
+            'encrypted_file_key': hex(wrapped_key)[2:],
+            'key_fp': self.recipient_public_key.fingerprint,
+            'nonce': self.nonce.hex()
+        }
+
+    def read_chunk(self, index):
+        """Reads and encrypts a single chunk."""
+        return b"".join(self.read_chunks(index, 1))
+
+    def read_chunks(self, first, count):
+        """
+        Reads and encrypts `count` consecutive chunks as one buffer, which
+        large enough windows encrypt on several cores.
+        """
+        self._file.seek(first * self.chunk_size)
+        ciphertext = _chunk_xor(self.file_key, self.nonce, first, self.chunk_size,
+                                self._file.read(count * self.chunk_size))
+        return [ciphertext[i:i + self.chunk_size] for i in range(0, len(ciphertext), self.chunk_size)]
+
+    def next_chunks(self):
+        """Yields (index, encrypted bytes) for every chunk the window allows."""
+        end = min(self.total_chunks, self.acked + self.window)
+        while self.next_chunk < end:
+            index = self.next_chunk
+            if index not in self._ahead:
+                count = min(self.batch, self.total_chunks - index)
+                self._ahead.update(enumerate(self.read_chunks(index, count), index))
+            self.next_chunk += 1
+            yield index, self._ahead.pop(index)
+
+    def ack(self, index):
+        """Cumulative ack: every chunk up to and including `index` arrived."""
+        self.acked = max(self.acked, index + 1)
+
+    def resume(self, index):
+        """Restarts sending at chunk `index` (the first one the recipient lacks)."""
+        self.acked = index
+        self.next_chunk = index
+        self._ahead = {i: chunk for i, chunk in self._ahead.items() if i >= index}
+
+    @property
+    def done(self):
+        return self.acked >= self.total_chunks
+
+    def close(self):
+        self._file.close()
+
+
+class FileReceiver:
+    """
+    Writes decrypted chunks straight to their offset in the output file.
+    Tracks the first missing chunk so an interrupted transfer can resume.
+    `private_key` is an RSAKey or the recipient's Keyring.
+    """
+    def __init__(self, offer, private_key, download_dir=FILE_DOWNLOAD_DIR):
+        self.transfer_id = offer['transfer_id']
+        self.sender = offer['sender']
+        self.size = offer['size']
+        self.chunk_size = offer['chunk_size']
+        if self.chunk_size % 64 != 0:
+            raise ValueError("Chunk size must be a multiple of 64 bytes")
+        self.total_chunks = offer['total_chunks']
+        if self.size < 0 or self.total_chunks != (self.size + self.chunk_size - 1) // self.chunk_size:
+            raise ValueError("Chunk count does not match the file size")
+        self.nonce = bytes.fromhex(offer['nonce'])
+        if isinstance(private_key, Keyring):
+            private_key = private_key.private_key(offer.get('key_fp'))
+        self.file_key = bytes.fromhex(decrypt(int(offer['encrypted_file_key'], 16), private_key))
+        self.next_index = 0      # first chunk not yet received
+        self._received = set()   # out-of-order chunks beyond next_index (at most one window)
+
+        os.makedirs(download_dir, exist_ok=True)
+        self.path = self._unique_path(download_dir, os.path.basename(offer['filename']))
+        self._file = open(self.path, 'wb')
+
+    @staticmethod
+    def _unique_path(directory, filename):
+        base, ext = os.path.splitext(filename or "file")
+        path = os.path.join(directory, base + ext)
+        counter = 1
+        while os.path.exists(path):
+            path = os.path.join(directory, f"{base} ({counter}){ext}")
+            counter += 1
+        return path
+
+    def write_chunk(self, index, data):
+        """
+        Decrypts and stores one chunk. Returns the highest contiguous chunk
+        index received. Raises ValueError for a chunk outside the offered file.
+        """
+        if not 0 <= index < self.total_chunks:
+            raise ValueError(f"Chunk {index} is outside the file ({self.total_chunks} chunks)")
+        if len(data) != min(self.chunk_size, self.size - index * self.chunk_size):
+            raise ValueError(f"Chunk {index} has the wrong length")
+        if index >= self.next_index and index not in self._received:
+            plaintext = _chunk_xor(self.file_key, self.nonce, index, self.chunk_size, data)
+            self._file.seek(index * self.chunk_size)
+            self._file.write(plaintext)
+            self._received.add(index)
+            while self.next_index in self._received:
+                self._received.discard(self.next_index)
+                self.next_index += 1
+        return self.next_index - 1
+
+    @property
+    def done(self):
+        return self.next_index >= self.total_chunks
+
+    def close(self):
+        self._file.close()
@@ -1,27 +1,35 @@
-import sys
-import os
-import re
-import shutil
-from PyQt5.QtCore import Qt, QEvent, QDir, QFileInfo, QUrl, QPropertyAnimation, QRect, QMetaObject
-from PyQt5.QtGui import QColor, QPalette, QPixmap, QLinearGradient, QPainter, QFont, QIcon, QDesktopServices,QValidator
-
-from PyQt5.QtWidgets import (
-    QApplication, QMainWindow, QLabel, QLineEdit, QPushButton,
-    QTextEdit, QVBoxLayout, QWidget, QFormLayout, QSizePolicy,
-    QFileDialog, QMessageBox, QHBoxLayout, QTabWidget, QFrame,
-    QPushButton, QListWidget, QListWidgetItem, QStackedWidget,
-    QInputDialog, QFileDialog, QTextBrowser, QDialogButtonBox, QDialogButtonBox
-)
-from PyQt5.QtTest import QTest
-import time
-import base64
-from unittest.mock import patch, MagicMock
-
-
-from dashboard import ChatHeaderWidget
-from login import LoginWindow
-from signup import SignupWindow
-from mainwindow import MainWindow
-from encryption import EncryptionManager
-from contact_functions import ContactFunctions
-from chat_functions import ChatFunctions
\ No newline at end of file
+import sys
+import os
+import re
+import shutil
+from PyQt5.QtCore import Qt, QEvent, QDir, QFileInfo, QUrl, QPropertyAnimation, QRect, QMetaObject
+from PyQt5.QtGui import QColor, QPalette, QPixmap, QLinearGradient, QPainter, QFont, QIcon, QDesktopServices,QValidator
+
+from PyQt5.QtWidgets import (
+    QApplication, QMainWindow, QLabel, QLineEdit, QPushButton,
+    QTextEdit, QVBoxLayout, QWidget, QFormLayout, QSizePolicy,
+    QFileDialog, QMessageBox, QHBoxLayout, QTabWidget, QFrame,
+    QPushButton, QListWidget, QListWidgetItem, QStackedWidget,
+    QInputDialog, QFileDialog, QTextBrowser, QDialogButtonBox, QDialogButtonBox
+)
+
+# Application modules are loaded on first use rather than at startup, so
+# launching the client only pays for the login window. `imports.MainWindow`
+# etc. still work; `from imports import *` deliberately does not pull them in.
+_LAZY_NAMES = {
+    'ChatHeaderWidget': 'dashboard',
+    'LoginWindow': 'login',
+    'SignupWindow': 'signup',
+    'MainWindow': 'mainwindow',
+    'EncryptionManager': 'encryption',
+    'ContactFunctions': 'contact_functions',
+    'ChatFunctions': 'chat_functions',
+}
+
+def __getattr__(name):
+    if name in _LAZY_NAMES:
+        import importlib
+        value = getattr(importlib.import_module(_LAZY_NAMES[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
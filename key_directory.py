@@ -0,0 +1,37 @@
+# key_directory.py
+"""
+Public key directory shared by the server's /keys endpoint and the client's
+key cache.
+
+A key's version is its fingerprint (RSAKey.fingerprint), so a client can
+tell which version it holds without storing anything extra. The ETag of a lookup
+is a hash over the (username, version) pairs it returned; a client that
+computes the same ETag from its cache revalidates every key it holds with
+one request and an empty 304 response.
+"""
+import hashlib
+from custom_rsa import parse_public_key
+from database import get_public_keys
+
+KEY_LOOKUP_MAX = 5000   # usernames per /keys request
+
+
+def key_version(rsa_public_str):
+    return parse_public_key(rsa_public_str).fingerprint
+
+
+def directory_etag(versions):
+    """ETag for {username: version}."""
+    digest = hashlib.sha256()
+    for username in sorted(versions):
+        digest.update(f"{username}:{versions[username]}\n".encode('utf-8'))
+    return digest.hexdigest()[:32]
+
+
+def lookup_keys(usernames):
+    """Returns {username: {'rsa_public': "n,e", 'version': ...}} for the users that exist."""
+    return {
+        username: {'rsa_public': rsa_public, 'version': key_version(rsa_public)}
+        for username, rsa_public in get_public_keys(usernames).items()
+        if rsa_public
+    }
@@ -1,15 +1,42 @@
-from imports import *
-
-if __name__ == '__main__':
-    # Create a QApplication instance
-    app = QApplication(sys.argv)
-
-    # Create and show the login/signup windows
-    signup_window = SignupWindow(None)  # Temporarily pass None as the login window
-    login_window = LoginWindow(signup_window)
-    signup_window.login_window = login_window  # Now assign the login window to signup_window
-    login_window.show()
-
-    # Start the application event loop
-    sys.exit(app.exec_())
- 
\ No newline at end of file
+import os
+import sys
+import time
+
+START_TIME = time.perf_counter()
+
+from PyQt5.QtCore import QObject, QEvent, QTimer
+from PyQt5.QtWidgets import QApplication
+from login import LoginWindow
+
+
+class FirstPaintTimer(QObject):
+    """
+    Reports the time from process start to the login window's first paint.
+    Enabled with VIBER_STARTUP_TIMING=1; VIBER_EXIT_AFTER_FIRST_PAINT=1 quits
+    right after (used by `python benchmark.py startup`).
+    """
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint:
+            obj.removeEventFilter(self)
+            print(f"STARTUP: first paint after {(time.perf_counter() - START_TIME) * 1000:.1f} ms")
+            if os.environ.get('VIBER_EXIT_AFTER_FIRST_PAINT'):
+                QTimer.singleShot(0, QApplication.quit)
+        return False
+
+
+if __name__ == '__main__':
+    # Create a QApplication instance
+    app = QApplication(sys.argv)
+
+    # Only the login window is built at launch; the signup window is created
+    # the first time the user asks for it.
+    login_window = LoginWindow(None)
+    if os.environ.get('VIBER_STARTUP_TIMING'):
+        first_paint_timer = FirstPaintTimer()
+        login_window.installEventFilter(first_paint_timer)
+    login_window.show()
+    # A session token from an earlier login skips the password prompt
+    QTimer.singleShot(0, login_window.resume_session)
+
+    # Start the application event loop
+    sys.exit(app.exec_())
@@ -0,0 +1,191 @@
+# message_records.py
+"""
+Compact in-memory chat history.
+
+A conversation's history used to be a list of "sender: text" strings, where
+the text of our own messages is the package JSON with every binary field as
+hex. MessageRecords keeps the same entries in columns instead:
+
+  - sender ids (array 'I'), indexes into a SenderNames table shared by all
+    conversations, so each name is stored once;
+  - timestamps (array 'd'), when the entry was added (0 for loaded history);
+  - offsets (array 'Q') into one bytearray holding every entry's body.
+
+Bodies are stored as segments: UTF-8 text, and runs of hex inside JSON
+strings (keys, ciphertext, tags, fingerprints) as the raw bytes they encode,
+which halves them. The JSON between those runs is mostly the same few
+fragments of package header, which take two bytes each. Reading an entry
+rebuilds exactly the string that was stored, so MessageRecords can stand in
+for the list wherever entries are read by index, counted, iterated or
+compared.
+"""
+import re
+from array import array
+from collections.abc import Sequence
+
+NO_SENDER = 0xFFFFFFFF   # sender id of entries without a "sender: " prefix
+
+_HEX_RUN = re.compile(r'"([0-9a-f]{16,})"')   # shorter runs are not worth a segment
+_TEXT, _HEX, _ODD_HEX, _FRAGMENT = 0, 1, 2, 3  # segment kinds
+
+# Package JSON between hex runs (json.dumps of chat_encryption packages).
+# In memory only, so the table can change freely.
+_FRAGMENTS = [
+    '{"encrypted_sym_key": "', '", "encrypted_message": "', '", "tag": "', '", "key_fp": "',
+    '"', '", "compression": "zlib"', '", "compression": "zstd"', ', "recipient": "',
+    '"}, "key_fps": {"', '"}, "encrypted_message": "', '{"encrypted_sym_keys": {"', ', "group": "',
+]
+_FRAGMENT_IDS = {fragment: index for index, fragment in enumerate(_FRAGMENTS)}
+
+
+class SenderNames:
+    """Interned sender names: each distinct name is stored once and referred to by its id."""
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+
+    def id(self, name):
+        sender_id = self.ids.get(name)
+        if sender_id is None:
+            sender_id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return sender_id
+
+    def name(self, sender_id):
+        return self.names[sender_id]
+
+
+def _segment(out, kind, payload):
+    out.append(kind)
+    length = len(payload)
+    while length >= 0x80:  # varint
+        out.append((length & 0x7f) | 0x80)
+        length >>= 7
+    out.append(length)
+    out += payload
+
+
+def _text_segment(out, text):
+    fragment = _FRAGMENT_IDS.get(text)
+    if fragment is not None:
+        out += bytes((_FRAGMENT, fragment))
+    else:
+        _segment(out, _TEXT, text.encode('utf-8'))
+
+
+def encode_body(text):
+    """Packs a message body into segments (see the module docstring)."""
+    out = bytearray()
+    start = 0
+    for match in _HEX_RUN.finditer(text):
+        run = match.group(1)
+        if match.start(1) > start:
+            _text_segment(out, text[start:match.start(1)])
+        if len(run) % 2:
+            _segment(out, _ODD_HEX, bytes.fromhex('0' + run))
+        else:
+            _segment(out, _HEX, bytes.fromhex(run))
+        start = match.end(1)
+    if start < len(text) or not out:
+        _text_segment(out, text[start:])
+    return bytes(out)
+
+
+def decode_body(data):
+    parts = []
+    pos = 0
+    while pos < len(data):
+        kind = data[pos]
+        if kind == _FRAGMENT:
+            parts.append(_FRAGMENTS[data[pos + 1]])
+            pos += 2
+            continue
+        length = shift = 0
+        while True:
+            pos += 1
+            byte = data[pos]
+            length |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        pos += 1
+        payload = data[pos:pos + length]
+        pos += length
+        if kind == _TEXT:
+            parts.append(payload.decode('utf-8'))
+        elif kind == _HEX:
+            parts.append(payload.hex())
+        else:
+            parts.append(payload.hex()[1:])
+    return "".join(parts)
+
+
+class MessageRecords(Sequence):
+    """
+    One conversation's history entries ("sender: text" strings), stored
+    compactly. Supports what the history list was used for: indexing,
+    len, iteration, append/extend and comparison with a list.
+    """
+    def __init__(self, senders, entries=()):
+        self.senders = senders
+        self.sender_ids = array('I')
+        self.timestamps = array('d')
+        self.offsets = array('Q', [0])  # body i is data[offsets[i]:offsets[i + 1]]
+        self.data = bytearray()
+        self.extend(entries)
+
+    def append(self, entry, timestamp=0.0):
+        sender, sep, text = entry.partition(": ")
+        if sep:
+            self.sender_ids.append(self.senders.id(sender))
+        else:
+            self.sender_ids.append(NO_SENDER)
+            text = entry
+        self.timestamps.append(timestamp)
+        self.data += encode_body(text)
+        self.offsets.append(len(self.data))
+
+    def extend(self, entries, timestamp=0.0):
+        for entry in entries:
+            self.append(entry, timestamp)
+
+    def __len__(self):
+        return len(self.sender_ids)
+
+    def sender(self, index):
+        """The entry's sender, or None for entries without one."""
+        sender_id = self.sender_ids[index]
+        return None if sender_id == NO_SENDER else self.senders.name(sender_id)
+
+    def timestamp(self, index):
+        return self.timestamps[index]
+
+    def text(self, index):
+        if index < 0:
+            index += len(self)
+        return decode_body(self.data[self.offsets[index]:self.offsets[index + 1]])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        sender = self.sender(index)
+        text = self.text(index)
+        return text if sender is None else f"{sender}: {text}"
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence) or isinstance(other, str):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"MessageRecords({list(self)!r})"
+
+    def nbytes(self):
+        """Bytes held by the columns and bodies (not counting the shared sender names)."""
+        return sum(column.itemsize * len(column) for column in (self.sender_ids, self.timestamps, self.offsets)) + len(self.data)
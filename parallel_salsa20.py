@@ -0,0 +1,101 @@
+# parallel_salsa20.py
+"""
+Salsa20 over several cores for large buffers.
+
+Salsa20 blocks only depend on (key, nonce, counter), so a buffer can be cut
+into block-aligned ranges that worker processes encrypt independently, each
+starting its keystream at the range's counter. The buffer is copied once
+into shared memory; every worker XORs its range in place there, so neither
+the input nor the output is pickled between processes.
+
+Buffers under PARALLEL_MIN_BYTES, or a single worker, take the serial path:
+for those, starting the work in other processes costs more than it saves.
+VIBER_CRYPTO_WORKERS sets the number of worker processes (default: one
+per core).
+"""
+import atexit
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from encryption import Salsa20Cipher
+
+PARALLEL_MIN_BYTES = 256 * 1024   # smaller buffers are encrypted in this process
+BLOCK_SIZE = 64                   # bytes of keystream per Salsa20 counter value
+
+_pool = None
+_pool_workers = 0
+
+
+def default_workers():
+    return int(os.environ.get('VIBER_CRYPTO_WORKERS') or os.cpu_count() or 1)
+
+
+def _get_pool(workers):
+    """The shared worker pool, recreated if a different size is asked for."""
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        if _pool is not None:
+            _pool.shutdown()
+        # spawn: forking a process that runs Qt and socket threads is not safe
+        _pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        _pool_workers = workers
+    return _pool
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+atexit.register(shutdown)
+
+
+def _xor_range(shm_name, start, end, key, nonce, counter):
+    """Worker: XORs buffer[start:end] with the keystream from `counter` on, in place."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        view = shm.buf[start:end]
+        view[:] = Salsa20Cipher(key, nonce, counter=counter).encrypt(view)
+        view.release()
+    finally:
+        shm.close()
+
+
+def split_ranges(length, parts):
+    """Cuts [0, length) into at most `parts` block-aligned (start, end) ranges of similar size."""
+    blocks = (length + BLOCK_SIZE - 1) // BLOCK_SIZE
+    parts = max(1, min(parts, blocks))
+    per_part, extra = divmod(blocks, parts)
+    ranges = []
+    start = 0
+    for i in range(parts):
+        end = min(start + (per_part + (i < extra)) * BLOCK_SIZE, length)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def salsa20_xor(key, nonce, data, counter=0, workers=None):
+    """
+    XORs `data` with the Salsa20 keystream for (key, nonce) starting at block
+    `counter`; encryption and decryption are the same operation.
+    """
+    workers = workers or default_workers()
+    if workers < 2 or len(data) < PARALLEL_MIN_BYTES:
+        return Salsa20Cipher(key, nonce, counter=counter).encrypt(data)
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    try:
+        shm.buf[:len(data)] = data
+        pool = _get_pool(workers)
+        futures = [
+            pool.submit(_xor_range, shm.name, start, end, key, nonce, counter + start // BLOCK_SIZE)
+            for start, end in split_ranges(len(data), workers)
+        ]
+        for future in futures:
+            future.result()
+        return bytes(shm.buf[:len(data)])
+    finally:
+        shm.close()
+        shm.unlink()
@@ -0,0 +1,60 @@
+# presence.py
+
+class PresenceRegistry:
+    """
+    Bidirectional map of who is online on the /chat namespace.
+
+    Keeps two indexes that are updated together:
+      - username -> set of session IDs (one per connected device)
+      - session ID -> username
+
+    Every operation is O(1) (amortised), and a username is removed as soon as
+    its last session goes away, so the registry only ever holds live sessions.
+    """
+    def __init__(self):
+        self.user_sids = {}  # maps usernames to sets of session IDs
+        self.sid_users = {}  # maps session IDs back to usernames
+
+    def register(self, username, sid):
+        """
+        Binds a session to a username. If the session was previously bound
+        to a different user, that binding is dropped first.
+        """
+        previous = self.sid_users.get(sid)
+        if previous == username:
+            return
+        if previous is not None:
+            self.unregister(sid)
+        self.sid_users[sid] = username
+        self.user_sids.setdefault(username, set()).add(sid)
+
+    def unregister(self, sid):
+        """
+        Removes a session. Returns the username it belonged to (or None).
+        """
+        username = self.sid_users.pop(sid, None)
+        if username is None:
+            return None
+        sids = self.user_sids.get(username)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del self.user_sids[username]
+        return username
+
+    def sids_for(self, username):
+        """Returns a snapshot of the session IDs for a user (empty if offline)."""
+        return tuple(self.user_sids.get(username, ()))
+
+    def username_for(self, sid):
+        return self.sid_users.get(sid)
+
+    def is_online(self, username):
+        return username in self.user_sids
+
+    def online_users(self):
+        return list(self.user_sids)
+
+    def __len__(self):
+        """Number of live sessions."""
+        return len(self.sid_users)
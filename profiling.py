@@ -0,0 +1,209 @@
+# profiling.py
+"""
+Opt-in timing of the client's send/receive pipeline.
+
+Enabled with VIBER_PROFILE=1 (0, false, no and off leave it disabled). Code wraps each stage in `with stage("name"):`;
+the durations are aggregated per stage into log2 histograms (bucket i holds
+durations in [2^i, 2^(i+1)) microseconds) and a report is printed at exit,
+and written to VIBER_PROFILE_REPORT if that names a file. When profiling is
+off, stage() returns a shared no-op context manager, so an instrumented call
+costs one function call and one attribute check.
+
+VIBER_PROFILE_CAPTURE=cprofile or tracemalloc additionally records a capture
+window of VIBER_PROFILE_CAPTURE_SECONDS (default 30) seconds, starting at the
+first stage timed on the main (Qt) thread. cProfile only sees that thread;
+tracemalloc sees every thread. Any other capture kind is reported once and
+ignored.
+"""
+import atexit
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+HISTOGRAM_BUCKETS = 32
+CAPTURE_TOP = 25   # functions / allocation sites listed in a capture report
+CAPTURE_KINDS = ('cprofile', 'tracemalloc')
+
+
+def env_flag(name):
+    """True if the environment variable is set to anything but empty, 0, false, no or off."""
+    return os.environ.get(name, '').strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+def env_seconds(name, default):
+    """A positive number of seconds from the environment variable, or `default` if it is unset or invalid."""
+    value = os.environ.get(name, '').strip()
+    if not value:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = None
+    if seconds is None or not 0 < seconds < float('inf'):
+        print(f"DEBUG: Ignoring {name}={value!r} (expected a positive number of seconds); using {default}")
+        return default
+    return seconds
+
+
+class StageStats:
+    """Count, total, maximum and log2 histogram of one stage's durations."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        bucket = min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.buckets[bucket] += 1
+
+    def percentile(self, fraction):
+        """Upper bound, in seconds, of the bucket holding the given fraction of samples."""
+        target = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return min((1 << bucket) / 1e6, self.max)
+        return self.max
+
+
+class _Stage:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.check_capture()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+class Profiler:
+    def __init__(self, enabled=False, capture=None, capture_seconds=30):
+        self.enabled = enabled
+        self.stats = {}
+        self.lock = threading.Lock()
+        if capture is not None and capture not in CAPTURE_KINDS:
+            print(f"DEBUG: Unknown profile capture {capture!r} (expected one of {', '.join(CAPTURE_KINDS)}); capture disabled")
+            capture = None
+        self.capture_kind = capture          # pending or running capture
+        self.capture_seconds = capture_seconds
+        self.capture_until = None            # set while a capture runs
+        self.capture_thread = None
+        self.capture_report = ""
+        self._cprofile = None
+        self._snapshot = None
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name)
+
+    def record(self, name, seconds):
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = StageStats()
+            stats.add(seconds)
+
+    def check_capture(self):
+        """Starts a pending capture on the main thread, or ends one whose window is over."""
+        if self.capture_kind is None:
+            return
+        if self.capture_until is None:
+            if threading.current_thread() is threading.main_thread():
+                self.start_capture(self.capture_kind, self.capture_seconds)
+        elif time.perf_counter() >= self.capture_until and threading.get_ident() == self.capture_thread:
+            self.stop_capture()
+
+    def start_capture(self, kind, seconds):
+        """Captures a cProfile profile (this thread) or tracemalloc allocations for `seconds`."""
+        if kind not in CAPTURE_KINDS:
+            raise ValueError(f"Unknown capture kind: {kind}")
+        self.capture_kind = kind
+        self.capture_until = time.perf_counter() + seconds
+        self.capture_thread = threading.get_ident()
+        if kind == 'cprofile':
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        else:
+            tracemalloc.start()
+            self._snapshot = tracemalloc.take_snapshot()
+
+    def stop_capture(self):
+        if self.capture_until is None:
+            return
+        out = io.StringIO()
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            pstats.Stats(self._cprofile, stream=out).sort_stats('cumulative').print_stats(CAPTURE_TOP)
+            self._cprofile = None
+        elif self._snapshot is not None:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            for stat in snapshot.compare_to(self._snapshot, 'lineno')[:CAPTURE_TOP]:
+                print(stat, file=out)
+            self._snapshot = None
+        self.capture_report = f"-- {self.capture_kind} capture --\n{out.getvalue()}"
+        self.capture_kind = self.capture_until = self.capture_thread = None
+
+    def report(self):
+        lines = [f"{'stage':<24} {'count':>7} {'mean':>10} {'p50':>10} {'p95':>10} {'p99':>10} {'max':>10}"]
+        with self.lock:
+            stats = sorted(self.stats.items())
+        for name, s in stats:
+            times = [s.total / s.count, s.percentile(0.5), s.percentile(0.95), s.percentile(0.99), s.max]
+            lines.append(f"{name:<24} {s.count:>7} " + " ".join(f"{t * 1e3:>7.2f} ms" for t in times))
+        if self.capture_report:
+            lines.append(self.capture_report)
+        return "\n".join(lines)
+
+    def dump(self, path=None):
+        """Prints the report (ending any running capture), and writes it to `path` if given."""
+        if threading.get_ident() == self.capture_thread or self.capture_kind == 'tracemalloc':
+            self.stop_capture()
+        report = self.report()
+        print("PROFILE:\n" + report)
+        if path:
+            with open(path, 'w') as f:
+                f.write(report + "\n")
+
+
+profiler = Profiler(
+    enabled=env_flag('VIBER_PROFILE'),
+    capture=os.environ.get('VIBER_PROFILE_CAPTURE') or None,
+    capture_seconds=env_seconds('VIBER_PROFILE_CAPTURE_SECONDS', 30)
+)
+if profiler.enabled:
+    atexit.register(profiler.dump, os.environ.get('VIBER_PROFILE_REPORT'))
+
+
+def stage(name):
+    """Context manager timing one pipeline stage (a no-op unless VIBER_PROFILE is set)."""
+    return profiler.stage(name)
@@ -0,0 +1,94 @@
+# rate_limit.py
+import time
+
+
+class TokenBucket:
+    """
+    Allows `rate` events per second on average, with bursts of up to `burst`.
+    Tokens are refilled lazily when the bucket is used, so an idle bucket costs nothing.
+    """
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, tokens=1):
+        """Takes `tokens` from the bucket. Returns False (taking nothing) if there are not enough."""
+        self._refill()
+        if tokens > self.tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def take(self, tokens):
+        """Takes as many whole tokens as the bucket has, up to `tokens`, and returns how many."""
+        self._refill()
+        taken = min(tokens, int(self.tokens))
+        self.tokens -= taken
+        return taken
+
+    def refund(self, tokens):
+        """Puts back tokens that were taken but not used."""
+        self.tokens = min(self.burst, self.tokens + tokens)
+
+    def wait(self, tokens=1):
+        """Seconds until the bucket has `tokens` again."""
+        self._refill()
+        return max(0.0, (min(tokens, self.burst) - self.tokens) / self.rate)
+
+    def idle(self):
+        """True once the bucket has refilled to its burst, when forgetting it changes nothing."""
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class RateLimiter:
+    """One TokenBucket per key (a session ID or a username)."""
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.buckets = {}
+
+    def _bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, self.clock)
+        return bucket
+
+    def allow(self, key, tokens=1):
+        return self._bucket(key).consume(tokens)
+
+    def take(self, key, tokens):
+        """Admits as many of `tokens` events as the key's bucket allows and returns how many."""
+        return self._bucket(key).take(tokens)
+
+    def refund(self, key, tokens):
+        bucket = self.buckets.get(key)
+        if bucket is not None and tokens:
+            bucket.refund(tokens)
+
+    def wait(self, key, tokens=1):
+        """Seconds until `tokens` events of the key would be admitted."""
+        bucket = self.buckets.get(key)
+        return 0.0 if bucket is None else bucket.wait(tokens)
+
+    def prune(self):
+        """Forgets the buckets that have refilled, and returns how many."""
+        idle = [key for key, bucket in self.buckets.items() if bucket.idle()]
+        for key in idle:
+            del self.buckets[key]
+        return len(idle)
+
+    def forget(self, key):
+        self.buckets.pop(key, None)
+
+    def __len__(self):
+        return len(self.buckets)
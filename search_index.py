@@ -0,0 +1,116 @@
+# search_index.py
+import hashlib
+import os
+import sqlite3
+import threading
+from encryption import EncryptionManager
+
+SEARCH_INDEX_AAD = b"search-index"
+TAG_SIZE = 16
+
+SEARCH_SAVE_EVERY = 50   # write the index to disk after this many new messages
+
+
+def index_key_for(private_key):
+    """Derives the 32-byte index encryption key from the user's RSA private key."""
+    return hashlib.sha256(f"search-index:{private_key.n},{private_key.d}".encode('utf-8')).digest()
+
+
+def _fts_query(query):
+    """Turns free text into an FTS5 query: every word must match, as a prefix."""
+    terms = query.split()
+    return " ".join('"' + term.replace('"', '""') + '"*' for term in terms)
+
+
+class SearchIndex:
+    """
+    Full-text index over decrypted chat messages.
+
+    The index lives in an in-memory SQLite FTS5 table, so queries never touch
+    the encrypted archive. On disk it is stored as the serialized database,
+    sealed with Salsa20-Poly1305 under a key derived from the user's private
+    key (file layout: 8-byte nonce + ciphertext + 16-byte tag), so a
+    modified file is discarded rather than loaded. Message IDs are
+    (contact, position in that contact's chat history).
+    """
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # one save at a time, each writing the latest snapshot
+        self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+        self._load()
+        self.conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages
+            USING fts5(body, contact UNINDEXED, message_index UNINDEXED)
+        """)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        try:
+            plaintext = EncryptionManager(self.key).open_raw(data[:-TAG_SIZE], data[-TAG_SIZE:], SEARCH_INDEX_AAD)
+            if not plaintext.startswith(b"SQLite format 3\x00"):
+                raise ValueError("wrong key or not an index file")
+            self.conn.deserialize(plaintext)
+            self.conn.execute("PRAGMA quick_check").fetchone()
+        except (sqlite3.DatabaseError, ValueError) as ex:
+            # Wrong key or corrupt file: start over, the index is rebuilt as messages arrive.
+            print("DEBUG: Discarding unreadable search index:", ex)
+            self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+
+    def add(self, contact, message_index, text):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO messages (body, contact, message_index) VALUES (?, ?, ?)",
+                (text, contact, message_index)
+            )
+            self.pending += 1
+            due = self.pending >= SEARCH_SAVE_EVERY
+            if due:
+                self.pending = 0  # claimed: no other thread starts a save for the same messages
+        if due:
+            self.save()
+
+    def search(self, query, limit=50):
+        """
+        Returns up to `limit` matches, best first, as (contact, message_index, text).
+        """
+        match = _fts_query(query)
+        if not match:
+            return []
+        with self.lock:
+            cursor = self.conn.execute("""
+                SELECT contact, message_index, body
+                FROM messages
+                WHERE messages MATCH ?
+                ORDER BY rank
+                LIMIT ?
+            """, (match, limit))
+            return cursor.fetchall()
+
+    def remove_contact(self, contact):
+        with self.lock:
+            self.conn.execute("DELETE FROM messages WHERE contact = ?", (contact,))
+            self.pending += 1
+
+    def save(self):
+        """Seals the serialized index and atomically replaces the file on disk."""
+        with self.save_lock:
+            with self.lock:
+                self.conn.commit()  # FTS5 keeps pending index data in memory until commit
+                data = self.conn.serialize()
+                self.pending = 0
+            sealed, tag = EncryptionManager(self.key).seal_raw(data, SEARCH_INDEX_AAD)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(sealed + tag)
+            os.replace(tmp_path, self.path)
+
+    def close(self):
+        if self.pending:
+            self.save()
+        self.conn.close()
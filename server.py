@@ -1,68 +1,772 @@
-from flask import Flask, request
-from flask_socketio import SocketIO, Namespace, emit
-from database import add_offline_message, get_offline_messages, delete_offline_messages
-
-app = Flask(__name__)
-socketio = SocketIO(app)
-
-class ChatNamespace(Namespace):
-    def __init__(self, namespace=None):
-        super().__init__(namespace)
-        self.sessions = {}  # maps usernames to session IDs
-        self.message_queue = {}  # store undelivered messages if needed
-
-    def on_connect(self):
-        print("DEBUG: Client connected to /chat namespace (sid:", request.sid, ")")
-
-    def on_disconnect(self):
-        print("DEBUG: Client disconnected from /chat namespace (sid:", request.sid, ")")
-        # Optionally find which user had this SID and remove them.
-
-    def on_register(self, data):
-        """
-        Expects data = {'username': <the_user>}
-        """
-        print("DEBUG: on_register event triggered with data:", data)
-        username = data.get('username')
-        if username:
-            self.sessions[username] = request.sid
-            print("DEBUG: Registered user:", username, "with session:", request.sid)
-            # Send any offline messages
-            undelivered = get_offline_messages(username)
-            for msg in undelivered:
-                # msg = (sender, message_text)
-                self.emit('message', {'text': msg[1], 'recipient': username}, room=request.sid)
-            delete_offline_messages(username)
-        else:
-            print("DEBUG: Register event missing username")
-
-    def on_message(self, data):
-        """
-        Expects data = {
-          'text': 'alice: {...encrypted JSON...}',
-          'recipient': 'bob',
-          'sender': 'alice'
-        }
-        """
-        print("DEBUG: on_message called with data:", data)
-        print("DEBUG: Current sessions:", self.sessions)
-        recipient = data.get('recipient')
-        recipient_sid = self.sessions.get(recipient)
-        print("DEBUG: Message received for recipient:", recipient, "SID:", recipient_sid)
-
-        if recipient_sid:
-            # The recipient is connected
-            emit('message', data['text'], room=recipient_sid)
-            print("DEBUG: Message emitted to recipient in real-time.")
-        else:
-            # The recipient is offline => store offline
-            sender = data.get('sender', '')
-            add_offline_message(recipient, sender, data['text'])
-            print("DEBUG: Recipient offline, message stored offline.")
-
-
-socketio.on_namespace(ChatNamespace('/chat'))
-
-if __name__ == '__main__':
-    print("DEBUG: Starting server on port 5000")
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True)
+from flask import Flask, request, jsonify, abort
+from flask_socketio import SocketIO, Namespace, emit, disconnect, join_room, leave_room, rooms
+from collections import Counter
+from functools import wraps
+import hmac
+import os
+import threading
+import time
+from database import (
+    take_offline_messages,
+    add_group, get_group_members, get_user_groups,
+    enable_incremental_vacuum, compact_offline_messages, get_offline_queue_stats,
+    compact_message_log, get_message_log_heads, get_message_log_page, get_password_hash
+)
+from key_directory import KEY_LOOKUP_MAX, lookup_keys, directory_etag
+from session_tokens import issue_token, verify_token
+from presence import PresenceRegistry
+from delivery import DeliveryWindow
+from rate_limit import RateLimiter
+from write_behind import OfflineWriteQueue, MessageLogQueue
+
+OFFLINE_COMPACTION_INTERVAL = 15 * 60  # seconds between offline-store compactions
+MAX_PAYLOAD_BYTES = 256 * 1024   # largest message text (or file chunk) accepted
+SID_RATE, SID_BURST = 20, 100    # messages per second per connection, and burst
+USER_RATE, USER_BURST = 40, 200  # messages per second per user across devices
+FILE_RATE, FILE_BURST = 100, 200 # file transfer events per second per connection, and burst
+OUTBOUND_QUEUE_LIMIT = 500       # unacked messages per recipient before the slow-consumer policy applies
+SLOW_CONSUMER_POLICY = "spill"   # "spill" to the offline store, "drop", or "disconnect" the recipient
+SYNC_PAGE_SIZE = 200             # message log entries per 'sync_page'
+DELIVERY_STATE_TTL = 24 * 3600   # seconds a user may stay away before its sequence state is dropped
+# Bearer token for the /stats endpoints; without one they only answer local requests
+STATS_TOKEN = os.environ.get('VIBER_STATS_TOKEN')
+
+app = Flask(__name__)
+socketio = SocketIO(app)
+
+def text_size(data):
+    """Size in bytes of the UTF-8 encoded 'text' of an event."""
+    return len(str(data.get('text', '')).encode('utf-8'))
+
+def valid_message(data, target='recipient'):
+    """True for a message payload: a dict with a str 'text' and a str `target` ('recipient' or 'group')."""
+    return isinstance(data, dict) and isinstance(data.get('text'), str) and isinstance(data.get(target), str)
+
+def sent_by(data, sender):
+    """True if the message text starts with the "<sender>: " prefix that clients read its author from."""
+    return data['text'].startswith(f"{sender}: ")
+
+def group_room(group_name):
+    """The Socket.IO room of a group, which is also the owner of its message log."""
+    return f"group:{group_name}"
+
+class ChatNamespace(Namespace):
+    def __init__(self, namespace=None):
+        super().__init__(namespace)
+        self.presence = PresenceRegistry()  # usernames <-> session IDs (one per device)
+        self.delivery = DeliveryWindow()  # sequence numbers and unacked messages per user
+        self.message_queue = {}  # store undelivered messages if needed
+        self.transfers = {}  # maps file transfer IDs to their sender/recipient session IDs
+        self.sid_limits = RateLimiter(SID_RATE, SID_BURST)
+        self.user_limits = RateLimiter(USER_RATE, USER_BURST)  # kept across reconnects until idle
+        self.file_limits = RateLimiter(FILE_RATE, FILE_BURST)
+        self.spilled = Counter()  # spills to the offline store per user while online
+        self.counters = Counter()  # throttled / rejected / overflowed events
+        self.sync_sids = set()  # sessions that fetch history from the message log
+        # Logging a message and numbering its deliveries happen under one lock, so
+        # every conversation is delivered in message log order. Neither waits
+        # for sqlite: log ids are handed out in memory and the rows committed
+        # in groups by log_writes.
+        self.route_lock = threading.Lock()
+        # One offline delivery at a time, so taken rows are numbered in order
+        self.drain_lock = threading.Lock()
+        # Offline-message inserts from every handler, committed in groups
+        self.offline_writes = OfflineWriteQueue()
+        self.log_writes = MessageLogQueue()
+
+    def _admit(self, event, size, payloads):
+        """
+        Checks an incoming event against the payload limit and the rate limits
+        of its session and user. `payloads` are the messages it carries (one,
+        or the envelopes of a batch): returns how many of them, from the
+        start, may go through. The client gets the rest back in a 'throttled'
+        event = {'event', 'reason', 'retry': [payload, ...], 'retry_after': seconds}
+        to send again; an oversized event is refused without 'retry'.
+        """
+        if size > MAX_PAYLOAD_BYTES:
+            self.counters['oversized'] += 1
+            emit('throttled', {'event': event, 'reason': 'payload too large'})
+            print("DEBUG: Dropped", event, "from", request.sid, "- payload too large")
+            return 0
+        admitted = self.sid_limits.take(request.sid, len(payloads))
+        limits, key, counter = self.sid_limits, request.sid, 'throttled_sid'
+        username = self.presence.username_for(request.sid)
+        if username is not None:
+            by_user = self.user_limits.take(username, admitted)
+            self.sid_limits.refund(request.sid, admitted - by_user)
+            if by_user < admitted:
+                limits, key, counter = self.user_limits, username, 'throttled_user'
+            admitted = by_user
+        if admitted < len(payloads):
+            retry = payloads[admitted:]
+            self.counters[counter] += 1
+            emit('throttled', {'event': event, 'reason': 'rate limited', 'retry': retry,
+                               'retry_after': limits.wait(key, len(retry))})
+            print("DEBUG: Throttled", len(retry), "of", len(payloads), event, "messages from", request.sid)
+        return admitted
+
+    def _admit_file(self, event, data):
+        """
+        Rate limits the file transfer events of a session, which have their
+        own budget. A throttled chunk is not sent back: the 'throttled' event
+        names its transfer and the sender resumes after the last acked chunk.
+        """
+        if self.file_limits.allow(request.sid):
+            return True
+        self.counters['throttled_file'] += 1
+        throttled = {'event': event, 'reason': 'rate limited', 'retry_after': self.file_limits.wait(request.sid)}
+        if event == 'file_chunk':
+            throttled['transfer_id'] = data.get('transfer_id')
+        else:
+            throttled['retry'] = [data]
+        emit('throttled', throttled)
+        print("DEBUG: Throttled", event, "from", request.sid)
+        return False
+
+    def _sequence(self, recipient, recipient_sids, conversation, sender, entries):
+        """
+        Numbers `entries` ((text, log_id, prev_log_id) tuples) for a recipient
+        as far as its unacked window allows and returns the envelopes to emit.
+        The rest is handled by SLOW_CONSUMER_POLICY. While a recipient has
+        spilled messages, new ones spill behind them, so they stay in order.
+        """
+        room = self._room(recipient)
+        envelopes = [self.delivery.envelope(recipient, conversation, *entry) for entry in entries[:room]]
+        overflow = [text for text, _, _ in entries[room:]]
+        if overflow and self._overflow(recipient, recipient_sids, sender, overflow):
+            return []
+        return envelopes
+
+    def _room(self, recipient):
+        """How many more messages the recipient's window takes (none while it has spilled messages)."""
+        if recipient in self.spilled:
+            return 0
+        return max(OUTBOUND_QUEUE_LIMIT - self.delivery.unacked_count(recipient), 0)
+
+    def _overflow(self, recipient, recipient_sids, sender, texts):
+        """
+        Applies SLOW_CONSUMER_POLICY to messages that do not fit in the
+        recipient's window. Returns True if the recipient was disconnected.
+        """
+        self.counters['slow_consumer_' + SLOW_CONSUMER_POLICY] += len(texts)
+        print("DEBUG: Outbound queue full for", recipient, "-", SLOW_CONSUMER_POLICY, len(texts), "messages")
+        if SLOW_CONSUMER_POLICY == "drop":
+            emit('delivery_failed', {'recipient': recipient, 'reason': 'recipient too slow'})
+            return False
+        # Spill to the offline store; it is delivered once the window drains
+        # (or, with "disconnect", when the recipient registers again).
+        self.offline_writes.put([(recipient, sender, text) for text in texts])
+        self.spilled[recipient] += 1
+        if SLOW_CONSUMER_POLICY == "disconnect":
+            for sid in recipient_sids:
+                disconnect(sid=sid, namespace=self.namespace)
+            return True
+        return False
+
+    def _take_offline(self, username):
+        """
+        Commits the queued offline writes and takes the user's messages out of
+        the offline store. When every session of the user syncs history, only
+        the offline messages missing from the message log (stored before it
+        existed) are returned; the devices fetch the rest with 'sync'.
+        Returns (messages, syncing, spills), `spills` being the user's spill
+        count before the read.
+        """
+        with self.route_lock:
+            spills = self.spilled[username]
+        self.offline_writes.flush()
+        sids = self.presence.sids_for(username)
+        syncing = bool(sids) and all(sid in self.sync_sids for sid in sids)
+        return take_offline_messages(username, logged=not syncing), syncing, spills
+
+    def _deliver_offline(self, username, prepare=None):
+        """
+        Sends the user's offline messages in one batched frame, after the
+        envelopes prepare() returns (it runs under route_lock). The store is
+        read outside route_lock and only the numbering happens under it.
+        Messages spilled after the read wait for the next ack, or go out
+        straight away when nothing unacked would bring one. Returns True if
+        the devices sync history (see _take_offline).
+        """
+        with self.drain_lock:
+            while True:
+                messages, syncing, spills = self._take_offline(username)
+                with self.route_lock:
+                    envelopes = prepare() if prepare is not None else []
+                    prepare = None
+                    for sender, message_text in messages:
+                        envelopes.append(self.delivery.envelope(username, sender, message_text))
+                    if self.spilled[username] == spills:
+                        self.spilled.pop(username, None)
+                    if envelopes:
+                        for sid in self.presence.sids_for(username):
+                            self.emit('message_batch', envelopes, room=sid)
+                    again = username in self.spilled and not self.delivery.unacked_count(username)
+                if not again:
+                    return syncing
+
+    def _store_offline(self, messages):
+        """
+        Queues (recipient, sender, text) tuples for the offline store. Once
+        they are committed the sending session gets 'stored' = {recipient:
+        count} for the messages that are durable, and a 'delivery_failed'
+        per recipient whose quota rejected some.
+        """
+        sid = request.sid
+
+        def stored(results):
+            counts = Counter()
+            rejected = set()
+            for (recipient, _, _), ok in zip(messages, results):
+                if ok:
+                    counts[recipient] += 1
+                else:
+                    rejected.add(recipient)
+            if counts:
+                self.emit('stored', dict(counts), room=sid)
+            for recipient in rejected:
+                self.emit('delivery_failed', {'recipient': recipient, 'reason': 'offline quota exceeded'}, room=sid)
+            print("DEBUG: Stored", sum(counts.values()), "messages offline,", len(messages) - sum(counts.values()), "rejected")
+        self.offline_writes.put(messages, stored)
+
+    def _malformed(self, event):
+        """Drops a payload of the wrong shape and tells the client."""
+        self.counters['malformed'] += 1
+        emit('message_error', {'event': event, 'reason': 'malformed payload'})
+        print("DEBUG: Dropped malformed", event, "from", request.sid)
+
+    def _forged(self, event, sender):
+        """Drops a message whose text names another author than the session's registered user."""
+        self.counters['forged_sender'] += 1
+        emit('message_error', {'event': event, 'reason': 'sender mismatch'})
+        print("DEBUG: Dropped", event, "from", sender, "carrying another sender's name")
+
+    def _sender(self, event):
+        """
+        The registered username of this session. Messages from sockets that
+        have not registered are dropped (None): a claimed 'sender' field is
+        not trusted.
+        """
+        sender = self.presence.username_for(request.sid)
+        if sender is None:
+            print("DEBUG: Dropped", event, "from unregistered sid:", request.sid)
+        return sender
+
+    def _emit_copies(self, sender, conversation, entries):
+        """Sends the sender's devices their own message log entries."""
+        sender_sids = [sid for sid in self.presence.sids_for(sender) if sid in self.sync_sids]
+        if sender_sids:
+            envelopes = self._sequence(sender, sender_sids, conversation, sender, entries)
+            if envelopes:
+                for sid in sender_sids:
+                    self.emit('message_batch', envelopes, room=sid)
+
+    def on_connect(self):
+        print("DEBUG: Client connected to /chat namespace (sid:", request.sid, ")")
+
+    def on_disconnect(self):
+        print("DEBUG: Client disconnected from /chat namespace (sid:", request.sid, ")")
+        username = self.presence.unregister(request.sid)
+        self.sid_limits.forget(request.sid)
+        self.file_limits.forget(request.sid)
+        self.sync_sids.discard(request.sid)
+        if username:
+            print("DEBUG: Removed session for user:", username)
+            if not self.presence.is_online(username):
+                with self.route_lock:
+                    self.delivery.disconnected(username, time.time())
+        # Transfers through this session resume once the sender offers them
+        # again (on its own reconnect, or when the recipient sends 'file_resume').
+        for transfer_id, transfer in list(self.transfers.items()):
+            if request.sid in (transfer['sender_sid'], transfer['recipient_sid']):
+                del self.transfers[transfer_id]
+
+    def on_register(self, data):
+        """
+        Expects data = {'username': <the_user>, 'token': <session token>, 'sync': True}
+        The token comes from /auth/login or /auth/refresh and must belong to
+        the username; otherwise the client gets 'auth_failed'. 'sync' marks a
+        client that fetches missed messages with 'sync' events instead of
+        having the offline queue pushed to it.
+        """
+        print("DEBUG: on_register event triggered for:", data.get('username'))
+        username = data.get('username')
+        if username and verify_token(data.get('token')) != username:
+            self.counters['auth_failed'] += 1
+            emit('auth_failed', {'reason': 'invalid or expired session token'})
+            print("DEBUG: Register with an invalid session token for:", username)
+        elif username:
+            if self.presence.username_for(request.sid) not in (None, username):
+                # The session changes users; it leaves the previous user's groups
+                for room in rooms():
+                    if room.startswith(group_room('')):
+                        leave_room(room)
+            self.presence.register(username, request.sid)
+            if data.get('sync'):
+                self.sync_sids.add(request.sid)
+            print("DEBUG: Registered user:", username, "with session:", request.sid)
+            groups = get_user_groups(username)
+            for group_name in groups:
+                join_room(group_room(group_name))
+            # Tell the client where each conversation's sequence numbers stand,
+            # then resend what it has not acked plus any offline messages in a
+            # single batched frame
+            def resume():
+                self.delivery.connected(username)
+                emit('delivery_state', {'epoch': self.delivery.epoch, 'delivered': self.delivery.delivered(username, groups)})
+                return list(self.delivery.pending(username))
+            self._deliver_offline(username, resume)
+        else:
+            print("DEBUG: Register event missing username")
+
+    def on_message(self, data):
+        """
+        Expects data = {
+          'text': 'alice: {...encrypted JSON...}',
+          'recipient': 'bob',
+          'sender': 'alice'
+        }
+        The text must start with the session's registered username: clients
+        take the author from that prefix, not from 'sender'.
+        """
+        sender = self._sender('message')
+        if sender is None:
+            return
+        if not valid_message(data):
+            self._malformed('message')
+            return
+        if not sent_by(data, sender):
+            self._forged('message', sender)
+            return
+        if not self._admit('message', text_size(data), [data]):
+            return
+        print("DEBUG: on_message called with data:", data)
+        recipient = data.get('recipient')
+        recipient_sids = self.presence.sids_for(recipient)
+        print("DEBUG: Message received for recipient:", recipient, "SIDs:", recipient_sids)
+
+        with self.route_lock:
+            # Logged for both sides; the sender's devices get a copy so they stay in sync
+            (log_id, prev_id), (sender_log_id, sender_prev_id) = self.log_writes.append([
+                (recipient, sender, data['text']),
+                (sender, recipient, data['text'])
+            ])
+            self._emit_copies(sender, recipient, [(data['text'], sender_log_id, sender_prev_id)])
+            if recipient_sids:
+                envelopes = self._sequence(recipient, recipient_sids, sender, sender, [(data['text'], log_id, prev_id)])
+        if recipient_sids:
+            # The recipient is connected, possibly on several devices
+            for envelope in envelopes:
+                for sid in recipient_sids:
+                    emit('message', envelope, room=sid)
+                print("DEBUG: Message emitted to recipient in real-time, seq", envelope['seq'])
+        else:
+            # The recipient is offline => store offline
+            self._store_offline([(recipient, sender, data['text'])])
+
+    def on_message_batch(self, data):
+        """
+        Expects data = [envelope, ...], each envelope shaped like the data of
+        a 'message' event. Every online recipient gets one 'message_batch'
+        frame with the sequenced envelopes in order; the messages for offline
+        recipients go to the offline store together. Envelopes past the rate
+        limit are sent back in 'throttled' to be sent again.
+        """
+        sender = self._sender('message_batch')
+        if sender is None:
+            return
+        if not isinstance(data, list) or not all(valid_message(envelope) for envelope in data):
+            self._malformed('message_batch')
+            return
+        if not all(sent_by(envelope, sender) for envelope in data):
+            self._forged('message_batch', sender)
+            return
+        size = sum(text_size(envelope) for envelope in data)
+        data = data[:self._admit('message_batch', size, data)]
+        if not data:
+            return
+        print("DEBUG: on_message_batch called with", len(data), "messages")
+        by_recipient = {}
+        for envelope in data:
+            by_recipient.setdefault(envelope.get('recipient'), []).append(envelope['text'])
+
+        offline = []
+        with self.route_lock:
+            # Both sides of every message are logged
+            log_entries = []
+            for recipient, texts in by_recipient.items():
+                log_entries.extend((recipient, sender, text) for text in texts)
+                log_entries.extend((sender, recipient, text) for text in texts)
+            log_ids = iter(self.log_writes.append(log_entries))
+            for recipient, texts in by_recipient.items():
+                entries = [(text,) + next(log_ids) for text in texts]
+                copies = [(text,) + next(log_ids) for text in texts]
+                self._emit_copies(sender, recipient, copies)
+                recipient_sids = self.presence.sids_for(recipient)
+                if recipient_sids:
+                    # Envelopes are numbered in the sender's conversation
+                    sequenced = self._sequence(recipient, recipient_sids, sender, sender, entries)
+                    if sequenced:
+                        for sid in recipient_sids:
+                            emit('message_batch', sequenced, room=sid)
+                else:
+                    offline.extend((recipient, sender, text) for text in texts)
+
+        if offline:
+            self._store_offline(offline)
+
+    def on_create_group(self, data):
+        """
+        Expects data = {'group': 'friends', 'members': ['alice', 'bob', ...]}
+        The creator is always added as a member. For a group that already
+        exists the creator must be one of its members; anyone else gets
+        'group_error'.
+        """
+        print("DEBUG: on_create_group called with data:", data)
+        group_name = data.get('group')
+        creator = self.presence.username_for(request.sid)
+        if not group_name or creator is None:
+            print("DEBUG: create_group from unregistered session or without a name")
+            return
+        existing = get_group_members(group_name)
+        if existing and creator not in existing:
+            # The name is taken; only the group's members may add people to it
+            self.counters['group_rejected'] += 1
+            emit('group_error', {'group': group_name, 'reason': 'group name already taken'})
+            print("DEBUG: create_group for existing group", group_name, "from non-member", creator)
+            return
+        members = set(data.get('members', []))
+        members.add(creator)
+        add_group(group_name, members)
+        # Put every online device of every member into the group room
+        for member in members:
+            for sid in self.presence.sids_for(member):
+                join_room(group_room(group_name), sid=sid)
+        print("DEBUG: Created group:", group_name, "members:", members)
+
+    def on_group_message(self, data):
+        """
+        Expects data = {
+          'text': 'alice: {...encrypted group JSON...}',
+          'group': 'friends',
+          'sender': 'alice'
+        }
+        The message is logged once, in the group's log, numbered once in the
+        group's sequence and emitted once to the group room (skipping the
+        sending device unless it syncs, when it needs the log position, and
+        members whose window is full, which get SLOW_CONSUMER_POLICY).
+        Members without a live session get it through the offline store.
+        """
+        sender = self._sender('group_message')
+        if sender is None:
+            return
+        if not valid_message(data, 'group'):
+            self._malformed('group_message')
+            return
+        if not sent_by(data, sender):
+            self._forged('group_message', sender)
+            return
+        if not self._admit('group_message', text_size(data), [data]):
+            return
+        print("DEBUG: on_group_message called with data:", data)
+        group_name = data.get('group')
+        members = get_group_members(group_name)
+        if sender not in members:
+            print("DEBUG: Sender", sender, "is not a member of group:", group_name)
+            return
+
+        offline = []
+        receivers = []
+        skip_sids = [] if request.sid in self.sync_sids else [request.sid]
+        with self.route_lock:
+            [(log_id, prev_id)] = self.log_writes.append([(group_room(group_name), group_name, data['text'])])
+            for member in members:
+                member_sids = [sid for sid in self.presence.sids_for(member) if sid not in skip_sids]
+                if not member_sids:
+                    if member != sender:
+                        offline.append((member, sender, data['text']))
+                elif self._room(member) == 0:
+                    self._overflow(member, member_sids, sender, [data['text']])
+                    skip_sids.extend(member_sids)
+                else:
+                    receivers.append(member)
+            envelope = self.delivery.group_envelope(group_name, receivers, data['text'], log_id, prev_id)
+        if receivers:
+            emit('message', envelope, room=group_room(group_name), skip_sid=skip_sids)
+        if offline:
+            self._store_offline(offline)
+        print("DEBUG: Group message emitted to room:", group_room(group_name))
+
+    def on_ack(self, data):
+        """
+        Expects data = {'epoch': ..., 'acks': {conversation: highest seq received in order}}
+        Acks are cumulative, so clients send one per batch of messages.
+        """
+        username = self.presence.username_for(request.sid)
+        if username is None or data.get('epoch') != self.delivery.epoch:
+            return
+        with self.route_lock:
+            released = self.delivery.ack(username, data.get('acks', {}))
+            print("DEBUG: Ack from", username, "released", released, "messages")
+            # Messages spilled while the window was full go out once it is empty again
+            if username not in self.spilled or self.delivery.unacked_count(username):
+                return
+        if self._deliver_offline(username):
+            # They are in the message log; tell the devices to fetch them
+            for sid in self.presence.sids_for(username):
+                emit('sync_hint', {}, room=sid)
+
+    def prune_delivery_state(self):
+        """
+        Drops the sequence state of users gone for longer than
+        DELIVERY_STATE_TTL; their unacked messages move to the offline store.
+        """
+        with self.route_lock:
+            expired = self.delivery.expire(DELIVERY_STATE_TTL, time.time())
+        messages = [
+            (recipient, envelope['conversation'], envelope['text'])
+            for recipient, envelopes in expired.items()
+            for envelope in envelopes
+        ]
+        if messages:
+            self.offline_writes.put(messages)
+        return len(expired)
+
+    def on_resend(self, data):
+        """
+        Expects data = {'epoch': ..., 'conversation': ..., 'from': <first missing seq>}
+        Sent by a client that noticed a gap in a conversation's sequence numbers.
+        """
+        username = self.presence.username_for(request.sid)
+        if username is None:
+            return
+        groups = get_user_groups(username)
+        if data.get('epoch') != self.delivery.epoch:
+            emit('delivery_state', {'epoch': self.delivery.epoch, 'delivered': self.delivery.delivered(username, groups)})
+            return
+        conversation = data.get('conversation')
+        from_seq = data.get('from', 1)
+        envelopes = self.delivery.pending(username, conversation, from_seq)
+        if not envelopes or envelopes[0]['seq'] > from_seq:
+            # The missing messages were already acked by another device (or,
+            # in a group, sent while this user was away); skip past them
+            skip_to = envelopes[0]['seq'] - 1 if envelopes else self.delivery.delivered(username, groups).get(conversation, 0)
+            emit('seq_reset', {'epoch': self.delivery.epoch, 'conversation': conversation, 'seq': skip_to})
+        if envelopes:
+            emit('message_batch', envelopes)
+        print("DEBUG: Resent", len(envelopes), "messages of", conversation, "to", username)
+
+    def on_sync(self, data):
+        """
+        Expects data = {'cursors': {conversation: last log id the device has}}
+        Replies with 'sync_page' = {'pages': {conversation: [[log_id, text], ...]},
+        'more': bool}, holding at most SYNC_PAGE_SIZE entries from the
+        conversations the device is behind on. The device asks again with
+        its new cursors while 'more' is true.
+        """
+        username = self.presence.username_for(request.sid)
+        if username is None or not self._admit('sync', 0, [data]):
+            return
+        self.log_writes.flush()
+        cursors = data.get('cursors', {})
+        groups = get_user_groups(username)
+        budget = SYNC_PAGE_SIZE
+        pages = {}
+        more = False
+        for conversation, last_id in get_message_log_heads(username, *map(group_room, groups)).items():
+            cursor = cursors.get(conversation, 0)
+            if last_id <= cursor:
+                continue
+            if budget == 0:
+                more = True
+                break
+            # Group messages are in the group's log (older ones in the user's own)
+            owners = (username, group_room(conversation)) if conversation in groups else username
+            entries = get_message_log_page(owners, conversation, cursor, budget)
+            pages[conversation] = entries
+            budget -= len(entries)
+            if entries[-1][0] < last_id:
+                more = True
+        emit('sync_page', {'pages': pages, 'more': more})
+        print("DEBUG: Sync for", username, "sent", SYNC_PAGE_SIZE - budget, "entries, more:", more)
+
+    def on_file_offer(self, data):
+        """
+        Expects the payload built by file_transfer.FileSender.offer. Sent again
+        with the same transfer_id to resume after a reconnect. The offer's
+        'sender' is set to the registered user of the session.
+        """
+        sender = self.presence.username_for(request.sid)
+        if sender is None:
+            print("DEBUG: Dropped file_offer from unregistered sid:", request.sid)
+            return
+        if not self._admit_file('file_offer', data):
+            return
+        transfer_id = data.get('transfer_id') if isinstance(data, dict) else None
+        if not isinstance(transfer_id, str):
+            emit('file_error', {'transfer_id': transfer_id, 'reason': 'malformed offer'})
+            return
+        print("DEBUG: on_file_offer called for transfer:", transfer_id)
+        recipient_sids = self.presence.sids_for(data.get('recipient'))
+        if not recipient_sids:
+            emit('file_error', {'transfer_id': transfer_id, 'reason': 'recipient offline'})
+            return
+        self.transfers[transfer_id] = {
+            'sender_sid': request.sid,
+            'recipient_sid': recipient_sids[0]
+        }
+        emit('file_offer', dict(data, sender=sender), room=recipient_sids[0])
+
+    def on_file_resume(self, data):
+        """
+        Expects data = {'transfer_id': ..., 'sender': <username>}
+        Sent by a recipient that reconnected during a transfer; the sender's
+        devices are asked to offer it again.
+        """
+        recipient = self.presence.username_for(request.sid)
+        if recipient is None or not self._admit_file('file_resume', data):
+            return
+        for sid in self.presence.sids_for(data.get('sender')):
+            emit('file_resume', {'transfer_id': data.get('transfer_id'), 'recipient': recipient}, room=sid)
+
+    def on_file_accept(self, data):
+        """Expects data = {'transfer_id': ..., 'next_index': <first missing chunk>}"""
+        if not self._admit_file('file_accept', data):
+            return
+        transfer = self.transfers.get(data.get('transfer_id'))
+        if transfer and transfer['recipient_sid'] == request.sid:
+            emit('file_accept', data, room=transfer['sender_sid'])
+
+    def on_file_chunk(self, data):
+        """Expects data = {'transfer_id': ..., 'index': n, 'data': <encrypted bytes>}"""
+        if len(data.get('data', b'')) > MAX_PAYLOAD_BYTES:
+            self.counters['oversized'] += 1
+            emit('throttled', {'event': 'file_chunk', 'reason': 'payload too large'})
+            return
+        if not self._admit_file('file_chunk', data):
+            return
+        transfer = self.transfers.get(data.get('transfer_id'))
+        if transfer and transfer['sender_sid'] == request.sid:
+            emit('file_chunk', data, room=transfer['recipient_sid'])
+
+    def on_file_ack(self, data):
+        """Expects data = {'transfer_id': ..., 'index': <highest contiguous chunk received>}"""
+        if not self._admit_file('file_ack', data):
+            return
+        transfer = self.transfers.get(data.get('transfer_id'))
+        if transfer and transfer['recipient_sid'] == request.sid:
+            emit('file_ack', data, room=transfer['sender_sid'])
+
+    def on_file_complete(self, data):
+        if not self._admit_file('file_complete', data):
+            return
+        self.transfers.pop(data.get('transfer_id'), None)
+        print("DEBUG: File transfer complete:", data.get('transfer_id'))
+
+
+chat_namespace = ChatNamespace('/chat')
+socketio.on_namespace(chat_namespace)
+
+def stats_endpoint(view):
+    """
+    Restricts an operator endpoint (it names users) to requests carrying
+    STATS_TOKEN, or to local requests when no token is configured.
+    """
+    @wraps(view)
+    def checked(*args, **kwargs):
+        if STATS_TOKEN:
+            supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+            if not hmac.compare_digest(supplied.encode('utf-8'), STATS_TOKEN.encode('utf-8')):
+                abort(403)
+        elif request.remote_addr not in ('127.0.0.1', '::1'):
+            abort(403)
+        return view(*args, **kwargs)
+    return checked
+
+@app.route('/stats/offline')
+@stats_endpoint
+def offline_stats():
+    chat_namespace.offline_writes.flush()
+    return jsonify(get_offline_queue_stats())
+
+@app.route('/stats/limits')
+@stats_endpoint
+def limit_stats():
+    return jsonify({
+        'counters': dict(chat_namespace.counters),
+        'unacked_messages': len(chat_namespace.delivery),
+        'spilled_users': len(chat_namespace.spilled),
+        'rate_limited_users': len(chat_namespace.user_limits),
+        'offline_writes': dict(chat_namespace.offline_writes.stats, pending=len(chat_namespace.offline_writes)),
+        'log_writes': dict(chat_namespace.log_writes.stats, pending=len(chat_namespace.log_writes)),
+    })
+
+@app.route('/auth/login', methods=['POST'])
+def auth_login():
+    """
+    Password login, the only place the server runs bcrypt. Expects
+    {'username', 'password'} and returns {'token', 'expires_at'}, or 401.
+    """
+    import bcrypt  # Lazy import: only password logins need it
+    data = request.get_json(silent=True) or {}
+    username, password = data.get('username'), data.get('password')
+    hashed_password = None
+    if isinstance(username, str) and isinstance(password, str):
+        hashed_password = get_password_hash(username)
+    if hashed_password is None or not bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8')):
+        return jsonify({'error': 'invalid username or password'}), 401
+    token, expires_at = issue_token(username)
+    return jsonify({'token': token, 'expires_at': expires_at})
+
+@app.route('/auth/refresh', methods=['POST'])
+def auth_refresh():
+    """Exchanges a valid session token for a new one. Expects {'token'}; 401 once it has expired."""
+    username = verify_token((request.get_json(silent=True) or {}).get('token'))
+    if username is None:
+        return jsonify({'error': 'invalid or expired session token'}), 401
+    token, expires_at = issue_token(username)
+    return jsonify({'token': token, 'expires_at': expires_at})
+
+@app.route('/keys', methods=['POST'])
+def key_lookup():
+    """
+    Bulk public key lookup. Expects {'usernames': [...]} (400 otherwise) and returns
+    {'keys': {username: {'rsa_public', 'version'}}, 'missing': [...]} with an
+    ETag; a request whose If-None-Match matches gets an empty 304 instead.
+    """
+    usernames = (request.get_json(silent=True) or {}).get('usernames', [])
+    if not isinstance(usernames, list) or not all(isinstance(u, str) for u in usernames):
+        return jsonify({'error': 'usernames must be a list of strings'}), 400
+    usernames = usernames[:KEY_LOOKUP_MAX]
+    keys = lookup_keys(usernames)
+    etag = directory_etag({username: key['version'] for username, key in keys.items()})
+    if etag in request.if_none_match:
+        return '', 304, {'ETag': f'"{etag}"'}
+    response = jsonify({'keys': keys, 'missing': [u for u in usernames if u not in keys]})
+    response.set_etag(etag)
+    return response
+
+def offline_compaction_task():
+    """
+    Periodically drops expired offline messages and message log entries
+    past their retention, forgets the delivery state of long-gone users and
+    shrinks the database file.
+    """
+    enable_incremental_vacuum()
+    while True:
+        chat_namespace.log_writes.flush()
+        trimmed = compact_message_log()
+        print("DEBUG: Message log compaction removed", trimmed, "entries")
+        deleted = compact_offline_messages()
+        print("DEBUG: Offline compaction removed", deleted, "expired messages")
+        pruned = chat_namespace.prune_delivery_state()
+        print("DEBUG: Dropped the delivery state of", pruned, "users")
+        # User buckets outlive disconnects, so a reconnect does not reset the limit
+        idle = chat_namespace.user_limits.prune()
+        print("DEBUG: Dropped", idle, "idle rate limit buckets")
+        socketio.sleep(OFFLINE_COMPACTION_INTERVAL)
+
+if __name__ == '__main__':
+    print("DEBUG: Starting server on port 5000")
+    socketio.start_background_task(offline_compaction_task)
+    socketio.run(app, host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,93 @@
+# session_tokens.py
+"""
+Signed, expiring session tokens.
+
+The server checks a password with bcrypt once (POST /auth/login) and hands
+out a token; the 'register' handshake and POST /auth/refresh only verify
+the token, which is an HMAC-SHA256 and takes microseconds. A token is
+"<base64url username>.<expiry, unix seconds>.<hex signature>", so no
+server-side session state is needed.
+
+The signing secret is VIBER_SESSION_SECRET (hex) if set, otherwise a random
+secret kept in SESSION_SECRET_PATH, created on first use so that tokens
+survive a server restart. Either must be at least 32 bytes.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import time
+
+SESSION_TOKEN_TTL = 24 * 60 * 60   # seconds a token is valid
+SESSION_SECRET_PATH = 'session_secret.key'
+SESSION_SECRET_MIN_BYTES = 32      # shorter secrets are refused
+
+
+class TokenSigner:
+    def __init__(self, secret, ttl=SESSION_TOKEN_TTL):
+        self.secret = secret
+        self.ttl = ttl
+
+    def _signature(self, payload):
+        return hmac.new(self.secret, payload.encode('ascii'), hashlib.sha256).hexdigest()
+
+    def issue(self, username, now=None):
+        """Returns (token, expires_at) for `username`."""
+        expires_at = int((time.time() if now is None else now) + self.ttl)
+        name = base64.urlsafe_b64encode(username.encode('utf-8')).decode('ascii').rstrip('=')
+        payload = f"{name}.{expires_at}"
+        return f"{payload}.{self._signature(payload)}", expires_at
+
+    def verify(self, token, now=None):
+        """Returns the token's username, or None if it is malformed, forged or expired."""
+        if not isinstance(token, str) or token.count('.') != 2:
+            return None
+        name, expires_at, signature = token.split('.')
+        try:
+            expected = self._signature(f"{name}.{expires_at}").encode('ascii')
+            if not hmac.compare_digest(expected, signature.encode('utf-8')):
+                return None
+            if not expires_at.isdigit() or int(expires_at) <= (time.time() if now is None else now):
+                return None
+            return base64.urlsafe_b64decode(name + '=' * (-len(name) % 4)).decode('utf-8')
+        except (UnicodeError, ValueError, TypeError):
+            # Non-ASCII parts, bad base64 or a name that is not UTF-8
+            return None
+
+
+def _load_secret():
+    """The signing secret; raises ValueError if it is shorter than SESSION_SECRET_MIN_BYTES."""
+    secret = os.environ.get('VIBER_SESSION_SECRET')
+    if secret:
+        secret, source = bytes.fromhex(secret), 'VIBER_SESSION_SECRET'
+    else:
+        source = SESSION_SECRET_PATH
+        try:
+            with open(SESSION_SECRET_PATH, 'rb') as f:
+                secret = f.read()
+        except FileNotFoundError:
+            secret = os.urandom(SESSION_SECRET_MIN_BYTES)
+            fd = os.open(SESSION_SECRET_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(secret)
+    if len(secret) < SESSION_SECRET_MIN_BYTES:
+        raise ValueError(f"Session secret from {source} is {len(secret)} bytes; at least {SESSION_SECRET_MIN_BYTES} are needed")
+    return secret
+
+
+signer = None  # the server's TokenSigner, created on first use
+
+
+def _signer():
+    global signer
+    if signer is None:
+        signer = TokenSigner(_load_secret())
+    return signer
+
+
+def issue_token(username):
+    return _signer().issue(username)
+
+
+def verify_token(token):
+    return _signer().verify(token)
@@ -1,182 +1,1759 @@
-import unittest
-from cryptography.fernet import Fernet
-from flask_socketio import SocketIOTestClient
-from server import app, socketio, ChatNamespace
-# from encryption import EncryptionManager
-from imports import*
-# from chat_functions import ChatFunctions
-
-# app = QApplication([])
-class TestEncryptionManager(unittest.TestCase):
-
-    def setUp(self):
-        self.key = Fernet.generate_key()
-        self.encryption_manager = EncryptionManager(self.key)
-
-    def test_encrypt_message(self):
-        message = "Test message"
-        encrypted_message = self.encryption_manager.encrypt_message(message)
-        self.assertNotEqual(message, encrypted_message)
-
-    def test_decrypt_message(self):
-        message = "Test message"
-        encrypted_message = self.encryption_manager.encrypt_message(message)
-        decrypted_message = self.encryption_manager.decrypt_message(encrypted_message)
-        self.assertEqual(message, decrypted_message)
-        
-class TestLoginWindow(unittest.TestCase):
-    app = QApplication([])
-    def setUp(self):
-        self.login = LoginWindow(None)
-
-    def test_title(self):
-        self.assertEqual(self.login.windowTitle(), "Viber Lite - Login")
-
-    def test_username_input(self):
-        QTest.keyClicks(self.login.username_input, 'testuser')
-        self.assertEqual(self.login.username_input.text(), 'testuser')
-
-    def test_password_input(self):
-        QTest.keyClicks(self.login.password_input, 'testpassword')
-        self.assertEqual(self.login.password_input.text(), 'testpassword')
-
-
-class TestSignupWindow(unittest.TestCase):
-    app = QApplication([])
-    def setUp(self):
-        self.signup = SignupWindow(None)
-
-    def test_title(self):
-        self.assertEqual(self.signup.windowTitle(), "Viber Lite - Signup")
-
-    def test_username_input(self):
-        QTest.keyClicks(self.signup.username_input, 'testuser')
-        self.assertEqual(self.signup.username_input.text(), 'testuser')
-
-    def test_email_input(self):
-        QTest.keyClicks(self.signup.email_input, 'testuser@example.com')
-        self.assertEqual(self.signup.email_input.text(), 'testuser@example.com')
-
-    def test_password_input(self):
-        QTest.keyClicks(self.signup.password_input, 'testpassword')
-        self.assertEqual(self.signup.password_input.text(), 'testpassword')
-
-class TestChatNamespace(unittest.TestCase):
-    def setUp(self):
-        self.client = socketio.test_client(app, namespace='/chat')
-        self.client.get_received('/chat')
-
-    def test_connect(self):
-        self.assertTrue(self.client.is_connected('/chat'))
-
-    def test_register(self):
-        self.client.emit('register', {'username': 'testuser'}, namespace='/chat')
-        # received = self.client.get_received('/chat')
-        # self.assertEqual(len(received), 1)
-        # self.assertEqual(received[0]['name'], 'register')
-        # self.assertEqual(received[0]['args'][0]['username'], 'testuser')
-
-    def test_message(self):
-        self.client.emit('message', {'recipient': 'testuser', 'text': 'Hello, world!'}, namespace='/chat')
-        received = self.client.get_received('/chat')
-        # self.assertEqual(len(received), 1)
-        # self.assertEqual(received[0]['name'], 'message')
-        # self.assertEqual(received[0]['args'][0]['recipient'], 'testuser')
-        # self.assertEqual(received[0]['args'][0]['text'], 'Hello, world!')
-
-class TestContactFunctions(unittest.TestCase):
-    app = QApplication([])
-    def setUp(self):
-        self.contact = ContactFunctions()
-
-    @patch('PyQt5.QtWidgets.QMessageBox.warning')
-    @patch('PyQt5.QtWidgets.QInputDialog.getText')
-    @patch('sqlite3.connect')
-    def test_add_contact(self, mock_sqlite3_connect, mock_getText, mock_warning):
-        # Mock the user input and database connection
-        mock_getText.return_value = ('testuser', True)
-        mock_conn = MagicMock()
-        mock_sqlite3_connect.return_value = mock_conn
-
-        # Mock the database cursor
-        mock_cursor = MagicMock()
-        mock_conn.cursor.return_value = mock_cursor
-
-        # Mock the database query result
-        mock_cursor.fetchone.return_value = None
-
-        # Call the method
-        self.contact.add_contact()
-
-        # Check that the method called the mock functions with the correct arguments
-        mock_getText.assert_called_once_with(self.contact, "Add Contact", "Enter the name of the new contact:")
-        mock_sqlite3_connect.assert_called_once_with('database.db')
-        mock_cursor.execute.assert_called_once_with("SELECT * FROM users WHERE username=?", ('testuser',))
-        mock_warning.assert_called_once_with(self.contact, "Error", "User does not exist.")
-
-class TestMainWindow(unittest.TestCase):
-    app = QApplication([])
-    def setUp(self):
-        self.username = 'testuser'
-        self.main_window = MainWindow(self.username)
-        self.main_window.contact_list_widget = MagicMock()
-        self.main_window.chat_input_widget = MagicMock()
-        self.main_window.chat_history_widget = MagicMock()
-        self.main_window.chat_header_widget = MagicMock()
-        self.main_window.stacked_widget = MagicMock()
-        self.main_window.chat_widget = MagicMock()
-        self.main_window.socketio = MagicMock()
-        self.main_window.update_gui_signal = MagicMock()
-        self.main_window.chat_history = {'testuser': []}
-        self.main_window.encryption_manager = MagicMock()
-        self.main_window.animation = MagicMock()
-
-    @patch('mainwindow.get_contacts')
-    def test_init(self, mock_get_contacts):
-        mock_get_contacts.return_value = [('testuser', 'Hello\\n')]
-        main_window = MainWindow(self.username)
-        self.assertEqual(main_window.username, self.username)
-        self.assertIsInstance(main_window.cipher_suite, Fernet)
-        # self.assertIsInstance(main_window.encryption_manager, MagicMock)
-        # self.assertIsInstance(main_window.animation, MagicMock)
-
-    def test_encrypt_message(self):
-        message = 'Hello'
-        self.main_window.encryption_manager.encrypt_message.return_value = 'encrypted_message'
-        result = self.main_window.encrypt_message(message)
-        self.assertEqual(result, 'encrypted_message')
-
-    def test_decrypt_message(self):
-        encrypted_message = 'encrypted_message'
-        self.main_window.encryption_manager.decrypt_message.return_value = 'message'
-        result = self.main_window.decrypt_message(encrypted_message)
-        self.assertEqual(result, 'message')
-
-    def test_on_connect(self):
-        self.main_window.on_connect()
-        self.main_window.socketio.emit.assert_called_with('register', {'username': self.username}, namespace='/chat')
-
-    def test_update_gui(self):
-        sender = 'testuser'
-        self.main_window.contact_list_widget.currentItem.return_value.text.return_value = sender
-        self.main_window.update_gui(sender)
-        # self.main_window.display_chat_history.assert_called_with(sender)
-
-    @patch('mainwindow.QMessageBox.question')
-    def test_closeEvent(self, mock_question):
-        mock_question.return_value = QMessageBox.Yes
-        event = MagicMock()
-        self.main_window.closeEvent(event)
-        event.accept.assert_called_once()
-
-    def test_getUsername(self):
-        self.assertEqual(self.main_window.getUsername(), self.username)
-
-    def test_setUsername(self):
-        new_username = 'newuser'
-        self.main_window.setUsername(new_username)
-        self.assertEqual(self.main_window.getUsername(), new_username)
-
-
-if __name__ == "__main__":
-    unittest.main()
+import atexit
+import os
+import tempfile
+import unittest
+
+# The modules under test create their tables on import; point them at a
+# scratch database instead of the tracked database.db
+_db_fd, _db_path = tempfile.mkstemp(suffix='.db')
+os.close(_db_fd)
+os.environ['VIBER_DATABASE_PATH'] = _db_path
+atexit.register(os.remove, _db_path)
+from cryptography.fernet import Fernet
+from flask_socketio import SocketIOTestClient
+from server import app, socketio, ChatNamespace
+import server
+from presence import PresenceRegistry
+from custom_rsa import generate_rsa_keys
+import custom_rsa
+from chat_encryption import encrypt_chat_message, decrypt_chat_message
+from chat_encryption import encrypt_group_message, decrypt_group_message, PackageRejected
+from file_transfer import FileSender, FileReceiver
+from custom_aes import AES, AESCTRCipher, aes_encrypt, aes_decrypt
+import crypto_backends
+import parallel_salsa20
+from encryption import Salsa20Cipher, poly1305
+from delivery import DeliveryWindow
+from rate_limit import TokenBucket, RateLimiter
+import compression
+from profiling import Profiler
+import profiling
+from chat_view import TranscriptModel, SenderRole, FileRole
+from contact_list import ContactListModel, UnreadRole, PreviewRole
+from search_index import SearchIndex
+from write_behind import OfflineWriteQueue, MessageLogQueue
+from message_records import MessageRecords, SenderNames
+from chat_client import ChatSession, ChatClientError, HistoryStore, OutgoingBatcher, InboundSequencer, HistorySync, KeyCache, load_keyring, ContactSummaries, SessionAuth
+import session_tokens
+from session_tokens import TokenSigner
+import tracemalloc
+import time
+import threading
+import shutil
+import json
+import sqlite3
+import database
+# from encryption import EncryptionManager
+from imports import*
+from PyQt5.QtTest import QTest
+from unittest.mock import patch, MagicMock
+from login import LoginWindow
+from signup import SignupWindow
+from mainwindow import MainWindow
+from encryption import EncryptionManager
+from contact_functions import ContactFunctions
+# from chat_functions import ChatFunctions
+
+# app = QApplication([])
+class TestEncryptionManager(unittest.TestCase):
+
+    def setUp(self):
+        self.key = Fernet.generate_key()
+        self.encryption_manager = EncryptionManager(self.key)
+
+    def test_encrypt_message(self):
+        message = "Test message"
+        encrypted_message = self.encryption_manager.encrypt_message(message)
+        self.assertNotEqual(message, encrypted_message)
+
+    def test_decrypt_message(self):
+        message = "Test message"
+        encrypted_message = self.encryption_manager.encrypt_message(message)
+        decrypted_message = self.encryption_manager.decrypt_message(encrypted_message)
+        self.assertEqual(message, decrypted_message)
+        
+class TestLoginWindow(unittest.TestCase):
+    app = QApplication([])
+    def setUp(self):
+        self.login = LoginWindow(None)
+
+    def test_title(self):
+        self.assertEqual(self.login.windowTitle(), "Viber Lite - Login")
+
+    def test_username_input(self):
+        QTest.keyClicks(self.login.username_input, 'testuser')
+        self.assertEqual(self.login.username_input.text(), 'testuser')
+
+    def test_password_input(self):
+        QTest.keyClicks(self.login.password_input, 'testpassword')
+        self.assertEqual(self.login.password_input.text(), 'testpassword')
+
+
+class TestSignupWindow(unittest.TestCase):
+    app = QApplication([])
+    def setUp(self):
+        self.signup = SignupWindow(None)
+
+    def test_title(self):
+        self.assertEqual(self.signup.windowTitle(), "Viber Lite - Signup")
+
+    def test_username_input(self):
+        QTest.keyClicks(self.signup.username_input, 'testuser')
+        self.assertEqual(self.signup.username_input.text(), 'testuser')
+
+    def test_email_input(self):
+        QTest.keyClicks(self.signup.email_input, 'testuser@example.com')
+        self.assertEqual(self.signup.email_input.text(), 'testuser@example.com')
+
+    def test_password_input(self):
+        QTest.keyClicks(self.signup.password_input, 'testpassword')
+        self.assertEqual(self.signup.password_input.text(), 'testpassword')
+
+class TestChatNamespace(unittest.TestCase):
+    def setUp(self):
+        signer = patch.object(session_tokens, 'signer', TokenSigner(os.urandom(32)))
+        signer.start()
+        self.addCleanup(signer.stop)
+        self.client = socketio.test_client(app, namespace='/chat')
+        self.client.get_received('/chat')
+
+    def token(self, username):
+        return session_tokens.issue_token(username)[0]
+
+    def register_sender(self):
+        """Registers self.client as 'alice', the sender in the message tests."""
+        self.client.emit('register', {'username': 'alice', 'token': self.token('alice')}, namespace='/chat')
+        self.client.get_received('/chat')
+
+    def flush_writes(self):
+        """Commits the server's queued rows while the test database is still patched in."""
+        server.chat_namespace.log_writes.flush()
+        server.chat_namespace.offline_writes.flush()
+
+    def test_connect(self):
+        self.assertTrue(self.client.is_connected('/chat'))
+
+    def test_register(self):
+        self.client.emit('register', {'username': 'testuser', 'token': self.token('testuser')}, namespace='/chat')
+        # received = self.client.get_received('/chat')
+        # self.assertEqual(len(received), 1)
+        # self.assertEqual(received[0]['name'], 'register')
+        # self.assertEqual(received[0]['args'][0]['username'], 'testuser')
+
+    def test_message(self):
+        self.client.emit('message', {'recipient': 'testuser', 'text': 'Hello, world!'}, namespace='/chat')
+        received = self.client.get_received('/chat')
+        # self.assertEqual(len(received), 1)
+        # self.assertEqual(received[0]['name'], 'message')
+        # self.assertEqual(received[0]['args'][0]['recipient'], 'testuser')
+        # self.assertEqual(received[0]['args'][0]['text'], 'Hello, world!')
+
+    def test_message_batch(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            database.create_message_log_table()
+            bob = socketio.test_client(app, namespace='/chat')
+            bob.emit('register', {'username': 'batch_bob', 'token': self.token('batch_bob')}, namespace='/chat')
+            bob.get_received('/chat')
+            self.register_sender()
+            self.client.emit('message_batch', [
+                {'recipient': 'batch_bob', 'sender': 'alice', 'text': 'alice: one'},
+                {'recipient': 'batch_carol', 'sender': 'alice', 'text': 'alice: offline'},
+                {'recipient': 'batch_bob', 'sender': 'alice', 'text': 'alice: two'},
+            ], namespace='/chat')
+            received = bob.get_received('/chat')
+            self.assertEqual([r['name'] for r in received], ['message_batch'])
+            self.assertEqual([(e['seq'], e['text']) for e in received[0]['args'][0]],
+                             [(1, 'alice: one'), (2, 'alice: two')])
+            server.chat_namespace.offline_writes.flush()
+            self.assertEqual(database.get_offline_messages('batch_carol'), [('alice', 'alice: offline')])
+            stored = [r for r in self.client.get_received('/chat') if r['name'] == 'stored']
+            self.assertEqual(stored[0]['args'][0], {'batch_carol': 1})
+            bob.disconnect(namespace='/chat')
+            self.flush_writes()
+
+    def test_unacked_messages_are_resent_on_register(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            database.create_message_log_table()
+            bob = socketio.test_client(app, namespace='/chat')
+            bob.emit('register', {'username': 'ack_bob', 'token': self.token('ack_bob')}, namespace='/chat')
+            bob.get_received('/chat')
+            self.register_sender()
+            for text in ('alice: one', 'alice: two', 'alice: three'):
+                self.client.emit('message', {'recipient': 'ack_bob', 'sender': 'alice', 'text': text}, namespace='/chat')
+            # The test client unwraps single dict arguments sent to another session
+            envelopes = [r['args'] for r in bob.get_received('/chat')]
+            self.assertEqual([e['seq'] for e in envelopes], [1, 2, 3])
+            bob.emit('ack', {'epoch': envelopes[0]['epoch'], 'acks': {'alice': 2}}, namespace='/chat')
+            bob.disconnect(namespace='/chat')
+
+            bob = socketio.test_client(app, namespace='/chat')
+            bob.emit('register', {'username': 'ack_bob', 'token': self.token('ack_bob')}, namespace='/chat')
+            received = {r['name']: r['args'][0] for r in bob.get_received('/chat')}
+            self.assertEqual(received['delivery_state']['delivered'], {'alice': 2})
+            self.assertEqual([e['text'] for e in received['message_batch']], ['alice: three'])
+            bob.disconnect(namespace='/chat')
+            self.flush_writes()
+
+    @patch.object(server, 'SYNC_PAGE_SIZE', 2)
+
+    def test_sync_pages_from_cursor(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            database.create_message_log_table()
+            self.register_sender()
+            for i in range(3):
+                self.client.emit('message', {'recipient': 'sync_bob', 'sender': 'alice', 'text': f'alice: {i}'}, namespace='/chat')
+            bob = socketio.test_client(app, namespace='/chat')
+            bob.emit('register', {'username': 'sync_bob', 'token': self.token('sync_bob'), 'sync': True}, namespace='/chat')
+            self.assertEqual([r['name'] for r in bob.get_received('/chat')], ['delivery_state'])
+            log = HistorySync()
+            texts = []
+            more = True
+            while more:
+                bob.emit('sync', log.request(), namespace='/chat')
+                page = bob.get_received('/chat')[0]['args'][0]
+                entries, more = log.apply_page(page)
+                texts.extend(text for text, _ in entries)
+            self.assertEqual(texts, ['alice: 0', 'alice: 1', 'alice: 2'])
+            self.assertEqual(database.get_offline_messages('sync_bob'), [])
+            bob.disconnect(namespace='/chat')
+            self.flush_writes()
+
+    def test_syncing_client_gets_offline_rows_missing_from_the_log(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            database.create_message_log_table()
+            self.register_sender()
+            self.client.emit('message', {'recipient': 'legacy_bob', 'sender': 'alice', 'text': 'alice: logged'}, namespace='/chat')
+            self.flush_writes()
+            conn = sqlite3.connect(db_path)
+            conn.execute("INSERT INTO offline_messages VALUES ('legacy_bob', 'alice', 'alice: old', ?, 10, 0)", (time.time(),))
+            conn.commit()
+            conn.close()
+            bob = socketio.test_client(app, namespace='/chat')
+            bob.emit('register', {'username': 'legacy_bob', 'token': self.token('legacy_bob'), 'sync': True}, namespace='/chat')
+            received = {r['name']: r['args'][0] for r in bob.get_received('/chat')}
+            self.assertEqual([e['text'] for e in received['message_batch']], ['alice: old'])
+            self.assertEqual(database.get_offline_messages('legacy_bob'), [])
+            bob.disconnect(namespace='/chat')
+            self.flush_writes()
+
+    def test_existing_group_cannot_be_taken_over(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            database.add_group('team', ['team_alice', 'team_bob'])
+            self.client.emit('register', {'username': 'team_mallory', 'token': self.token('team_mallory')}, namespace='/chat')
+            self.client.get_received('/chat')
+            self.client.emit('create_group', {'group': 'team', 'members': ['team_mallory']}, namespace='/chat')
+            received = self.client.get_received('/chat')
+            self.assertEqual([r['name'] for r in received], ['group_error'])
+            self.assertEqual(sorted(database.get_group_members('team')), ['team_alice', 'team_bob'])
+
+    def test_group_message_is_emitted_once_to_the_room(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            database.create_message_log_table()
+            database.add_group('room_team', ['room_alice', 'room_bob', 'room_carol', 'room_dave'])
+            self.client.emit('register', {'username': 'room_alice', 'token': self.token('room_alice')}, namespace='/chat')
+            members = {}
+            for name in ('room_bob', 'room_carol'):
+                members[name] = socketio.test_client(app, namespace='/chat')
+                members[name].emit('register', {'username': name, 'token': self.token(name)}, namespace='/chat')
+                members[name].get_received('/chat')
+            self.client.get_received('/chat')
+            with patch.object(server, 'emit', wraps=server.emit) as emit:
+                self.client.emit('group_message', {'group': 'room_team', 'text': 'room_alice: hi'}, namespace='/chat')
+            self.assertEqual([c.kwargs.get('room') for c in emit.call_args_list if c.args[0] == 'message'], ['group:room_team'])
+            envelopes = [members[name].get_received('/chat')[0]['args'] for name in members]
+            self.assertEqual(envelopes[0], envelopes[1])
+            self.assertEqual((envelopes[0]['conversation'], envelopes[0]['seq']), ('room_team', 1))
+            self.assertEqual(self.client.get_received('/chat'), [])
+            server.chat_namespace.offline_writes.flush()
+            self.assertEqual(database.get_offline_messages('room_dave'), [('room_alice', 'room_alice: hi')])
+            for client in members.values():
+                client.disconnect(namespace='/chat')
+            self.flush_writes()
+
+    def test_oversized_payload_is_rejected(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            self.register_sender()
+            before = server.chat_namespace.counters['oversized']
+            self.client.emit('message', {'recipient': 'nobody', 'text': 'alice: ' + 'x' * (server.MAX_PAYLOAD_BYTES - 6)}, namespace='/chat')
+            received = self.client.get_received('/chat')
+            self.assertEqual(received[0]['name'], 'throttled')
+            self.assertEqual(server.chat_namespace.counters['oversized'], before + 1)
+            # The limit is in bytes: two bytes per character here
+            self.client.emit('message', {'recipient': 'nobody', 'text': 'alice: ' + 'é' * ((server.MAX_PAYLOAD_BYTES - 7) // 2 + 1)}, namespace='/chat')
+            self.assertEqual(self.client.get_received('/chat')[0]['name'], 'throttled')
+            self.assertEqual(server.chat_namespace.counters['oversized'], before + 2)
+
+    def test_malformed_batches_are_dropped(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            self.register_sender()
+            for payload in ({'recipient': 'bob', 'text': 'alice: hi'}, [{'recipient': 'bob'}], ['alice: hi']):
+                self.client.emit('message_batch', payload, namespace='/chat')
+                [error] = self.client.get_received('/chat')
+                self.assertEqual((error['name'], error['args'][0]['reason']), ('message_error', 'malformed payload'))
+            self.client.emit('message', {'recipient': 'bob', 'text': 7}, namespace='/chat')
+            self.assertEqual(self.client.get_received('/chat')[0]['name'], 'message_error')
+
+    def test_batch_past_the_rate_limit_is_partly_admitted(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        frozen = lambda: 0.0
+        with patch.object(database, 'DATABASE_PATH', db_path), \
+                patch.object(server.chat_namespace, 'sid_limits', RateLimiter(2, 3, frozen)), \
+                patch.object(server.chat_namespace, 'user_limits', RateLimiter(2, 3, frozen)):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            database.create_message_log_table()
+            self.register_sender()
+            batch = [{'recipient': 'rate_bob', 'text': f'alice: {i}'} for i in range(5)]
+            self.client.emit('message_batch', batch, namespace='/chat')
+            throttled = [r['args'][0] for r in self.client.get_received('/chat') if r['name'] == 'throttled']
+            self.assertEqual(throttled[0]['retry'], batch[3:])
+            self.assertEqual(throttled[0]['retry_after'], 1.0)
+            server.chat_namespace.offline_writes.flush()
+            self.assertEqual([text for _, text in database.get_offline_messages('rate_bob')], ['alice: 0', 'alice: 1', 'alice: 2'])
+            # The user's bucket outlives the connection
+            self.client.disconnect(namespace='/chat')
+            self.client.connect(namespace='/chat')
+            self.register_sender()
+            self.client.emit('message', batch[3], namespace='/chat')
+            self.assertEqual(self.client.get_received('/chat')[0]['args'][0]['retry'], [batch[3]])
+            self.flush_writes()
+
+    def test_file_events_are_rate_limited(self):
+        with patch.object(server.chat_namespace, 'file_limits', RateLimiter(1, 1, lambda: 0.0)):
+            self.client.emit('file_ack', {'transfer_id': 't1', 'index': 0}, namespace='/chat')
+            self.client.emit('file_ack', {'transfer_id': 't1', 'index': 1}, namespace='/chat')
+            self.client.emit('file_chunk', {'transfer_id': 't1', 'index': 2, 'data': b'x'}, namespace='/chat')
+            throttled = [r['args'][0] for r in self.client.get_received('/chat')]
+        self.assertEqual(throttled[0]['retry'], [{'transfer_id': 't1', 'index': 1}])
+        self.assertEqual((throttled[1]['event'], throttled[1]['transfer_id']), ('file_chunk', 't1'))
+        self.assertNotIn('retry', throttled[1])
+
+    def test_offline_delivery_reads_outside_the_route_lock(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        namespace = server.chat_namespace
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            database.add_offline_message('lock_bob', 'alice', 'alice: hi')
+            locked = []
+            flush = namespace.offline_writes.flush
+            with patch.object(namespace.offline_writes, 'flush', side_effect=lambda: locked.append(namespace.route_lock.locked()) or flush()):
+                self.client.emit('register', {'username': 'lock_bob', 'token': self.token('lock_bob')}, namespace='/chat')
+            self.assertEqual(locked, [False])
+            batch = [r['args'][0] for r in self.client.get_received('/chat') if r['name'] == 'message_batch']
+            self.assertEqual([e['text'] for e in batch[0]], ['alice: hi'])
+            self.assertEqual(database.get_offline_messages('lock_bob'), [])
+
+    def test_spoofed_sender_prefix_is_dropped(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            self.register_sender()
+            with patch.object(server.chat_namespace.log_writes, 'append') as append:
+                self.client.emit('message', {'recipient': 'bob', 'text': 'mallory: hi'}, namespace='/chat')
+                self.client.emit('message_batch', [{'recipient': 'bob', 'text': 'alice: hi'}, {'recipient': 'bob', 'text': 'alicex: hi'}], namespace='/chat')
+                self.client.emit('group_message', {'group': 'team', 'text': 'bob: hi'}, namespace='/chat')
+            append.assert_not_called()
+            errors = [r['args'][0] for r in self.client.get_received('/chat')]
+            self.assertEqual([e['event'] for e in errors], ['message', 'message_batch', 'group_message'])
+            self.assertTrue(all(e['reason'] == 'sender mismatch' for e in errors))
+
+    def test_unregistered_sender_is_dropped(self):
+        with patch.object(server.chat_namespace.log_writes, 'append') as append:
+            self.client.emit('message', {'recipient': 'bob', 'sender': 'mallory', 'text': 'mallory: hi'}, namespace='/chat')
+            self.client.emit('message_batch', [{'recipient': 'bob', 'sender': 'mallory', 'text': 'mallory: hi'}], namespace='/chat')
+        append.assert_not_called()
+        self.assertEqual(self.client.get_received('/chat'), [])
+
+    @patch.object(database, 'OFFLINE_MAX_MESSAGES', 1)
+    @patch.object(database, 'OFFLINE_OVERFLOW_POLICY', 'reject')
+    def test_offline_store_acknowledges_sender(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            database.create_message_log_table()
+            self.register_sender()
+            for text in ('alice: one', 'alice: two'):
+                self.client.emit('message', {'recipient': 'ack_carol', 'sender': 'alice', 'text': text}, namespace='/chat')
+            server.chat_namespace.offline_writes.flush()
+            received = [(r['name'], r['args'][0]) for r in self.client.get_received('/chat')]
+            self.assertIn(('stored', {'ack_carol': 1}), received)
+            self.assertIn(('delivery_failed', {'recipient': 'ack_carol', 'reason': 'offline quota exceeded'}), received)
+            self.flush_writes()
+
+    @patch.object(database, 'OFFLINE_MAX_MESSAGES', 1)
+    @patch.object(database, 'OFFLINE_OVERFLOW_POLICY', 'reject')
+    def test_group_offline_quota_is_reported(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            database.create_message_log_table()
+            database.add_group('quota_team', ['quota_alice', 'quota_bob'])
+            self.client.emit('register', {'username': 'quota_alice', 'token': self.token('quota_alice')}, namespace='/chat')
+            for text in ('quota_alice: one', 'quota_alice: two'):
+                self.client.emit('group_message', {'group': 'quota_team', 'text': text}, namespace='/chat')
+            server.chat_namespace.offline_writes.flush()
+            received = [(r['name'], r['args'][0]) for r in self.client.get_received('/chat')]
+            self.assertIn(('stored', {'quota_bob': 1}), received)
+            self.assertIn(('delivery_failed', {'recipient': 'quota_bob', 'reason': 'offline quota exceeded'}), received)
+            self.flush_writes()
+
+    def test_receiver_reconnect_asks_sender_to_resume(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            self.client.emit('register', {'username': 'file_alice', 'token': self.token('file_alice')}, namespace='/chat')
+            self.client.get_received('/chat')
+            bob = socketio.test_client(app, namespace='/chat')
+            bob.emit('register', {'username': 'file_bob', 'token': self.token('file_bob')}, namespace='/chat')
+            bob.emit('file_resume', {'transfer_id': 't1', 'sender': 'file_alice'}, namespace='/chat')
+            received = self.client.get_received('/chat')
+            self.assertEqual([(r['name'], r['args'][0]) for r in received],
+                             [('file_resume', {'transfer_id': 't1', 'recipient': 'file_bob'})])
+            bob.disconnect(namespace='/chat')
+
+    def test_file_offer_needs_a_registered_sender(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            bob = socketio.test_client(app, namespace='/chat')
+            bob.emit('register', {'username': 'offer_bob', 'token': self.token('offer_bob')}, namespace='/chat')
+            bob.get_received('/chat')
+            offer = {'transfer_id': 't2', 'sender': 'offer_mallory', 'recipient': 'offer_bob'}
+            self.client.emit('file_offer', offer, namespace='/chat')
+            self.assertEqual(bob.get_received('/chat'), [])
+
+            self.client.emit('register', {'username': 'offer_alice', 'token': self.token('offer_alice')}, namespace='/chat')
+            self.client.get_received('/chat')
+            self.client.emit('file_offer', {'recipient': 'offer_bob'}, namespace='/chat')
+            self.assertEqual(self.client.get_received('/chat')[0]['args'][0], {'transfer_id': None, 'reason': 'malformed offer'})
+            self.client.emit('file_offer', offer, namespace='/chat')
+            self.assertEqual(bob.get_received('/chat')[0]['args'][0]['sender'], 'offer_alice')
+            bob.disconnect(namespace='/chat')
+
+    def test_stats_need_authorization(self):
+        http = app.test_client()
+        self.assertEqual(http.get('/stats/limits', environ_base={'REMOTE_ADDR': '10.0.0.5'}).status_code, 403)
+        with patch.object(server, 'get_offline_queue_stats', return_value=[]):
+            self.assertEqual(http.get('/stats/offline').status_code, 200)
+            self.assertEqual(http.get('/stats/offline', environ_base={'REMOTE_ADDR': '10.0.0.5'}).status_code, 403)
+            with patch.object(server, 'STATS_TOKEN', 'operator'):
+                self.assertEqual(http.get('/stats/offline').status_code, 403)
+                response = http.get('/stats/offline', headers={'Authorization': 'Bearer operator'},
+                                    environ_base={'REMOTE_ADDR': '10.0.0.5'})
+                self.assertEqual(response.status_code, 200)
+
+    @patch.object(server, 'OUTBOUND_QUEUE_LIMIT', 2)
+    def test_slow_consumer_spills_to_offline_store(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_offline_messages_table()
+            database.create_groups_table()
+            database.create_message_log_table()
+            bob = socketio.test_client(app, namespace='/chat')
+            bob.emit('register', {'username': 'slow_bob', 'token': self.token('slow_bob')}, namespace='/chat')
+            bob.get_received('/chat')
+            self.register_sender()
+            for i in range(3):
+                self.client.emit('message', {'recipient': 'slow_bob', 'sender': 'alice', 'text': f'alice: {i}'}, namespace='/chat')
+            envelopes = [r['args'] for r in bob.get_received('/chat')]
+            self.assertEqual([e['seq'] for e in envelopes], [1, 2])
+            server.chat_namespace.offline_writes.flush()
+            self.assertEqual(database.get_offline_messages('slow_bob'), [('alice', 'alice: 2')])
+            # The window has room again, but this message queues behind the spilled one
+            bob.emit('ack', {'epoch': envelopes[0]['epoch'], 'acks': {'alice': 1}}, namespace='/chat')
+            self.client.emit('message', {'recipient': 'slow_bob', 'sender': 'alice', 'text': 'alice: 3'}, namespace='/chat')
+            self.assertEqual(bob.get_received('/chat'), [])
+            bob.emit('ack', {'epoch': envelopes[0]['epoch'], 'acks': {'alice': 2}}, namespace='/chat')
+            received = bob.get_received('/chat')
+            self.assertEqual([(e['seq'], e['text']) for e in received[0]['args'][0]], [(3, 'alice: 2'), (4, 'alice: 3')])
+            self.assertNotIn('slow_bob', server.chat_namespace.spilled)
+            bob.disconnect(namespace='/chat')
+            self.flush_writes()
+
+class TestPresenceRegistry(unittest.TestCase):
+    def setUp(self):
+        self.presence = PresenceRegistry()
+
+    def test_multiple_devices(self):
+        self.presence.register('alice', 'sid1')
+        self.presence.register('alice', 'sid2')
+        self.assertEqual(set(self.presence.sids_for('alice')), {'sid1', 'sid2'})
+        self.assertEqual(self.presence.unregister('sid1'), 'alice')
+        self.assertTrue(self.presence.is_online('alice'))
+        self.presence.unregister('sid2')
+        self.assertFalse(self.presence.is_online('alice'))
+        self.assertEqual(self.presence.sids_for('alice'), ())
+
+    def test_reregister_sid_as_other_user(self):
+        self.presence.register('alice', 'sid1')
+        self.presence.register('bob', 'sid1')
+        self.assertFalse(self.presence.is_online('alice'))
+        self.assertEqual(self.presence.username_for('sid1'), 'bob')
+
+    def test_unknown_sid_disconnect(self):
+        self.assertIsNone(self.presence.unregister('never-registered'))
+
+    def test_memory_flat_over_churn(self):
+        def churn(rounds):
+            for i in range(rounds):
+                sid = f"sid{i}"
+                self.presence.register(f"user{i % 100}", sid)
+                self.presence.unregister(sid)
+
+        churn(10000)  # warm up allocator free lists
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        churn(100000)
+        after, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.assertEqual(len(self.presence), 0)
+        self.assertEqual(self.presence.online_users(), [])
+        self.assertLess(after - before, 64 * 1024)
+
+class TestGroupEncryption(unittest.TestCase):
+    def setUp(self):
+        self.keys = {name: generate_rsa_keys(bit_length=512) for name in ('alice', 'bob', 'carol')}
+
+    def test_every_member_decrypts(self):
+        public_keys = {name: pair[1] for name, pair in self.keys.items()}
+        package = encrypt_group_message("Hello, group!", public_keys)
+        self.assertEqual(set(package['encrypted_sym_keys']), {'alice', 'bob', 'carol'})
+        for name, (private_key, _) in self.keys.items():
+            self.assertEqual(decrypt_group_message(package, name, private_key), "Hello, group!")
+
+    def test_non_member_has_no_key(self):
+        public_keys = {'alice': self.keys['alice'][1]}
+        package = encrypt_group_message("secret", public_keys)
+        with self.assertRaises(KeyError):
+            decrypt_group_message(package, 'bob', self.keys['bob'][0])
+
+    def test_512_bit_keys_wrap_any_symmetric_key(self):
+        # The largest symmetric key, as hex, fits only below a full 512-bit modulus
+        keys = [generate_rsa_keys(bit_length=512) for _ in range(8)]
+        self.assertTrue(all(public_key.n.bit_length() == 512 for _, public_key in keys))
+        with patch('chat_encryption.os.urandom', side_effect=lambda n: b'\xff' * n):
+            package = encrypt_group_message("Hello, group!", {str(i): public_key for i, (_, public_key) in enumerate(keys)})
+        for i, (private_key, _) in enumerate(keys):
+            self.assertEqual(decrypt_group_message(package, str(i), private_key), "Hello, group!")
+
+class TestAuthenticatedPackages(unittest.TestCase):
+    def setUp(self):
+        self.private_key, self.public_key = generate_rsa_keys(bit_length=1024)
+
+    def test_poly1305_rfc8439_vector(self):
+        key = bytes.fromhex('85d6be7857556d337f4452fe42d506a80103808afb0db2fd4abff6af4149f51b')
+        self.assertEqual(poly1305(key, b"Cryptographic Forum Research Group").hex(), 'a8061dc1305136c6c22b8baf0c0127a9')
+
+    def test_forged_ciphertext_is_rejected_before_decryption(self):
+        package = encrypt_chat_message("pay bob 10", self.public_key)
+        data = bytearray(bytes.fromhex(package['encrypted_message']))
+        data[-1] ^= 1
+        package['encrypted_message'] = data.hex()
+        with patch('encryption.EncryptionManager._stream_xor', wraps=EncryptionManager(os.urandom(32))._stream_xor) as stream:
+            with self.assertRaises(PackageRejected) as caught:
+                decrypt_chat_message(package, self.private_key)
+        self.assertEqual(caught.exception.reason, 'bad_tag')
+        # Only the Poly1305 key block was generated, not the message keystream
+        self.assertEqual([len(call.args[1]) for call in stream.call_args_list], [32])
+
+    def test_malformed_header_skips_rsa(self):
+        package = encrypt_chat_message("hello", self.public_key)
+        bad_packages = [
+            dict(package, tag='00'),
+            dict(package, encrypted_sym_key='xyz'),
+            dict(package, encrypted_sym_key=format(self.private_key.n, 'x')),
+            dict(package, compression='lzma'),
+            {'encrypted_message': package['encrypted_message']},
+        ]
+        with patch('chat_encryption.decrypt') as rsa_decrypt:
+            for bad in bad_packages:
+                with self.assertRaises(PackageRejected) as caught:
+                    decrypt_chat_message(bad, self.private_key)
+                self.assertEqual(caught.exception.reason, 'malformed')
+        rsa_decrypt.assert_not_called()
+
+    def test_untagged_packages_still_decrypt(self):
+        sym_key = os.urandom(32)
+        package = {
+            'encrypted_sym_key': hex(custom_rsa.encrypt(sym_key.hex(), self.public_key))[2:],
+            'encrypted_message': EncryptionManager(sym_key).encrypt_message("from before tags"),
+        }
+        self.assertEqual(decrypt_chat_message(package, self.private_key), "from before tags")
+
+    def test_session_counts_rejections(self):
+        session = ChatSession('bob', self.private_key, self.public_key)
+        package = encrypt_chat_message("hi", self.public_key)
+        package['tag'] = '0' * 32
+        with self.assertRaises(ChatClientError):
+            session.receive("alice: " + json.dumps(package))
+        package['key_fp'] = 'unknown'
+        with self.assertRaises(ChatClientError):
+            session.receive("alice: " + json.dumps(package))
+        self.assertEqual(session.rejected, {'bad_tag': 1, 'unknown_key': 1})
+
+    def test_session_refuses_untagged_packages(self):
+        sym_key = os.urandom(32)
+        data = "alice: " + json.dumps({
+            'encrypted_sym_key': hex(custom_rsa.encrypt(sym_key.hex(), self.public_key))[2:],
+            'encrypted_message': EncryptionManager(sym_key).encrypt_message("no tag"),
+        })
+        session = ChatSession('bob', self.private_key, self.public_key)
+        with patch('chat_client.decrypt_chat_message') as decrypt:
+            with self.assertRaises(ChatClientError):
+                session.receive(data)
+        decrypt.assert_not_called()
+        self.assertEqual(session.rejected, {'untagged': 1})
+        legacy = ChatSession('bob', self.private_key, self.public_key, allow_untagged=True)
+        self.assertEqual(legacy.receive(data), ('alice', 'alice', "no tag"))
+
+class TestDelivery(unittest.TestCase):
+    def setUp(self):
+        self.window = DeliveryWindow()
+        self.inbound = InboundSequencer()
+
+    def test_cumulative_ack(self):
+        for i in range(5):
+            self.window.envelope('bob', 'alice', f'alice: {i}')
+        self.window.envelope('bob', 'team', 'carol: hi')
+        self.assertEqual(self.window.ack('bob', {'alice': 3}), 3)
+        self.assertEqual([e['seq'] for e in self.window.pending('bob', 'alice')], [4, 5])
+        self.assertEqual(self.window.delivered('bob'), {'alice': 3, 'team': 0})
+        self.window.ack('bob', {'alice': 5, 'team': 1})
+        self.assertEqual(len(self.window), 0)
+
+    def texts(self, result):
+        envelopes, resend = result
+        return [envelope['text'] for envelope in envelopes], resend
+
+    def test_gap_detection(self):
+        envelopes = [self.window.envelope('bob', 'alice', f'alice: {i}') for i in range(1, 5)]
+        self.assertEqual(self.texts(self.inbound.accept(envelopes[0])), (['alice: 1'], None))
+        texts, resend = self.texts(self.inbound.accept(envelopes[2]))
+        self.assertEqual((texts, resend['from']), ([], 2))
+        self.assertEqual(self.inbound.accept(envelopes[3]), ([], None))
+        self.assertEqual(self.texts(self.inbound.accept(envelopes[1])), (['alice: 2', 'alice: 3', 'alice: 4'], None))
+        self.assertEqual(self.inbound.accept(envelopes[1]), ([], None))  # duplicate
+        self.assertEqual(self.inbound.take_acks()['acks'], {'alice': 4})
+        self.assertIsNone(self.inbound.take_acks())
+
+    def test_seq_reset_skips_lost_messages(self):
+        envelopes = [self.window.envelope('bob', 'alice', f'alice: {i}') for i in range(1, 4)]
+        self.inbound.accept(envelopes[2])
+        ready = self.inbound.reset({'epoch': self.window.epoch, 'conversation': 'alice', 'seq': 2})
+        self.assertEqual([envelope['text'] for envelope in ready], ['alice: 3'])
+        self.assertEqual(self.inbound.delivered['alice'], 3)
+
+    def test_group_envelope_is_shared(self):
+        envelope = self.window.group_envelope('team', ['bob', 'carol'], 'alice: hi')
+        self.assertEqual(envelope['seq'], 1)
+        self.assertIs(self.window.pending('bob')[0], self.window.pending('carol')[0])
+        self.window.ack('bob', {'team': 1})
+        self.assertEqual(self.window.delivered('bob', ['team']), {'team': 1})
+        self.assertEqual(self.window.delivered('carol', ['team']), {'team': 0})
+
+    def test_state_of_long_gone_users_expires(self):
+        self.window.envelope('bob', 'alice', 'alice: one')
+        self.inbound.sync({'epoch': self.window.epoch, 'delivered': self.window.delivered('bob')})
+        self.inbound.accept(self.window.envelope('bob', 'alice', 'alice: two'))
+        self.window.disconnected('bob', 100.0)
+        self.assertEqual(self.window.expire(60, 150.0), {})
+        expired = self.window.expire(60, 200.0)
+        self.assertEqual([e['text'] for e in expired['bob']], ['alice: one', 'alice: two'])
+        self.assertEqual((len(self.window), self.window.delivered('bob')), (0, {}))
+        # The returning client starts counting again from the server's state
+        self.inbound.sync({'epoch': self.window.epoch, 'delivered': self.window.delivered('bob')})
+        ready, resend = self.inbound.accept(self.window.envelope('bob', 'alice', 'alice: three'))
+        self.assertEqual(([e['text'] for e in ready], resend), (['alice: three'], None))
+
+class TestTokenBucket(unittest.TestCase):
+    def test_refill(self):
+        now = [0.0]
+        bucket = TokenBucket(rate=2, burst=3, clock=lambda: now[0])
+        self.assertTrue(all(bucket.consume() for _ in range(3)))
+        self.assertFalse(bucket.consume())
+        now[0] = 1.0
+        self.assertTrue(bucket.consume(2))
+        self.assertFalse(bucket.consume())
+        now[0] = 100.0
+        self.assertFalse(bucket.consume(4))  # never more than the burst
+        self.assertTrue(bucket.consume(3))
+
+    def test_partial_take(self):
+        now = [0.0]
+        limiter = RateLimiter(rate=2, burst=3, clock=lambda: now[0])
+        self.assertEqual(limiter.take('alice', 5), 3)
+        self.assertEqual(limiter.wait('alice', 2), 1.0)
+        limiter.refund('alice', 1)
+        self.assertEqual(limiter.take('alice', 5), 1)
+        self.assertEqual(limiter.prune(), 0)
+        now[0] = 2.0
+        self.assertEqual(limiter.prune(), 1)
+        self.assertEqual(len(limiter), 0)
+
+class TestOfflineStore(unittest.TestCase):
+    def setUp(self):
+        fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.db_patch = patch.object(database, 'DATABASE_PATH', self.db_path)
+        self.db_patch.start()
+        database.create_offline_messages_table()
+
+    def tearDown(self):
+        self.db_patch.stop()
+        os.remove(self.db_path)
+
+    def test_expired_messages_are_hidden_and_compacted(self):
+        with patch('database.time.time', return_value=1000.0):
+            database.add_offline_message('bob', 'alice', 'old')
+        database.add_offline_message('bob', 'alice', 'new')
+        self.assertEqual(database.get_offline_messages('bob'), [('alice', 'new')])
+        database.enable_incremental_vacuum()
+        self.assertEqual(database.compact_offline_messages(), 1)
+        self.assertEqual(database.get_offline_queue_stats()['total_messages'], 1)
+
+    def test_take_deletes_the_rows_read(self):
+        with patch('database.time.time', return_value=1000.0):
+            database.add_offline_message('bob', 'alice', 'old')
+        database.add_offline_messages([('bob', 'alice', 'one'), ('carol', 'alice', 'hi')])
+        self.assertEqual(database.take_offline_messages('bob'), [('alice', 'one')])
+        database.add_offline_message('bob', 'alice', 'two')
+        self.assertEqual(database.get_offline_queue_stats()['total_messages'], 2)
+        self.assertEqual(database.take_offline_messages('bob'), [('alice', 'two')])
+        self.assertEqual(database.get_offline_messages('carol'), [('alice', 'hi')])
+
+    @patch.object(database, 'OFFLINE_MAX_MESSAGES', 3)
+    def test_drop_oldest_policy(self):
+        for i in range(5):
+            self.assertTrue(database.add_offline_message('bob', 'alice', f'msg{i}'))
+        messages = [m for _, m in database.get_offline_messages('bob')]
+        self.assertEqual(messages, ['msg2', 'msg3', 'msg4'])
+
+    @patch.object(database, 'OFFLINE_MAX_BYTES', 10)
+    @patch.object(database, 'OFFLINE_OVERFLOW_POLICY', 'reject')
+    def test_reject_policy(self):
+        self.assertTrue(database.add_offline_message('bob', 'alice', '12345678'))
+        self.assertFalse(database.add_offline_message('bob', 'alice', '12345'))
+        stats = database.get_offline_queue_stats()
+        self.assertEqual(stats['recipients']['bob']['messages'], 1)
+        self.assertEqual(stats['total_bytes'], 8)
+
+    def test_message_log_pages(self):
+        database.create_message_log_table()
+        ids = database.append_message_log([('bob', 'alice', f'alice: {i}') for i in range(5)])
+        database.append_message_log([('bob', 'carol', 'carol: hi')])
+        self.assertEqual([prev for _, prev in ids], [0] + [log_id for log_id, _ in ids[:-1]])
+        heads = database.get_message_log_heads('bob')
+        self.assertEqual(heads['alice'], ids[-1][0])
+        page = database.get_message_log_page('bob', 'alice', ids[1][0], 2)
+        self.assertEqual(page, [(ids[2][0], 'alice: 2'), (ids[3][0], 'alice: 3')])
+
+    @patch.object(database, 'MESSAGE_LOG_MAX_MESSAGES', 2)
+    def test_message_log_retention(self):
+        database.create_message_log_table()
+        with patch('database.time.time', return_value=1000.0):
+            database.append_message_log([('bob', 'alice', 'alice: expired')])
+        ids = database.append_message_log([('bob', 'alice', f'alice: {i}') for i in range(3)])
+        database.append_message_log([('carol', 'alice', 'alice: hi')])
+        self.assertEqual(database.compact_message_log(), 2)
+        self.assertEqual(database.get_message_log_page('bob', 'alice', 0, 10), [(ids[1][0], 'alice: 1'), (ids[2][0], 'alice: 2')])
+        self.assertEqual(len(database.get_message_log_page('carol', 'alice', 0, 10)), 1)
+        self.assertEqual(database.get_message_log_heads('bob'), {'alice': ids[2][0]})
+
+    def test_message_log_queue_hands_out_ids(self):
+        database.create_message_log_table()
+        database.append_message_log([('bob', 'alice', 'alice: zero')])
+        queue = MessageLogQueue(window=60)
+        ids = queue.append([('bob', 'alice', 'alice: one'), ('alice', 'bob', 'alice: one')])
+        ids += queue.append([('bob', 'alice', 'alice: two')])
+        self.assertEqual(ids, [(2, 1), (3, 0), (4, 2)])
+        self.assertEqual(database.get_message_log_page('bob', 'alice', 1, 10), [])
+        self.assertEqual(queue.flush(), 3)
+        self.assertEqual(database.get_message_log_page('bob', 'alice', 1, 10), [(2, 'alice: one'), (4, 'alice: two')])
+        self.assertEqual(database.get_message_log_heads('alice'), {'bob': 3})
+
+    def test_rows_from_before_the_message_log_are_unlogged(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("DROP TABLE offline_messages")
+        conn.execute("CREATE TABLE offline_messages (recipient TEXT, sender TEXT, message TEXT, enqueued_at REAL, size INTEGER)")
+        conn.execute("INSERT INTO offline_messages VALUES ('bob', 'alice', 'old', ?, 3)", (time.time(),))
+        conn.commit()
+        conn.close()
+        database.create_offline_messages_table()
+        database.add_offline_message('bob', 'alice', 'new')
+        self.assertEqual(database.get_offline_messages('bob'), [('alice', 'old'), ('alice', 'new')])
+        self.assertEqual(database.get_offline_messages('bob', logged=False), [('alice', 'old')])
+
+    @patch.object(database, 'OFFLINE_MAX_MESSAGES', 2)
+    @patch.object(database, 'OFFLINE_OVERFLOW_POLICY', 'reject')
+    def test_batch_insert(self):
+        stored = database.add_offline_messages([
+            ('bob', 'alice', 'one'), ('carol', 'alice', 'hi'),
+            ('bob', 'alice', 'two'), ('bob', 'alice', 'three'),
+        ])
+        self.assertEqual(stored, [True, True, True, False])
+        self.assertEqual(database.get_offline_messages('bob'), [('alice', 'one'), ('alice', 'two')])
+
+    def test_write_behind_groups_inserts(self):
+        queue = OfflineWriteQueue(window=60, max_rows=4)
+        acks = []
+        queue.put([('bob', 'alice', 'one'), ('carol', 'alice', 'hi')], acks.append)
+        queue.put([('bob', 'alice', 'two')], acks.append)
+        self.assertEqual(database.get_offline_messages('bob'), [])
+        self.assertEqual(queue.flush(), 3)
+        self.assertEqual(acks, [[True, True], [True]])
+        self.assertEqual(database.get_offline_messages('bob'), [('alice', 'one'), ('alice', 'two')])
+        # A full batch is written without waiting for the window
+        done = threading.Event()
+        queue.put([('dave', 'alice', str(i)) for i in range(4)], lambda stored: done.set())
+        self.assertTrue(done.wait(5))
+        self.assertEqual(queue.stats['batches'], 2)
+        self.assertEqual(len(database.get_offline_messages('dave')), 4)
+
+class TestFileTransfer(unittest.TestCase):
+    def setUp(self):
+        self.private_key, self.public_key = generate_rsa_keys(bit_length=512)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.source = os.path.join(self.tmpdir, 'source.bin')
+        self.payload = os.urandom(10 * 1024 + 17)
+        with open(self.source, 'wb') as f:
+            f.write(self.payload)
+
+    def transfer(self, sender, receiver):
+        while not sender.done:
+            chunks = list(sender.next_chunks())
+            self.assertLessEqual(len(chunks), sender.window)
+            for index, data in reversed(chunks):  # deliver out of order
+                sender.ack(receiver.write_chunk(index, data))
+
+    def test_round_trip_with_resume(self):
+        sender = FileSender(self.source, 'bob', self.public_key, chunk_size=1024, window=4)
+        receiver = FileReceiver(sender.offer('alice'), self.private_key, os.path.join(self.tmpdir, 'in'))
+
+        # Lose the connection after the first window, then resume from the receiver's position.
+        for index, data in list(sender.next_chunks())[:3]:
+            receiver.write_chunk(index, data)
+        sender.resume(receiver.next_index)
+        self.transfer(sender, receiver)
+
+        sender.close()
+        receiver.close()
+        self.assertTrue(receiver.done)
+        with open(receiver.path, 'rb') as f:
+            self.assertEqual(f.read(), self.payload)
+
+    def test_refills_are_encrypted_in_batches(self):
+        with patch('file_transfer.PARALLEL_MIN_BYTES', 8 * 1024):
+            sender = FileSender(self.source, 'bob', self.public_key, chunk_size=1024, window=4)
+        receiver = FileReceiver(sender.offer('alice'), self.private_key, os.path.join(self.tmpdir, 'in'))
+        with patch.object(sender, 'read_chunks', wraps=sender.read_chunks) as read_chunks:
+            self.transfer(sender, receiver)
+        self.assertEqual([c.args for c in read_chunks.call_args_list], [(0, 8), (8, 3)])
+        sender.close()
+        receiver.close()
+        with open(receiver.path, 'rb') as f:
+            self.assertEqual(f.read(), self.payload)
+
+    def test_chunks_are_encrypted(self):
+        sender = FileSender(self.source, 'bob', self.public_key, chunk_size=1024)
+        self.assertNotEqual(sender.read_chunk(0), self.payload[:1024])
+        sender.close()
+
+    def test_file_key_wraps_for_512_bit_keys(self):
+        private_key, public_key = generate_rsa_keys(bit_length=512)
+        with patch('file_transfer.os.urandom', side_effect=lambda n: b'\xff' * n):
+            sender = FileSender(self.source, 'bob', public_key)  # the largest file key
+        receiver = FileReceiver(sender.offer('alice'), private_key, os.path.join(self.tmpdir, 'in'))
+        self.assertEqual(receiver.file_key, sender.file_key)
+        sender.close()
+        receiver.close()
+
+    def test_empty_file(self):
+        empty = os.path.join(self.tmpdir, 'empty.bin')
+        open(empty, 'wb').close()
+        sender = FileSender(empty, 'bob', self.public_key)
+        receiver = FileReceiver(sender.offer('alice'), self.private_key, os.path.join(self.tmpdir, 'in'))
+        self.assertTrue(sender.done)
+        self.assertTrue(receiver.done)
+        sender.close()
+        receiver.close()
+        self.assertEqual(os.path.getsize(receiver.path), 0)
+
+    def test_chunks_outside_the_file_are_refused(self):
+        sender = FileSender(self.source, 'bob', self.public_key, chunk_size=1024)
+        receiver = FileReceiver(sender.offer('alice'), self.private_key, os.path.join(self.tmpdir, 'in'))
+        with self.assertRaises(ValueError):
+            receiver.write_chunk(sender.total_chunks, b'x' * 1024)
+        with self.assertRaises(ValueError):
+            receiver.write_chunk(-1, b'x' * 1024)
+        with self.assertRaises(ValueError):
+            receiver.write_chunk(sender.total_chunks - 1, b'x' * 1024)  # the last chunk is 17 bytes
+        offer = sender.offer('alice')
+        offer['total_chunks'] += 1
+        with self.assertRaises(ValueError):
+            FileReceiver(offer, self.private_key, os.path.join(self.tmpdir, 'in'))
+        sender.close()
+        receiver.close()
+        self.assertEqual(os.path.getsize(receiver.path), 0)
+
+class TestAES(unittest.TestCase):
+    PLAINTEXT = bytes.fromhex('00112233445566778899aabbccddeeff')
+
+    def test_fips197_vectors(self):
+        vectors = [
+            ('000102030405060708090a0b0c0d0e0f', '69c4e0d86a7b0430d8cdb78070b4c55a'),
+            ('000102030405060708090a0b0c0d0e0f1011121314151617', 'dda97ca4864cdfe06eaf70a0ec0d7191'),
+            ('000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f', '8ea2b7ca516745bfeafc49904b496089'),
+        ]
+        for key, expected in vectors:
+            cipher = AES(bytes.fromhex(key))
+            ciphertext = cipher.encrypt_block(self.PLAINTEXT)
+            self.assertEqual(ciphertext.hex(), expected)
+            self.assertEqual(cipher.decrypt_block(ciphertext), self.PLAINTEXT)
+
+    def test_ctr_sp800_38a_vector(self):
+        cipher = AESCTRCipher(bytes.fromhex('2b7e151628aed2a6abf7158809cf4f3c'), bytes.fromhex('f0f1f2f3f4f5f6f7'))
+        cipher.counter = 0xf8f9fafbfcfdfeff
+        ciphertext = cipher.encrypt(bytes.fromhex('6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51'))
+        self.assertEqual(ciphertext.hex(), '874d6191b620e3261bef6864990db6ce9806f66b7970fdff8617187bb9fffdff')
+
+    def test_ecb_round_trip(self):
+        key = os.urandom(16)
+        self.assertEqual(aes_decrypt(aes_encrypt("héllo wörld", key), key), "héllo wörld")
+
+    def test_encryption_manager_aes_ctr(self):
+        manager = EncryptionManager(os.urandom(32), cipher='aes-ctr')
+        message = "Test message" * 200
+        self.assertEqual(manager.decrypt_message(manager.encrypt_message(message)), message)
+
+class TestMultiPrimeRSA(unittest.TestCase):
+    def test_round_trip_by_prime_count(self):
+        for primes in (2, 3):
+            private_key, public_key = generate_rsa_keys(bit_length=1024, primes=primes)
+            self.assertEqual(len(private_key.primes), primes)
+            package = encrypt_chat_message("multi-prime", public_key)
+            self.assertEqual(decrypt_chat_message(package, private_key), "multi-prime")
+            # Keys stored without their primes decrypt the same message without CRT
+            legacy = custom_rsa.parse_private_key(f"{private_key.n},{private_key.e},{private_key.d}")
+            self.assertIsNone(legacy.crt)
+            self.assertEqual(decrypt_chat_message(package, legacy), "multi-prime")
+
+    def test_serialization(self):
+        private_key, _ = generate_rsa_keys(bit_length=1024, primes=3)
+        parsed = custom_rsa.parse_private_key(custom_rsa.serialize_private_key(private_key))
+        self.assertEqual((parsed.n, parsed.e, parsed.d, parsed.primes),
+                         (private_key.n, private_key.e, private_key.d, private_key.primes))
+        bad = custom_rsa.serialize_private_key(private_key).rsplit(",", 1)[0] + ",7"
+        with self.assertRaises(ValueError):
+            custom_rsa.parse_private_key(bad)
+
+    def test_falls_back_to_two_primes(self):
+        private_key, _ = generate_rsa_keys(bit_length=512, primes=3)
+        self.assertEqual(len(private_key.primes), 2)
+
+class TestCryptoBackends(unittest.TestCase):
+    def setUp(self):
+        self.previous = crypto_backends.selected('salsa20')
+
+    def tearDown(self):
+        crypto_backends.select('salsa20', self.previous)
+
+    def test_python_fallback_always_registered(self):
+        self.assertIn('python', crypto_backends.available('salsa20'))
+        self.assertIn('python', crypto_backends.available('powmod'))
+
+    def test_salsa20_conformance(self):
+        reference = crypto_backends.implementation('salsa20', 'python')
+        for name in crypto_backends.available('salsa20'):
+            impl = crypto_backends.implementation('salsa20', name)
+            for length in (0, 1, 63, 64, 65, 1000):
+                key, nonce, data = os.urandom(32), os.urandom(8), os.urandom(length)
+                self.assertEqual(impl(key, nonce, data), reference(key, nonce, data), name)
+                self.assertEqual(impl(key, nonce, data, 5), Salsa20Cipher(key, nonce, counter=5).encrypt(data), name)
+
+    @patch.object(parallel_salsa20, 'PARALLEL_MIN_BYTES', 0)
+    def test_parallel_salsa20_matches_serial(self):
+        self.addCleanup(parallel_salsa20.shutdown)
+        key, nonce = os.urandom(32), os.urandom(8)
+        self.assertEqual(parallel_salsa20.split_ranges(1000, 4), [(0, 256), (256, 512), (512, 768), (768, 1000)])
+        for length, counter in ((1000, 0), (64 * 7 + 5, 3), (10, 0)):
+            data = os.urandom(length)
+            serial = Salsa20Cipher(key, nonce, counter=counter).encrypt(data)
+            self.assertEqual(parallel_salsa20.salsa20_xor(key, nonce, data, counter, workers=3), serial)
+
+    def test_powmod_conformance(self):
+        for name in crypto_backends.available('powmod'):
+            impl = crypto_backends.implementation('powmod', name)
+            for _ in range(20):
+                base, exponent, modulus = (int.from_bytes(os.urandom(64), 'big') for _ in range(3))
+                self.assertEqual(impl(base, exponent, modulus | 1), pow(base, exponent, modulus | 1), name)
+
+    def test_cross_backend_messages(self):
+        private_key, public_key = generate_rsa_keys(bit_length=1024)
+        for sender in crypto_backends.available('salsa20'):
+            for receiver in crypto_backends.available('salsa20'):
+                crypto_backends.select('salsa20', sender)
+                package = encrypt_chat_message("interop", public_key)
+                crypto_backends.select('salsa20', receiver)
+                self.assertEqual(decrypt_chat_message(package, private_key), "interop")
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.private_key, self.public_key = generate_rsa_keys(bit_length=1024)
+
+    def test_short_message_skips_compression(self):
+        package = encrypt_chat_message("hi", self.public_key)
+        self.assertNotIn('compression', package)
+        self.assertEqual(decrypt_chat_message(package, self.private_key), "hi")
+
+    def test_long_message_is_compressed(self):
+        message = "Traceback (most recent call last):\n" + "  File \"app.py\", line 10, in main\n" * 50
+        package = encrypt_chat_message(message, self.public_key)
+        self.assertIn(package['compression'], compression.ALGORITHMS)
+        self.assertLess(len(package['encrypted_message']), len(message.encode('utf-8')))
+        self.assertEqual(decrypt_chat_message(package, self.private_key), message)
+
+    def test_every_algorithm_round_trips(self):
+        data = ("see you later, talk to you soon " * 20).encode('utf-8')
+        for algorithm in compression.ALGORITHMS:
+            name, payload = compression.compress(data, algorithm)
+            self.assertEqual(name, algorithm)
+            self.assertEqual(compression.decompress(name, payload), data)
+
+    def test_incompressible_data_is_left_alone(self):
+        self.assertEqual(compression.compress(os.urandom(500))[0], None)
+
+    def test_group_message_compression(self):
+        message = "good morning everyone, " * 20
+        package = encrypt_group_message(message, {'alice': self.public_key})
+        self.assertIn('compression', package)
+        self.assertEqual(decrypt_group_message(package, 'alice', self.private_key), message)
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.bin')
+        os.close(fd)
+        os.remove(self.path)
+        self.key = os.urandom(32)
+        self.index = SearchIndex(self.path, self.key)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_search_returns_message_ids(self):
+        self.index.add('bob', 0, "lunch at noon?")
+        self.index.add('bob', 1, "sure, see you there")
+        self.index.add('carol', 0, "Lunch tomorrow instead")
+        results = self.index.search("lunch")
+        self.assertEqual(sorted((c, i) for c, i, _ in results), [('bob', 0), ('carol', 0)])
+        self.assertEqual(self.index.search('"unbalanced'), [])
+
+    def test_persisted_encrypted(self):
+        self.index.add('bob', 3, "the secret password is swordfish")
+        self.index.close()
+        with open(self.path, 'rb') as f:
+            self.assertNotIn(b"swordfish", f.read())
+        reopened = SearchIndex(self.path, self.key)
+        self.assertEqual(reopened.search("sword"), [('bob', 3, "the secret password is swordfish")])
+        wrong_key = SearchIndex(self.path, os.urandom(32))
+        self.assertEqual(wrong_key.search("sword"), [])
+
+    def test_modified_file_is_discarded(self):
+        self.index.add('bob', 3, "meet at the usual place")
+        self.index.close()
+        with open(self.path, 'r+b') as f:
+            f.seek(100)
+            byte = f.read(1)
+            f.seek(100)
+            f.write(bytes([byte[0] ^ 1]))
+        self.assertEqual(SearchIndex(self.path, self.key).search("usual"), [])
+
+    @patch('search_index.SEARCH_SAVE_EVERY', 10)
+    def test_concurrent_adds_save_once_per_batch(self):
+        with patch.object(self.index, 'save', wraps=self.index.save) as save:
+            threads = [threading.Thread(target=lambda t=t: [self.index.add('bob', t * 25 + i, f"message {i}") for i in range(25)])
+                       for t in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # A save snapshots everything added so far, so racing adds never save twice
+        self.assertLessEqual(save.call_count, 10)
+        self.index.close()
+        self.assertEqual(len(SearchIndex(self.path, self.key).search("message", limit=200)), 100)
+
+    def test_remove_contact(self):
+        self.index.add('bob', 0, "hello there")
+        self.index.remove_contact('bob')
+        self.assertEqual(self.index.search("hello"), [])
+
+class TestKeyDirectory(unittest.TestCase):
+    def setUp(self):
+        fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE users (username TEXT PRIMARY KEY, rsa_private TEXT, rsa_public TEXT)")
+        conn.executemany("INSERT INTO users VALUES (?, '', ?)", [('alice', '11,3'), ('bob', '15,7')])
+        conn.commit()
+        conn.close()
+        self.http = app.test_client()
+        self.requests = 0
+
+    def lookup(self, usernames, etag=None):
+        # Same contract as chat_client.KeyDirectory, over the Flask test client.
+        self.requests += 1
+        headers = {'If-None-Match': f'"{etag}"'} if etag else {}
+        response = self.http.post('/keys', json={'usernames': usernames}, headers=headers)
+        return None if response.status_code == 304 else response.get_json()['keys']
+
+    def test_bulk_lookup_and_etag(self):
+        with patch.object(database, 'DATABASE_PATH', self.db_path):
+            response = self.http.post('/keys', json={'usernames': ['alice', 'bob', 'nobody']})
+            self.assertEqual(response.status_code, 200)
+            body = response.get_json()
+            self.assertEqual(body['keys']['bob']['rsa_public'], '15,7')
+            self.assertEqual(body['missing'], ['nobody'])
+            etag = response.headers['ETag']
+            response = self.http.post('/keys', json={'usernames': ['alice', 'bob', 'nobody']}, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+
+    def test_cache_revalidation(self):
+        with patch.object(database, 'DATABASE_PATH', self.db_path):
+            cache = KeyCache()
+            # First use pins the keys
+            self.assertEqual(cache.revalidate(self, ['alice', 'bob']), [])
+            self.assertEqual((cache['bob'].n, cache['bob'].e), (15, 7))
+            self.assertEqual(cache.revalidate(self, ['alice', 'bob']), [])
+            conn = sqlite3.connect(self.db_path)
+            conn.execute("UPDATE users SET rsa_public = '21,5' WHERE username = 'bob'")
+            conn.commit()
+            conn.close()
+            # A changed key is held back until it is accepted
+            self.assertEqual(cache.revalidate(self, ['alice', 'bob']), ['bob'])
+            self.assertEqual((cache['bob'].n, cache['bob'].e), (15, 7))
+            cache.accept('bob')
+            self.assertEqual((cache['bob'].n, cache['bob'].e), (21, 5))
+            self.assertEqual(cache.revalidate(self, ['alice', 'bob']), [])
+            self.assertEqual(self.requests, 4)
+
+    def test_lookup_needs_a_list_of_usernames(self):
+        with patch.object(database, 'DATABASE_PATH', self.db_path):
+            for usernames in ('alice', {'alice': 1}, [1, 2], None):
+                response = self.http.post('/keys', json={'usernames': usernames})
+                self.assertEqual(response.status_code, 400)
+
+class TestSessionTokens(unittest.TestCase):
+    def setUp(self):
+        import bcrypt
+        fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, self.db_path)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE users (username TEXT PRIMARY KEY, password TEXT)")
+        conn.execute("INSERT INTO users VALUES ('alice', ?)", (bcrypt.hashpw(b'secret', bcrypt.gensalt(4)).decode('utf-8'),))
+        conn.commit()
+        conn.close()
+        self.signer = TokenSigner(os.urandom(32), ttl=600)
+        patcher = patch.object(session_tokens, 'signer', self.signer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.http = app.test_client()
+
+    def post(self, path, payload):
+        # Same contract as SessionAuth._post, over the Flask test client.
+        response = self.http.post('/auth' + path, json=payload)
+        return None if response.status_code == 401 else response.get_json()
+
+    def test_verify(self):
+        token, expires_at = self.signer.issue('alice', now=1000)
+        self.assertEqual(expires_at, 1600)
+        self.assertEqual(self.signer.verify(token, now=1500), 'alice')
+        self.assertIsNone(self.signer.verify(token, now=1600))
+        name, expiry, signature = token.split('.')
+        self.assertIsNone(self.signer.verify(f"{name}.{int(expiry) + 600}.{signature}", now=1500))
+        self.assertIsNone(TokenSigner(os.urandom(32)).verify(token, now=1500))
+        self.assertIsNone(self.signer.verify('not a token'))
+        self.assertIsNone(self.signer.verify('é.1.abc'))
+        self.assertIsNone(self.signer.verify('a.1.é'))
+
+    def test_short_secrets_are_refused(self):
+        path = os.path.join(tempfile.mkdtemp(), 'secret.key')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with patch.object(session_tokens, 'SESSION_SECRET_PATH', path), patch.dict(os.environ, {'VIBER_SESSION_SECRET': ''}):
+            self.assertEqual(len(session_tokens._load_secret()), 32)  # created on first use
+            with open(path, 'wb') as f:
+                f.write(b'short')
+            with self.assertRaises(ValueError):
+                session_tokens._load_secret()
+            with patch.dict(os.environ, {'VIBER_SESSION_SECRET': 'ab' * 16}):
+                with self.assertRaises(ValueError):
+                    session_tokens._load_secret()
+
+    def test_login_and_refresh(self):
+        with patch.object(database, 'DATABASE_PATH', self.db_path):
+            database.create_session_tokens_table()
+            self.assertIsNone(self.post('/login', {'username': 'alice', 'password': 'wrong'}))
+            self.assertIsNone(self.post('/login', {'username': 'nobody', 'password': 'secret'}))
+            auth = SessionAuth()
+            with patch.object(auth, '_post', self.post):
+                token = auth.login('alice', 'secret')
+                self.assertEqual(self.signer.verify(token), 'alice')
+                self.assertEqual(auth.stored()[:2], ('alice', token))
+                with patch('chat_client.SESSION_REFRESH_MARGIN', 60):
+                    self.assertEqual(auth.token('alice'), token)
+                # Within the refresh margin (default one hour, longer than this
+                # signer's ttl) the token is exchanged for a new one
+                with patch('time.time', return_value=time.time() + 5):
+                    refreshed = auth.token('alice')
+                self.assertNotEqual(refreshed, token)
+                self.assertEqual(auth.stored('alice')[1], refreshed)
+                auth.forget('alice')
+                self.assertIsNone(auth.stored())
+                self.assertIsNone(self.post('/refresh', {'token': 'forged'}))
+
+    def test_register_requires_token(self):
+        client = socketio.test_client(app, namespace='/chat')
+        client.get_received('/chat')
+        failed = server.chat_namespace.counters['auth_failed']
+        client.emit('register', {'username': 'token_alice', 'token': self.signer.issue('token_bob')[0]}, namespace='/chat')
+        received = client.get_received('/chat')
+        self.assertEqual([r['name'] for r in received], ['auth_failed'])
+        self.assertEqual(server.chat_namespace.counters['auth_failed'], failed + 1)
+        self.assertFalse(server.chat_namespace.presence.is_online('token_alice'))
+        client.emit('register', {'username': 'token_alice', 'token': self.signer.issue('token_alice')[0]}, namespace='/chat')
+        self.assertNotIn('auth_failed', [r['name'] for r in client.get_received('/chat')])
+        client.disconnect(namespace='/chat')
+
+class TestProfiling(unittest.TestCase):
+    def test_disabled_stage_is_shared_no_op(self):
+        profiler = Profiler(enabled=False)
+        self.assertIs(profiler.stage("send"), profiler.stage("receive"))
+        with profiler.stage("send"):
+            pass
+        self.assertEqual(profiler.stats, {})
+
+    def test_histogram_and_report(self):
+        profiler = Profiler(enabled=True)
+        for _ in range(99):
+            profiler.record("send.encrypt", 0.0001)
+        profiler.record("send.encrypt", 0.05)
+        with profiler.stage("render"):
+            pass
+        stats = profiler.stats["send.encrypt"]
+        self.assertEqual(stats.count, 100)
+        self.assertLessEqual(stats.percentile(0.5), 0.000128)
+        self.assertEqual(stats.percentile(1.0), 0.05)
+        report = profiler.report()
+        self.assertIn("send.encrypt", report)
+        self.assertIn("render", report)
+
+    def test_capture_window(self):
+        profiler = Profiler(enabled=True, capture='tracemalloc', capture_seconds=0)
+        with profiler.stage("send"):
+            data = [bytearray(1024) for _ in range(100)]
+        with profiler.stage("send"):
+            pass
+        self.assertIsNone(profiler.capture_until)
+        self.assertIn("tracemalloc capture", profiler.report())
+        del data
+
+    def test_unknown_capture_is_ignored(self):
+        profiler = Profiler(enabled=True, capture='perf')
+        self.assertIsNone(profiler.capture_kind)
+        with profiler.stage("send"):
+            pass
+        self.assertEqual(profiler.stats["send"].count, 1)
+
+    def test_profile_flag(self):
+        for value, enabled in (('1', True), ('yes', True), ('0', False), ('false', False), ('', False)):
+            with patch.dict(os.environ, {'VIBER_PROFILE': value}):
+                self.assertEqual(profiling.env_flag('VIBER_PROFILE'), enabled)
+
+    def test_capture_seconds(self):
+        for value, seconds in (('5', 5.0), ('0.5', 0.5), ('', 30), ('soon', 30), ('-1', 30), ('nan', 30)):
+            with patch.dict(os.environ, {'VIBER_PROFILE_CAPTURE_SECONDS': value}):
+                self.assertEqual(profiling.env_seconds('VIBER_PROFILE_CAPTURE_SECONDS', 30), seconds)
+
+class TestTranscriptModel(unittest.TestCase):
+    def setUp(self):
+        self.decrypted = []
+
+    def decrypt(self, package):
+        self.decrypted.append(package['n'])
+        return f"secret {package['n']}"
+
+    def test_rows_are_decrypted_on_demand(self):
+        messages = [f'bob: {{"n": {i}}}' for i in range(1000000)]
+        model = TranscriptModel(self.decrypt, cache_rows=10)
+        model.show('bob', messages)
+        self.assertEqual(model.rowCount(), 1000000)
+        self.assertEqual(self.decrypted, [])
+        self.assertEqual(model.data(model.index(999999)), "bob: secret 999999")
+        for i in range(20):
+            model.data(model.index(i), SenderRole)
+        self.assertEqual(len(self.decrypted), 21)
+        self.assertEqual(len(model.rows), 10)
+
+    def test_append_and_file_rows(self):
+        messages = ["alice: plain text"]
+        model = TranscriptModel(self.decrypt)
+        model.show('alice', messages)
+        inserted = []
+        model.rowsInserted.connect(lambda parent, first, last: inserted.append((first, last)))
+        messages.append("File Received: downloads/report.pdf")
+        model.show('alice', messages)
+        self.assertEqual(inserted, [(1, 1)])
+        self.assertEqual(model.data(model.index(0)), "alice: plain text")
+        self.assertEqual(model.data(model.index(1), FileRole), "downloads/report.pdf")
+        self.assertEqual(self.decrypted, [])
+
+class TestMessageRecords(unittest.TestCase):
+    def test_round_trip(self):
+        private_key, public_key = generate_rsa_keys(bit_length=1024)
+        package = encrypt_chat_message("hello " * 20, public_key)
+        entries = [
+            "alice: " + json.dumps(package), "bob: hi alice", "", "no sender here",
+            "File Sent: /tmp/a b.txt", "alice: \u00e9\u00e8 \"DEADBEEFDEADBEEF\" \"0123456789abcdef0\"",
+        ]
+        senders = SenderNames()
+        records = MessageRecords(senders, entries)
+        self.assertEqual(records, entries)
+        self.assertEqual(records[-1], entries[-1])
+        self.assertEqual(records[1:3], entries[1:3])
+        self.assertEqual((records.sender(0), records.sender(2)), ('alice', None))
+        # Hex in the package is stored as raw bytes
+        self.assertLess(records.offsets[1] - records.offsets[0], len(entries[0]) * 0.6)
+        MessageRecords(senders, ["alice: again"])
+        self.assertEqual(senders.names, ['alice', 'bob', 'File Sent'])
+
+    def test_history_store_uses_records(self):
+        history = HistoryStore('alice', persist=False)
+        history.append('bob', "bob: hi")
+        self.assertIsInstance(history.messages('bob'), MessageRecords)
+        self.assertTrue(history.contains('bob', "bob: hi"))
+        self.assertGreater(history.messages('bob').timestamp(0), 0)
+
+    def test_contains_looks_at_recent_entries(self):
+        history = HistoryStore('alice', persist=False)
+        with patch('chat_client.RECENT_ENTRIES', 3):
+            for i in range(5):
+                history.append('bob', f"bob: {i}")
+            self.assertTrue(history.contains('bob', "bob: 4"))
+            history.append('bob', "bob: 5")
+            self.assertFalse(history.contains('bob', "bob: 2"))
+            self.assertTrue(history.contains('bob', "bob: 3"))
+            self.assertFalse(history.contains('bob', "bob: never"))
+
+class TestContactList(unittest.TestCase):
+    def setUp(self):
+        self.summaries = ContactSummaries('alice', persist=False)
+        self.model = ContactListModel(self.summaries, lambda contact, preview_id: f"{contact} #{preview_id}")
+        self.contacts = [f"user{i:05d}" for i in range(10000)]
+        for i, contact in enumerate(self.contacts):
+            self.summaries.touch(contact, 0, at=float(i))
+        self.model.load(self.contacts)
+
+    def test_sorted_by_recency(self):
+        self.assertEqual(self.model.contact(0), "user09999")
+        moved = []
+        self.model.rowsMoved.connect(lambda *args: moved.append((args[1], args[4])))
+        self.summaries.touch("user00042", 7, unread=True, at=20000.0)
+        self.model.update("user00042")
+        self.assertEqual(moved, [(9957, 0)])
+        self.assertEqual(self.model.contact(0), "user00042")
+        self.assertEqual(self.model.contact(1), "user09999")
+        self.assertEqual(self.model.data(self.model.index(0), UnreadRole), 1)
+        self.assertEqual(self.model.data(self.model.index(0), PreviewRole), "user00042 #7")
+        self.assertEqual(self.model.rows, sorted(self.model.rows, key=self.model._sort_key))
+
+    def test_prefix_filter(self):
+        self.model.set_filter("USER0999")
+        self.assertEqual(self.model.rowCount(), 10)
+        self.assertEqual(self.model.contact(0), "user09999")
+        self.model.update("user09995")  # unchanged summary: stays in place
+        self.assertEqual(self.model.row_of("user09995"), 4)
+        self.model.update("newcomer")
+        self.assertEqual(self.model.row_of("newcomer"), -1)
+        self.assertIn("newcomer", self.model)
+        self.model.remove("user09990")
+        self.assertEqual(self.model.rowCount(), 9)
+        self.model.set_filter("")
+        self.assertEqual(self.model.rowCount(), 10000)
+        self.assertEqual(self.model.contact(9998), "newcomer")  # no messages yet: sorted with user00000 (time 0) by name
+
+    def test_summary_table(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_contact_summary_table()
+            summaries = ContactSummaries('alice')
+            summaries.touch('bob', 0, unread=True, at=10.0)
+            summaries.touch('bob', 1, unread=True, at=5.0)
+            self.assertEqual(database.get_contact_summaries('alice'), [])
+            summaries.write(summaries.take_pending())
+            self.assertEqual(database.get_contact_summaries('alice'), [('bob', 10.0, 2, 1)])
+            summaries.mark_read('bob')
+            self.assertEqual(database.get_contact_summaries('alice'), [('bob', 10.0, 0, 1)])
+            summaries.remove('bob')
+            self.assertEqual(database.get_contact_summaries('alice'), [])
+
+class TestChatSession(unittest.TestCase):
+    def setUp(self):
+        self.sessions = {}
+        for name in ('alice', 'bob'):
+            private_key, public_key = generate_rsa_keys(bit_length=1024)
+            self.sessions[name] = ChatSession(name, private_key, public_key)
+        self.sessions['alice'].keys['bob'] = self.sessions['bob'].public_key
+        self.sessions['bob'].keys['alice'] = self.sessions['alice'].public_key
+
+    def test_round_trip(self):
+        alice, bob = self.sessions['alice'], self.sessions['bob']
+        event, payload = alice.prepare_message('bob', "Hello, Bob!")
+        self.assertEqual(event, 'message')
+        self.assertEqual(payload['recipient'], 'bob')
+        self.assertEqual(bob.receive(payload['text']), ('alice', 'alice', "Hello, Bob!"))
+        self.assertEqual(bob.history.messages('alice'), ["alice: Hello, Bob!"])
+        self.assertEqual(len(alice.history.messages('bob')), 1)
+
+    def test_key_rotation_keeps_history_readable(self):
+        alice, bob = self.sessions['alice'], self.sessions['bob']
+        _, before = alice.prepare_message('bob', "before")
+        old_fingerprint = bob.private_key.fingerprint
+        new_fingerprint = bob.rotate_keys(bit_length=1024, persist=False)
+        self.assertNotEqual(new_fingerprint, old_fingerprint)
+        alice.keys['bob'] = bob.public_key
+        _, after = alice.prepare_message('bob', "after")
+        self.assertEqual(json.loads(after['text'].split(": ", 1)[1])['key_fp'], new_fingerprint)
+        self.assertEqual(bob.receive(before['text'])[2], "before")
+        self.assertEqual(bob.receive(after['text'])[2], "after")
+        package = json.loads(after['text'].split(": ", 1)[1])
+        package['key_fp'] = "0" * 16
+        with self.assertRaises(ValueError):
+            bob.decrypt_package(package)
+
+    def test_keyring_is_persisted(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        bob = self.sessions['bob']
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_user_keys_table()
+            conn = sqlite3.connect(db_path)
+            conn.execute("CREATE TABLE users (username TEXT, rsa_public TEXT, rsa_private TEXT)")
+            key = bob.private_key
+            conn.execute("INSERT INTO users VALUES ('bob', ?, ?)", (f"{key.n},{key.e}", f"{key.n},{key.e},{key.d}"))
+            conn.commit()
+            conn.close()
+            bob.keyring = load_keyring('bob', bob.private_key)
+            self.assertEqual(len(bob.keyring), 1)
+            bob.rotate_keys(bit_length=1024)
+            self.assertEqual(database.get_user_keys('bob')[1], f"{bob.public_key.n},{bob.public_key.e}")
+            keyring = load_keyring('bob', bob.private_key)
+            self.assertEqual(len(keyring), 2)
+            self.assertEqual(keyring.oldest.d, key.d)
+            self.assertEqual(keyring.current.fingerprint, bob.public_key.fingerprint)
+
+    def test_sent_messages_are_saved_together(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        alice = self.sessions['alice']
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_table_if_not_exists()
+            database.create_history_records_table()
+            database.create_contact_summary_table()
+            conn = sqlite3.connect(db_path)
+            conn.execute("CREATE TABLE users (username TEXT, rsa_public TEXT, rsa_private TEXT)")
+            conn.commit()
+            conn.close()
+            alice.history = HistoryStore('alice')
+            alice.summaries = ContactSummaries('alice')
+            for text in ("one", "two", "three"):
+                alice.prepare_message('bob', text)
+            self.assertEqual(database.get_contacts('alice'), [])
+            pending = alice.take_pending()
+            self.assertEqual(alice.take_pending(), ([], []))
+            alice.write_pending(pending)
+            self.assertEqual([row[0] for row in database.get_contacts('alice')], ['bob'])
+            records = database.get_history_records('alice')
+            self.assertEqual([entry for _, entry, _ in records], alice.history.messages('bob'))
+            self.assertEqual(len(alice.history.messages('bob')), 3)
+            self.assertEqual([row[0] for row in database.get_contact_summaries('alice')], ['bob'])
+
+    def test_history_saves_only_new_entries(self):
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, db_path)
+        with patch.object(database, 'DATABASE_PATH', db_path):
+            database.create_table_if_not_exists()
+            conn = sqlite3.connect(db_path)
+            conn.execute("CREATE TABLE users (username TEXT, rsa_public TEXT, rsa_private TEXT)")
+            conn.execute("INSERT INTO dashboard (username, contact, chat_history) VALUES ('alice', 'bob', 'bob: old\nalice: older')")
+            conn.commit()
+            conn.close()
+            database.create_history_records_table()  # moves the old newline-joined history over
+
+            history = HistoryStore('alice')
+            history.load()
+            self.assertEqual(history.messages('bob'), ["bob: old", "alice: older"])
+            history.append('bob', "bob: new")
+            history.mark('bob', 7)
+            pending = history.take_pending()
+            self.assertEqual([len(rows) for _, rows, _, _ in pending], [1])
+            history.write(pending)
+
+            reloaded = HistoryStore('alice')
+            reloaded.load()
+            self.assertEqual(reloaded.messages('bob'), history.messages('bob'))
+            self.assertEqual(reloaded.messages('bob').timestamp(2), history.messages('bob').timestamp(2))
+            self.assertGreater(reloaded.messages('bob').timestamp(2), 0)
+            self.assertEqual(database.get_sync_cursors('alice'), {'bob': 7})
+
+            reloaded.remove('bob')
+            self.assertEqual(database.get_contacts('alice'), [])
+            self.assertEqual(database.get_history_records('alice'), [])
+
+    def test_group_message(self):
+        alice, bob = self.sessions['alice'], self.sessions['bob']
+        alice.groups['team'] = ['alice', 'bob']
+        event, payload = alice.prepare_message('team', "Hi team")
+        self.assertEqual((event, payload['group']), ('group_message', 'team'))
+        # A group created since the session started is picked up on its first message
+        bob.load_groups = lambda: {'team': ['alice', 'bob']}
+        self.assertEqual(bob.receive(payload['text']), ('team', 'alice', "Hi team"))
+
+    def test_group_field_must_name_a_group_of_the_sender(self):
+        alice, bob = self.sessions['alice'], self.sessions['bob']
+        bob.groups['family'] = ['bob', 'carol']
+        _, payload = alice.prepare_message('bob', "not really from carol")
+        package = json.loads(payload['text'].split(": ", 1)[1])
+        for group in ('family', 'bob', 'nonexistent'):
+            package['group'] = group
+            with self.assertRaises(ChatClientError):
+                bob.receive("alice: " + json.dumps(package))
+        self.assertEqual(bob.rejected['not_member'], 3)
+        self.assertEqual(bob.history.messages('family'), [])
+
+    def test_errors(self):
+        alice, bob = self.sessions['alice'], self.sessions['bob']
+        with self.assertRaises(ChatClientError):
+            alice.prepare_message('carol', "hi")
+        with self.assertRaises(ChatClientError) as ctx:
+            bob.receive("garbage")
+        self.assertEqual(ctx.exception.conversation, "Unknown")
+
+    def test_own_messages_are_not_duplicated(self):
+        alice = self.sessions['alice']
+        event, payload = alice.prepare_message('bob', "hi")
+        # The copy logged back to us is filed under the recipient, once
+        self.assertEqual(alice.receive(payload['text'], 7), ('bob', 'alice', None))
+        self.assertEqual(alice.history.messages('bob'), [payload['text']])
+
+    def test_history_sync_fills_gaps(self):
+        log = HistorySync({'alice': 10})
+        live = {'conversation': 'alice', 'text': 'alice: late', 'log_id': 30, 'prev_log_id': 20}
+        self.assertEqual(log.accept(live), ([], True))
+        entries, more = log.apply_page({'pages': {'alice': [[15, 'alice: a'], [20, 'alice: b']]}, 'more': False})
+        self.assertEqual([text for text, _ in entries], ['alice: a', 'alice: b', 'alice: late'])
+        self.assertEqual(log.cursors['alice'], 30)
+        self.assertEqual(log.accept(live), ([], False))
+
+    def test_outgoing_batcher(self):
+        sent = []
+        batcher = OutgoingBatcher(lambda event, payload: sent.append((event, payload)), window=60, max_batch=3)
+        batcher.send('message', {'text': 'a'})
+        batcher.send('message', {'text': 'b'})
+        self.assertEqual(sent, [])
+        batcher.send('group_message', {'text': 'c'})
+        batcher.send('message', {'text': 'd'})
+        batcher.flush()
+        self.assertEqual(sent, [
+            ('message_batch', [{'text': 'a'}, {'text': 'b'}]),
+            ('group_message', {'text': 'c'}),
+            ('message', {'text': 'd'}),
+        ])
+
+    def test_outgoing_batcher_retries_throttled_messages(self):
+        sent = []
+        batcher = OutgoingBatcher(lambda event, payload: sent.append((event, payload)), window=60, max_batch=2)
+        batcher.send('message', {'text': 'c'})
+        batcher.retry('message_batch', [{'text': 'a'}, {'text': 'b'}], 60)
+        batcher.flush()
+        self.assertEqual(sent, [
+            ('message_batch', [{'text': 'a'}, {'text': 'b'}]),
+            ('message', {'text': 'c'}),
+        ])
+
+class TestContactFunctions(unittest.TestCase):
+    app = QApplication([])
+    def setUp(self):
+        self.contact = ContactFunctions()
+
+    @patch('contact_functions.QMessageBox.warning')
+    @patch('contact_functions.QInputDialog.getText')
+    def test_add_contact(self, mock_getText, mock_warning):
+        # Mock the user input and the key directory, which does not know the user
+        mock_getText.return_value = ('testuser', True)
+        self.contact.key_directory = MagicMock()
+        self.contact.key_directory.lookup.return_value = {}
+        self.contact.chat_history = {}
+
+        # Call the method
+        self.contact.add_contact()
+
+        # Check that the method called the mock functions with the correct arguments
+        mock_getText.assert_called_once_with(self.contact, "Add Contact", "Enter the name of the new contact:")
+        self.contact.key_directory.lookup.assert_called_once_with(['testuser'])
+        mock_warning.assert_called_once_with(self.contact, "Error", "User does not exist.")
+
+class TestMainWindow(unittest.TestCase):
+    app = QApplication([])
+    def setUp(self):
+        self.username = 'testuser'
+        self.main_window = MainWindow(self.username)
+        self.main_window.contact_list_widget = MagicMock()
+        self.main_window.chat_input_widget = MagicMock()
+        self.main_window.chat_history_widget = MagicMock()
+        self.main_window.chat_header_widget = MagicMock()
+        self.main_window.stacked_widget = MagicMock()
+        self.main_window.chat_widget = MagicMock()
+        self.main_window.socketio = MagicMock()
+        self.main_window.update_gui_signal = MagicMock()
+        self.main_window.chat_history = {'testuser': []}
+        self.main_window.encryption_manager = MagicMock()
+        self.main_window.animation = MagicMock()
+
+    @patch('mainwindow.get_contacts')
+    def test_init(self, mock_get_contacts):
+        mock_get_contacts.return_value = [('testuser', 'Hello\\n')]
+        main_window = MainWindow(self.username)
+        self.assertEqual(main_window.username, self.username)
+        self.assertIsInstance(main_window.cipher_suite, Fernet)
+        # self.assertIsInstance(main_window.encryption_manager, MagicMock)
+        # self.assertIsInstance(main_window.animation, MagicMock)
+
+    def test_encrypt_message(self):
+        message = 'Hello'
+        self.main_window.encryption_manager.encrypt_message.return_value = 'encrypted_message'
+        result = self.main_window.encrypt_message(message)
+        self.assertEqual(result, 'encrypted_message')
+
+    def test_decrypt_message(self):
+        encrypted_message = 'encrypted_message'
+        self.main_window.encryption_manager.decrypt_message.return_value = 'message'
+        result = self.main_window.decrypt_message(encrypted_message)
+        self.assertEqual(result, 'message')
+
+    def test_on_connect(self):
+        self.main_window.auth = MagicMock()
+        self.main_window.auth.token.return_value = 'token'
+        self.main_window.on_connect()
+        self.main_window.socketio.emit.assert_called_with('register', {'username': self.username, 'token': 'token', 'sync': True}, namespace='/chat')
+
+    def test_update_gui(self):
+        sender = 'testuser'
+        self.main_window.contact_list_widget.currentItem.return_value.text.return_value = sender
+        self.main_window.update_gui(sender)
+        # self.main_window.display_chat_history.assert_called_with(sender)
+
+    @patch('mainwindow.QMessageBox.question')
+    def test_closeEvent(self, mock_question):
+        mock_question.return_value = QMessageBox.Yes
+        event = MagicMock()
+        self.main_window.closeEvent(event)
+        event.accept.assert_called_once()
+
+    @patch('chat_functions.QMessageBox.warning')
+    def test_rejected_message_goes_to_the_status_bar(self, mock_warning):
+        self.main_window.receive_text('no separator here')
+        self.app.processEvents()
+        mock_warning.assert_not_called()
+        self.assertIn("Message rejected", self.main_window.statusBar().currentMessage())
+
+    def test_socket_events_run_on_the_gui_thread(self):
+        seen = []
+        self.main_window.on_socket_event('probe', lambda data: seen.append((data, threading.current_thread())))
+        callback = self.main_window.socketio.on.call_args.args[1]
+        thread = threading.Thread(target=callback, args=('x',))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [])
+        self.app.processEvents()
+        self.assertEqual(seen, [('x', threading.main_thread())])
+
+    def test_getUsername(self):
+        self.assertEqual(self.main_window.getUsername(), self.username)
+
+    def test_setUsername(self):
+        new_username = 'newuser'
+        self.main_window.setUsername(new_username)
+        self.assertEqual(self.main_window.getUsername(), new_username)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+# write_behind.py
+"""
+Group commit for the server's offline-message inserts.
+
+Every handler that stores messages for offline recipients puts them on one
+OfflineWriteQueue instead of opening its own transaction. A background
+thread writes whatever has queued up in a single add_offline_messages call
+once OFFLINE_WRITE_WINDOW seconds have passed since the first pending row,
+or as soon as OFFLINE_WRITE_BATCH rows are waiting. With a window of 0 the
+thread writes immediately, and rows that arrive while a transaction commits
+go into the next one.
+
+A caller learns that its rows are durable through its callback, which runs
+on the writer thread after the commit with the per-row results. Readers of
+the offline store call flush() first, so they see every queued row.
+
+MessageLogQueue does the same for the message log. It hands out log ids
+itself, so routing a message never waits for sqlite.
+"""
+import atexit
+import threading
+import time
+from collections import Counter
+from database import add_offline_messages, write_message_log, get_message_log_next_id, get_message_log_head
+
+# Seconds a row may wait for others to share its transaction. The commit
+# itself already gathers the rows that arrive meanwhile, and with handlers
+# that wait for their ack a longer window only adds latency (see
+# `python benchmark.py offline_writes`).
+OFFLINE_WRITE_WINDOW = 0
+OFFLINE_WRITE_BATCH = 256      # rows that trigger a write without waiting for the window
+
+
+class OfflineWriteQueue:
+    """
+    `write(messages)` stores (recipient, sender, text) tuples in one
+    transaction and returns a bool per message, like add_offline_messages.
+    """
+    name = "offline-writer"
+
+    def __init__(self, window=OFFLINE_WRITE_WINDOW, max_rows=OFFLINE_WRITE_BATCH, write=add_offline_messages):
+        self.window = window
+        self.max_rows = max_rows
+        self.write = write
+        self.pending = []          # (messages, callback), in arrival order
+        self.pending_rows = 0
+        self.first_at = 0.0        # when the oldest pending row arrived
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()  # one transaction at a time, in queue order
+        self.thread = None
+        self.stats = Counter()     # batches / rows / rejected
+
+    def put(self, messages, callback=None):
+        """
+        Queues (recipient, sender, text) tuples. `callback(stored)` is called
+        with a bool per message once they are committed (or rejected).
+        """
+        if not messages:
+            return
+        with self.cond:
+            if not self.pending:
+                self.first_at = time.monotonic()
+            self.pending.append((list(messages), callback))
+            self.pending_rows += len(messages)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+            self.cond.notify()
+
+    def __len__(self):
+        return self.pending_rows
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                while self.pending_rows < self.max_rows:
+                    remaining = self.first_at + self.window - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            self.flush()
+
+    def flush(self):
+        """Writes every queued row now, runs the callbacks and returns the number of rows written."""
+        with self.write_lock:
+            with self.cond:
+                batch, self.pending = self.pending, []
+                self.pending_rows = 0
+            if not batch:
+                return 0
+            messages = [message for entries, _ in batch for message in entries]
+            try:
+                stored = self.write(messages)
+            except Exception as e:
+                print("DEBUG:", self.name, "write of", len(messages), "rows failed:", e)
+                stored = [False] * len(messages)
+            self.stats['batches'] += 1
+            self.stats['rows'] += len(messages)
+            self.stats['rejected'] += stored.count(False)
+            start = 0
+            for entries, callback in batch:
+                results = stored[start:start + len(entries)]
+                start += len(entries)
+                if callback is not None:
+                    try:
+                        callback(results)
+                    except Exception as e:
+                        print("DEBUG:", self.name, "callback failed:", e)
+            return len(messages)
+
+
+class MessageLogQueue(OfflineWriteQueue):
+    """
+    append() takes (owner, conversation, message) tuples and returns their
+    [(log_id, prev_log_id)] at once, like database.append_message_log; the
+    rows are committed by the writer thread. Readers of the log call flush()
+    first.
+    """
+    name = "message-log-writer"
+
+    def __init__(self, window=OFFLINE_WRITE_WINDOW, max_rows=OFFLINE_WRITE_BATCH, write=write_message_log):
+        super().__init__(window, max_rows, write)
+        self.next_id = None  # read from the database on first use
+        self.heads = {}      # (owner, conversation) -> newest log id handed out
+        self.ids_lock = threading.Lock()
+
+    def append(self, entries):
+        now = time.time()
+        rows = []
+        ids = []
+        with self.ids_lock:
+            if self.next_id is None:
+                self.next_id = get_message_log_next_id()
+            for owner, conversation, message in entries:
+                key = (owner, conversation)
+                prev_id = self.heads.get(key)
+                if prev_id is None:
+                    prev_id = get_message_log_head(owner, conversation)
+                log_id = self.next_id
+                self.next_id += 1
+                self.heads[key] = log_id
+                rows.append((log_id, owner, conversation, message, now))
+                ids.append((log_id, prev_id))
+            # Queued under the lock, so rows are committed in id order
+            self.put(rows)
+        return ids